@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+
+import pika
+import pika.exceptions
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from consumer import (
+    CONSUMED,
+    DEFAULT_PREFETCH_COUNT,
+    HANDLER_ERRORS,
+    HANDLER_SECONDS,
+    LAG_SECONDS,
+)
+from memory_broker import is_memory_address
+
+
+# Whether config.json selects the asyncio runtime instead of the default
+# thread-per-consumer BlockingConnection setup
+def use_asyncio(config):
+    return config.get('runtime', 'threaded') == 'asyncio'
+
+
+# Asyncio consumer runtime. All consumers share one AMQP connection driven
+# by the event loop, each on its own channel with its own prefetch window.
+# Every delivery runs `await handler(body, properties)` as a task and is
+# acked when the coroutine finishes, so up to `prefetch_count` messages per
+# queue are processed concurrently without extra threads.
+class AsyncRuntime:
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.loop = None
+        self.connection = None
+        self.closed = None
+        self._tasks = set()
+        self._publish_channel = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        opened = self.loop.create_future()
+
+        def on_open_error(_, error):
+            if not opened.done():
+                opened.set_exception(
+                    pika.exceptions.AMQPConnectionError(error))
+
+        def on_close(_, reason):
+            logging.warning(f"RabbitMQ connection closed: {reason}")
+            if not self.closed.done():
+                self.closed.set_result(reason)
+
+        self.connection = AsyncioConnection(
+            self.parameters,
+            on_open_callback=lambda _: opened.set_result(None),
+            on_open_error_callback=on_open_error,
+            on_close_callback=on_close,
+            custom_ioloop=self.loop)
+        await opened
+        return self
+
+    async def open_channel(self):
+        opened = self.loop.create_future()
+        self.connection.channel(on_open_callback=opened.set_result)
+        return await opened
+
+    # Await a channel method that reports completion through `callback`
+    def _call(self, method, **kwargs):
+        done = self.loop.create_future()
+        method(callback=lambda frame: done.done() or done.set_result(frame),
+               **kwargs)
+        return done
+
+    async def consume(self,
+                      queue_name,
+                      handler,
+                      prefetch_count=DEFAULT_PREFETCH_COUNT):
+        channel = await self.open_channel()
+        await self._call(channel.queue_declare, queue=queue_name, durable=True)
+        await self._call(channel.basic_qos, prefetch_count=prefetch_count)
+
+        def on_message(ch, method, properties, body):
+            task = self.loop.create_task(
+                self._handle(ch, method, properties, body, handler,
+                             queue_name, time.monotonic()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        channel.basic_consume(queue_name, on_message, auto_ack=False)
+        logging.info(f"Consuming {queue_name} on channel "
+                     f"{channel.channel_number}")
+        return channel
+
+    @staticmethod
+    async def _handle(channel, method, properties, body, handler, queue_name,
+                      received_at):
+        started = time.monotonic()
+        LAG_SECONDS.labels(queue_name).observe(started - received_at)
+        try:
+            await handler(body, properties)
+            failed = False
+        except Exception as e:
+            HANDLER_ERRORS.labels(queue_name).inc()
+            logging.error(f"Error processing message from {queue_name}, "
+                          f"requeueing it: {e}")
+            failed = True
+        HANDLER_SECONDS.labels(queue_name).observe(time.monotonic() - started)
+        CONSUMED.labels(queue_name).inc()
+        if not channel.is_open:
+            return
+        # A failed message may have rows queued but not committed
+        if failed:
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        else:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    async def _publisher(self):
+        if self._publish_channel is None or not self._publish_channel.is_open:
+            self._publish_channel = await self.open_channel()
+        return self._publish_channel
+
+    async def declare(self, queue_name):
+        channel = await self._publisher()
+        await self._call(channel.queue_declare, queue=queue_name, durable=True)
+
+    # Declare the exchanges, queues and bindings of a topology.Topology
+    async def declare_topology(self, topology):
+        channel = await self._publisher()
+        for method, kwargs in topology.declarations():
+            await self._call(getattr(channel, method), **kwargs)
+
+    async def publish(self, routing_key, body, exchange='', properties=None):
+        channel = await self._publisher()
+        channel.basic_publish(exchange=exchange,
+                              routing_key=routing_key,
+                              body=body,
+                              properties=properties)
+
+    # Schedule a publish from another thread
+    def publish_threadsafe(self, routing_key, body, exchange=''):
+        asyncio.run_coroutine_threadsafe(
+            self.publish(routing_key, body, exchange), self.loop)
+
+    # Wait until a BatchWriter has committed everything queued so far;
+    # raises RuntimeError when the writer dropped some of those rows
+    async def wait_for_commit(self, writer):
+        committed = self.loop.create_future()
+
+        def settle(error=None):
+            if committed.done():
+                return
+            if error is None:
+                committed.set_result(None)
+            else:
+                committed.set_exception(error)
+
+        writer.after_commit(
+            lambda: self.loop.call_soon_threadsafe(settle),
+            lambda: self.loop.call_soon_threadsafe(
+                settle, RuntimeError(f"{writer.path} dropped rows")))
+        await committed
+
+    async def wait_closed(self):
+        await self.closed
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
+            await self.closed
+
+
+# Connect a runtime using the rabbitmq_address from config.json
+async def connect_from_config(config):
+    if is_memory_address(config['rabbitmq_address']):
+        raise ValueError("The in-memory broker needs the threaded runtime")
+    runtime = AsyncRuntime(pika.URLParameters(config['rabbitmq_address']))
+    return await runtime.connect()
+
+
+# Prefetch window for asyncio consumers, shared with the threaded consumers
+def prefetch_from_config(config):
+    return config.get('consumer', {}).get('prefetch_count',
+                                          DEFAULT_PREFETCH_COUNT)
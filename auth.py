@@ -1,55 +1,62 @@
 import json
 import logging
-import random
 import sqlite3
+import threading
+import time
 import uuid
 
-import pika
 from flask import Blueprint, jsonify, request, session
 
-auth_blueprint = Blueprint('auth', __name__)
+from channel_pool import log_failure, pool_from_config
+from db import Database
+from game_map import load_game_map
+from messages import (
+    load_codec,
+    message_properties,
+    movement_message,
+    parse_location,
+)
+from metrics import LogSampler
+from topology import MOVEMENTS_EXCHANGE, load_topology
 
-# Singleton pattern for RabbitMQ connection
-class RabbitMQConnection:
-    _instance = None
-
-    @classmethod
-    def get_instance(cls):
-        if cls._instance is None:
-            cls._instance = cls._create_connection()
-        return cls._instance
-
-    @classmethod
-    def _create_connection(cls):
-        with open('config.json') as f:
-            config = json.load(f)
-        connection = pika.BlockingConnection(
-            pika.URLParameters(config['rabbitmq_address'])
-        )
-        channel = connection.channel()
-        # Ensuring queue is declared durable
-        channel.queue_declare(queue='movement_updates', durable=True)
-        return connection, channel
+auth_blueprint = Blueprint('auth', __name__)
 
-# Database setup
-def get_db_connection():
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Login log lines are sampled, so a login storm does not flood the log
+log_sampler = LogSampler()
+
+# Publisher pool shared by all request threads, started on first use
+publisher = None
+publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global publisher
+    with publisher_lock:
+        if publisher is None:
+            with open('config.json') as f:
+                config = json.load(f)
+            log_sampler.configure(config)
+            # Declares the durable exchanges and service queues
+            publisher = pool_from_config(
+                config,
+                declarations=load_topology().declarations())
+        return publisher
+
+# Database setup: the schema is created once at import, and the routes share
+# pooled connections
+users_db = Database('users.db', schema=['''
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        location TEXT,
+        is_admin BOOLEAN NOT NULL CHECK (is_admin IN (0, 1))
+    )
+'''], row_factory=sqlite3.Row)
 
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            location TEXT,
-            is_admin BOOLEAN NOT NULL CHECK (is_admin IN (0, 1))
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with open('config.json') as f:
+        users_db.configure(json.load(f))
+    users_db.setup()
 
 init_db()
 
@@ -58,29 +65,23 @@ def generate_session_token():
     return str(uuid.uuid4())
 
 def generate_random_location():
-    with open('config.json') as f:
-        config = json.load(f)
-    map_size = config['map_size']
-    x = random.randint(0, map_size[0] - 1)
-    y = random.randint(0, map_size[1] - 1)
+    x, y = load_game_map().random_open_cell()
     return f"{x},{y}"
 
 # Post login to RabbitMQ with message persistence
 def post_login_to_rabbitmq(username, location):
-    connection, channel = RabbitMQConnection.get_instance()
-    message = {
-        'action': 'login',
-        'user': username,
-        'location': location,
-        'turn': 0
-    }
-    channel.basic_publish(
-        exchange='',
-        routing_key='movement_updates',
-        body=json.dumps(message),
-        properties=pika.BasicProperties(delivery_mode=2)  # Ensure message persistence
-    )
-    logging.info(f"Published login message for user {username}")
+    codec = load_codec()
+    x, y = parse_location(location)
+    message = movement_message(username, x, y, turn=0,
+                               timestamp=int(time.time()), action='login')
+    get_publisher().publish(
+        load_topology().routing_key(x, y),
+        codec.encode(message),
+        exchange=MOVEMENTS_EXCHANGE,
+        properties=message_properties(codec)  # Persistent, with content type
+    ).add_done_callback(log_failure)
+    log_sampler.log('login', "Published login message for user %s",
+                    username)
 
 # Routes
 @auth_blueprint.route('/register', methods=['POST'])
@@ -91,21 +92,19 @@ def register():
     if not username or not password:
         return jsonify({"error": "Username and password are required"}), 400
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-    if cursor.fetchone():
-        conn.close()
-        return jsonify({"error": "User already exists"}), 409
-
-    location = generate_random_location()
-    cursor.execute(
-        'INSERT INTO users (username, password, location, is_admin) '
-        'VALUES (?, ?, ?, ?)',
-        (username, password, location, False)
-    )
-    conn.commit()
-    conn.close()
+    with users_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+        if cursor.fetchone():
+            return jsonify({"error": "User already exists"}), 409
+
+        location = generate_random_location()
+        cursor.execute(
+            'INSERT INTO users (username, password, location, is_admin) '
+            'VALUES (?, ?, ?, ?)',
+            (username, password, location, False)
+        )
+        conn.commit()
     return jsonify({
         "message": "User registered successfully",
         "location": location
@@ -119,20 +118,21 @@ def login():
     if not username or not password:
         return jsonify({"error": "Username and password are required"}), 400
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        'SELECT * FROM users WHERE username = ? AND password = ?',
-        (username, password)
-    )
-    user = cursor.fetchone()
-    conn.close()
+    with users_db.connection() as conn:
+        user = conn.execute(
+            'SELECT * FROM users WHERE username = ? AND password = ?',
+            (username, password)
+        ).fetchone()
     if not user:
         return jsonify({"error": "Invalid username or password"}), 401
 
     session['username'] = username
     location = user['location']
-    post_login_to_rabbitmq(username, location)
+    try:
+        post_login_to_rabbitmq(username, location)
+    except TimeoutError as e:
+        logging.error(f"Publishing login of {username} timed out: {e}")
+        return jsonify({"error": "Login publisher unavailable"}), 503
     return jsonify({
         "message": "Login successful",
         "session_token": generate_session_token(),
@@ -0,0 +1,50 @@
+import argparse
+import timeit
+
+from messages import CODEC_NAMES, movement_message, turn_message
+
+
+# Representative messages for each queue
+def sample_messages():
+    return {
+        "movement": movement_message('user_1234', 7, 3, turn=4182,
+                                     timestamp=1718000000),
+        "login": movement_message('user_1234', 2, 8, turn=0, action='login'),
+        "turn": turn_message(4182),
+        "map delta": {
+            "type": "delta",
+            "seq": 912,
+            "turn": 4182,
+            "cells": [[x, 3, ' ', 'user_1234'] for x in range(1, 9)]
+        },
+    }
+
+
+# Time encode and decode of every sample with every available codec
+def run(number):
+    print(f"{'message':<10} {'codec':<8} {'bytes':>6} "
+          f"{'encode us':>10} {'decode us':>10}")
+    for label, message in sample_messages().items():
+        for name, codec in CODEC_NAMES.items():
+            body = codec.encode(message)
+            encode = timeit.timeit(
+                lambda codec=codec, message=message: codec.encode(message),
+                number=number)
+            decode = timeit.timeit(
+                lambda codec=codec, body=body: codec.decode(body),
+                number=number)
+            print(f"{label:<10} {name:<8} {len(body):>6} "
+                  f"{encode / number * 1e6:>10.2f} "
+                  f"{decode / number * 1e6:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare message codecs by size and encode/decode cost")
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help="iterations per measurement")
+    run(parser.parse_args().number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from flask import Flask
+
+from db_writer import writer_from_config
+
+REPORT_PATHS = [
+    '/report/summary/{user}',
+    '/report/movement/{user}?limit=50',
+    '/report/intersection/{user}?limit=50',
+    '/report/heatmap',
+]
+
+
+# Fill reports.db through the report service's own writer and schema
+def seed_reports(report_service, config, users, movements, seed):
+    rng = random.Random(seed)
+    writer = writer_from_config('reports.db',
+                                config,
+                                schema=report_service.INGEST_SCHEMA)
+    for i in range(movements):
+        user = f"user{rng.randrange(users)}"
+        writer.submit(
+            'INSERT INTO movements (user, location, timestamp) '
+            'VALUES (?, ?, ?)',
+            (user, f"{rng.randrange(10)},{rng.randrange(10)}", str(i)))
+        if i % 4 == 0:
+            other = f"user{rng.randrange(users)}"
+            writer.submit(
+                'INSERT INTO intersections (user1, user2, location, '
+                'timestamp) VALUES (?, ?, ?, ?)',
+                (min(user, other), max(user, other), "1,1", str(i)))
+    writer.close()
+
+
+# p50 and p99 latency in microseconds of `requests` calls of `send`
+def latency(send, requests):
+    for _ in range(requests // 10):
+        send()
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = send()
+        timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"Request failed with {response.status_code}")
+    timings.sort()
+    return (timings[len(timings) // 2] * 1e6,
+            timings[int(len(timings) * 0.99)] * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare report and login latency with pooled SQLite "
+        "connections and with a connection per request")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--movements', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[0, 8],
+                        help="0 opens a connection for every request")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # auth and report_service read config.json from the working directory;
+    # the bench uses this tree's config on the in-memory broker
+    with open(args.config) as f:
+        config = json.load(f)
+    config['rabbitmq_address'] = 'memory://'
+    workdir = tempfile.mkdtemp(prefix='bench-db-')
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    os.chdir(workdir)
+    try:
+        auth = importlib.import_module('auth')
+        report_service = importlib.import_module('report_service')
+        logging.getLogger().setLevel(logging.WARNING)
+        # Logins are timed up to the database lookup
+        auth.post_login_to_rabbitmq = lambda _username, _location: None
+
+        seed_reports(report_service, config, args.users, args.movements,
+                     args.seed)
+        app = Flask(__name__)
+        app.secret_key = 'bench'
+        app.register_blueprint(auth.auth_blueprint)
+        app.register_blueprint(report_service.report_blueprint)
+        client = app.test_client()
+        registered = client.post('/register',
+                                 json={"username": "bench", "password": "x"})
+        if registered.status_code != 201:
+            raise RuntimeError(f"Register failed: {registered.get_json()}")
+
+        requests = [(path, lambda path=path: client.get(
+            path.format(user='user7'))) for path in REPORT_PATHS]
+        requests.append(('/login', lambda: client.post(
+            '/login', json={"username": "bench", "password": "x"})))
+
+        print(f"{'route':<38} {'pool':>5} {'p50 us':>8} {'p99 us':>8}")
+        for path, send in requests:
+            for pool_size in args.pool_sizes:
+                for database in (auth.users_db, report_service.reports_db):
+                    database.configure({"sqlite": {"pool_size": pool_size}})
+                p50, p99 = latency(send, args.requests)
+                print(f"{path:<38} {pool_size:>5} {p50:>8.0f} {p99:>8.0f}")
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
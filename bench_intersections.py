@@ -0,0 +1,110 @@
+import argparse
+import multiprocessing
+import random
+import time
+
+from intersection_engine import IntersectionEngine
+from intersection_shards import IntersectionShard, ShardLayout
+
+
+# Random positions for `users` users over `turns` turns as (turn, user, x, y)
+def generate_positions(width, height, users, turns, seed):
+    rng = random.Random(seed)
+    return [(turn, f"user{user}", rng.randrange(width), rng.randrange(height))
+            for turn in range(turns) for user in range(users)]
+
+
+# Resolve positions turn by turn; returns the hits as (turn, hit) pairs
+def resolve(engine, positions):
+    hits = []
+    turn = None
+    for position_turn, user, x, y in positions:
+        if position_turn != turn:
+            if turn is not None:
+                hits.extend((turn, hit) for hit in engine.detect(turn))
+            turn = position_turn
+        engine.add(position_turn, user, x, y)
+    if turn is not None:
+        hits.extend((turn, hit) for hit in engine.detect(turn))
+    return hits
+
+
+# Positions a shard would receive from its topic bindings: every position
+# in the tiles its cells and halo touch
+def route(layout, worker, positions):
+    tiles = set(layout.tiles_needed(worker))
+    return [position for position in positions
+            if layout.tile_of(position[2], position[3]) in tiles]
+
+
+def run_shard(args):
+    layout, worker, positions = args
+    shard = IntersectionShard(layout, worker)
+    started = time.perf_counter()
+    hits = resolve(shard, positions)
+    return hits, time.perf_counter() - started
+
+
+def bench_single(layout, positions):
+    engine = IntersectionEngine(layout.width, layout.height, layout.radius)
+    started = time.perf_counter()
+    hits = resolve(engine, positions)
+    return hits, time.perf_counter() - started
+
+
+def bench_sharded(layout, positions):
+    jobs = [(layout, worker, route(layout, worker, positions))
+            for worker in range(layout.workers)]
+    with multiprocessing.Pool(layout.workers) as pool:
+        started = time.perf_counter()
+        results = pool.map(run_shard, jobs)
+        wall = time.perf_counter() - started
+    hits = [hit for shard_hits, _ in results for hit in shard_hits]
+    slowest = max(elapsed for _, elapsed in results)
+    received = sum(len(job[2]) for job in jobs)
+    return hits, slowest, wall, received
+
+
+def canonical(hits):
+    return sorted(hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare sharded and single-process intersection "
+        "detection")
+    parser.add_argument('--size', type=int, nargs=2, default=[200, 200],
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--tile', type=int, nargs=2, default=[25, 25],
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--radius', type=float, default=1.5)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--turns', type=int, default=40)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    width, height = args.size
+    positions = generate_positions(width, height, args.users, args.turns,
+                                   args.seed)
+    single_layout = ShardLayout(width, height, 1, tuple(args.tile),
+                                args.radius)
+    expected, elapsed = bench_single(single_layout, positions)
+    print(f"{len(positions)} positions, {len(expected)} intersections")
+    print(f"{'mode':<12} {'received':>9} {'slowest s':>10} {'wall s':>8} "
+          f"{'positions/s':>12} {'match':>6}")
+    print(f"{'single':<12} {len(positions):>9} {elapsed:>10.3f} "
+          f"{elapsed:>8.3f} {len(positions) / elapsed:>12.0f} {'yes':>6}")
+    expected = canonical(expected)
+
+    for workers in args.workers:
+        layout = ShardLayout(width, height, workers, tuple(args.tile),
+                             args.radius)
+        hits, slowest, wall, received = bench_sharded(layout, positions)
+        match = 'yes' if canonical(hits) == expected else 'NO'
+        print(f"{f'{workers} shards':<12} {received:>9} {slowest:>10.3f} "
+              f"{wall:>8.3f} {len(positions) / slowest:>12.0f} {match:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from consumer import Delivery
+from messages import codec_from_config, message_properties
+from topology import Topology, map_worker_bindings
+
+
+# Config for a bordered width x height map whose history holds every turn
+# of the run in memory
+def bench_config(width, height, turns, region_size, codec):
+    layout = [['/'] * width] + [
+        ['/'] + [' '] * (width - 2) + ['/'] for _ in range(height - 2)
+    ] + [['/'] * width]
+    return {
+        "rabbitmq_address": "memory://",
+        "message_codec": codec,
+        "map_size": [width, height],
+        "map_layout": layout,
+        "map_history": {"max_turns": turns + 1},
+        "topology": {"region_size": list(region_size)},
+        "metrics": {"log_sample_every": 1000000000}
+    }
+
+
+# Encoded movement deliveries for `users` users over `turns` turns, in the
+# order the map builder would receive them
+def generate_deliveries(config, users, turns, seed):
+    rng = random.Random(seed)
+    codec = codec_from_config(config)
+    properties = message_properties(codec)
+    width, height = config['map_size']
+    deliveries = []
+    for turn in range(turns):
+        for user in range(users):
+            x, y = rng.randrange(1, width - 1), rng.randrange(1, height - 1)
+            body = codec.encode({
+                "user": str(user),
+                "location": [x, y],
+                "turn": turn
+            })
+            deliveries.append(
+                Delivery(len(deliveries), properties, body, 0.0))
+    return deliveries
+
+
+# Deliveries each worker's queue would receive from its region bindings
+def route(config, workers, deliveries):
+    width, height = config['map_size']
+    region_size = tuple(config['topology']['region_size'])
+    topology = Topology(region_size)
+    queue_of = {
+        binding.routing_key: int(binding.queue.rsplit('.', 1)[1])
+        for binding in map_worker_bindings(width, height, region_size,
+                                           workers)
+    }
+    codec = codec_from_config(config)
+    routed = [[] for _ in range(workers)]
+    for delivery in deliveries:
+        x, y = codec.decode(delivery.body)['location']
+        routed[queue_of[topology.routing_key(x, y)]].append(delivery)
+    return routed
+
+
+# Apply deliveries in consumer-sized batches to a fresh map; returns the
+# changes of every batch and the seconds it took
+def apply_batches(mapbuilder, deliveries, batch_size):
+    mapbuilder.maps_by_turn = mapbuilder.worker_history()
+    mapbuilder.dirty_cells_by_turn.clear()
+    batches = []
+    started = time.perf_counter()
+    for start in range(0, len(deliveries), batch_size):
+        batches.append(
+            mapbuilder.apply_movements(deliveries[start:start + batch_size]))
+        mapbuilder.dirty_cells_by_turn.clear()
+    return batches, time.perf_counter() - started
+
+
+def run_worker(args):
+    deliveries, batch_size = args
+    return apply_batches(importlib.import_module('mapbuilder'), deliveries,
+                         batch_size)
+
+
+def grids(mapbuilder, turns):
+    return [mapbuilder.maps_by_turn.rows(turn) for turn in range(turns)
+            if turn in mapbuilder.maps_by_turn]
+
+
+def bench_single(mapbuilder, deliveries, batch_size, turns):
+    _, elapsed = apply_batches(mapbuilder, deliveries, batch_size)
+    return grids(mapbuilder, turns), elapsed
+
+
+# Apply each worker's deliveries in its own forked process, then merge
+# their changes into the parent's map as mapbuilder does
+def bench_workers(mapbuilder, routed, batch_size, turns):
+    context = multiprocessing.get_context('fork')
+    with context.Pool(len(routed)) as pool:
+        started = time.perf_counter()
+        results = pool.map(run_worker,
+                           [(deliveries, batch_size) for deliveries in routed])
+        wall = time.perf_counter() - started
+    slowest = max(elapsed for _, elapsed in results)
+
+    mapbuilder.maps_by_turn = mapbuilder.worker_history()
+    mapbuilder.dirty_cells_by_turn.clear()
+    started = time.perf_counter()
+    for batches, _ in results:
+        for changes_by_turn in batches:
+            mapbuilder.merge_changes(changes_by_turn)
+    merge = time.perf_counter() - started
+    mapbuilder.dirty_cells_by_turn.clear()
+    return grids(mapbuilder, turns), slowest, wall, merge
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare map building with one process and with "
+        "region-sharded map workers")
+    parser.add_argument('--size', type=int, nargs=2, default=[200, 200],
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--region', type=int, nargs=2, default=[25, 25],
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--codec', default='json')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    width, height = args.size
+    config = bench_config(width, height, args.turns, tuple(args.region),
+                          args.codec)
+    deliveries = generate_deliveries(config, args.users, args.turns,
+                                     args.seed)
+
+    # mapbuilder reads config.json from the working directory on import
+    workdir = tempfile.mkdtemp(prefix='bench-mapbuilder-')
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    os.chdir(workdir)
+    try:
+        mapbuilder = importlib.import_module('mapbuilder')
+        logging.getLogger().setLevel(logging.WARNING)
+
+        expected, elapsed = bench_single(mapbuilder, deliveries,
+                                         args.batch_size, args.turns)
+        print(f"{len(deliveries)} movements over {args.turns} turns")
+        print(f"{'mode':<12} {'slowest s':>10} {'wall s':>8} {'merge s':>8} "
+              f"{'moves/s':>10} {'match':>6}")
+        print(f"{'single':<12} {elapsed:>10.3f} {elapsed:>8.3f} "
+              f"{0:>8.3f} {len(deliveries) / elapsed:>10.0f} {'yes':>6}")
+
+        for workers in args.workers:
+            routed = route(config, workers, deliveries)
+            maps, slowest, wall, merge = bench_workers(
+                mapbuilder, routed, args.batch_size, args.turns)
+            match = 'yes' if maps == expected else 'NO'
+            # The parent merges while the workers run, so the slower of the
+            # two bounds throughput
+            bound = max(slowest, merge)
+            print(f"{f'{workers} workers':<12} {slowest:>10.3f} "
+                  f"{wall:>8.3f} {merge:>8.3f} "
+                  f"{len(deliveries) / bound:>10.0f} {match:>6}")
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
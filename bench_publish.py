@@ -0,0 +1,107 @@
+import argparse
+import json
+import threading
+import time
+
+import pika
+
+from channel_pool import ChannelPool
+
+BENCH_QUEUE = 'bench_publish'
+
+
+def load_config():
+    with open('config.json') as f:
+        return json.load(f)
+
+
+# Baseline: one BlockingConnection publishing in confirm mode, each publish
+# waiting for its own confirm
+def bench_blocking(parameters, count, body):
+    connection = pika.BlockingConnection(parameters)
+    channel = connection.channel()
+    channel.queue_declare(queue=BENCH_QUEUE, durable=True)
+    channel.confirm_delivery()
+    properties = pika.BasicProperties(delivery_mode=2)
+    started = time.perf_counter()
+    for _ in range(count):
+        channel.basic_publish(exchange='',
+                              routing_key=BENCH_QUEUE,
+                              body=body,
+                              properties=properties)
+    elapsed = time.perf_counter() - started
+    channel.queue_purge(BENCH_QUEUE)
+    connection.close()
+    return elapsed
+
+
+# Pooled channels with asynchronous confirms, `threads` publishers sharing
+# `count` messages
+def bench_pool(parameters, count, body, threads, window):
+    pool = ChannelPool(parameters, queues=(BENCH_QUEUE, ),
+                       confirm_window=window,
+                       max_channels=threads).start()
+    properties = pika.BasicProperties(delivery_mode=2)
+
+    def publish(n):
+        for _ in range(n):
+            pool.publish(BENCH_QUEUE, body, properties=properties)
+
+    workers = [
+        threading.Thread(target=publish, args=(count // threads, ))
+        for _ in range(threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.flush()
+    elapsed = time.perf_counter() - started
+    stats = pool.stats()
+    pool.close()
+    return elapsed, stats
+
+
+def report(label, count, elapsed):
+    print(f"{label:<32} {count:>8} msgs {elapsed:>8.2f}s "
+          f"{count / elapsed:>10.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure confirmed publish throughput against RabbitMQ")
+    parser.add_argument('-n', '--count', type=int, default=20000)
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help="message body size in bytes")
+    parser.add_argument('-t', '--threads', type=int, nargs='+',
+                        default=[1, 4])
+    parser.add_argument('-w', '--windows', type=int, nargs='+',
+                        default=[1, 64, 256, 1024])
+    parser.add_argument('--skip-baseline', action='store_true')
+    args = parser.parse_args()
+
+    parameters = pika.URLParameters(load_config()['rabbitmq_address'])
+    body = b'x' * args.size
+
+    if not args.skip_baseline:
+        report("blocking, confirm per publish", args.count,
+               bench_blocking(parameters, args.count, body))
+    for threads in args.threads:
+        for window in args.windows:
+            count = args.count // threads * threads
+            elapsed, stats = bench_pool(parameters, count, body, threads,
+                                        window)
+            report(f"pool, {threads} threads, window {window}", count,
+                   elapsed)
+            if stats['nacked']:
+                print(f"  {stats['nacked']} messages nacked")
+
+    # Remove what the pooled runs left in the queue
+    connection = pika.BlockingConnection(parameters)
+    connection.channel().queue_delete(BENCH_QUEUE)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
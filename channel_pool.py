@@ -0,0 +1,390 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+import pika
+from pika.spec import Basic
+
+from memory_broker import InMemoryPublisher, is_memory_address, shared_broker
+from metrics import counter, histogram
+
+DEFAULT_CONFIRM_WINDOW = 256
+DEFAULT_MAX_CHANNELS = 8
+DEFAULT_RECONNECT_DELAY = 1.0
+DEFAULT_MAX_RECONNECT_DELAY = 30.0
+DEFAULT_PUBLISH_TIMEOUT = 5.0
+
+PUBLISHED = counter('publisher_messages_total',
+                    "Messages sent by the publisher pool")
+NACKED = counter('publisher_nacks_total',
+                 "Messages the broker rejected")
+CONFIRM_SECONDS = histogram('publisher_confirm_seconds',
+                            "Time from sending a message to its confirm")
+
+# A message waiting to be sent or confirmed
+Outgoing = namedtuple('Outgoing',
+                      ['exchange', 'routing_key', 'body', 'properties',
+                       'future'])
+
+
+# Raised through a publish future when the broker rejects the message
+class PublishNacked(Exception):
+    pass
+
+
+# One confirm-mode channel of a ChannelPool. Any thread may publish; messages
+# leave in publish order. At most `confirm_window` messages are unconfirmed
+# at a time, and publish() blocks while the window is full, for at most the
+# pool's publish_timeout unless given a timeout, then raises TimeoutError.
+# Messages still unconfirmed when the channel is lost are sent again after
+# reconnecting.
+class PooledChannel:
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self._window = threading.BoundedSemaphore(pool.confirm_window)
+        self._outbox = deque()
+        self._outbox_lock = threading.Lock()
+        self.outstanding = 0
+        # Only touched on the pool's IO thread
+        self._channel = None
+        self._opening = False
+        self._unconfirmed = {}
+        self._sent_at = {}
+        self._next_tag = 1
+
+    def publish(self, routing_key, body, exchange='', properties=None,
+                timeout=None):
+        if timeout is None:
+            timeout = self.pool.publish_timeout
+        if not self._window.acquire(timeout=timeout):
+            raise TimeoutError(
+                f"Confirm window of channel {self.name} is full")
+        future = Future()
+        with self._outbox_lock:
+            self._outbox.append(
+                Outgoing(exchange, routing_key, body, properties, future))
+            self.outstanding += 1
+        if not self.pool.call_soon(self._drain):
+            logging.debug(f"Publisher channel {self.name} is disconnected; "
+                          "message queued until it reconnects")
+        return future
+
+    # Release the window slot of a message that is confirmed or abandoned
+    def _settle(self):
+        with self._outbox_lock:
+            self.outstanding -= 1
+        self._window.release()
+
+    # IO thread: open the AMQP channel on a fresh connection
+    def _open(self, connection):
+        self._opening = True
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(
+            self._on_confirm,
+            callback=lambda _: self._declare(channel, self.pool.declarations))
+
+    # Make the pool's declarations one after another, then start sending
+    def _declare(self, channel, calls):
+        if not calls:
+            self._channel = channel
+            self._opening = False
+            self._next_tag = 1
+            self._drain()
+            return
+        method, kwargs = calls[0]
+        getattr(channel, method)(
+            callback=lambda _: self._declare(channel, calls[1:]), **kwargs)
+
+    def _drain(self):
+        channel = self._channel
+        if channel is None or not channel.is_open:
+            return
+        while True:
+            with self._outbox_lock:
+                if not self._outbox:
+                    return
+                outgoing = self._outbox.popleft()
+            channel.basic_publish(exchange=outgoing.exchange,
+                                  routing_key=outgoing.routing_key,
+                                  body=outgoing.body,
+                                  properties=outgoing.properties)
+            self._unconfirmed[self._next_tag] = outgoing
+            self._sent_at[self._next_tag] = time.monotonic()
+            self._next_tag += 1
+            self.pool.published += 1
+            PUBLISHED.inc()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed
+                    if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        acked = isinstance(method, Basic.Ack)
+        now = time.monotonic()
+        for tag in tags:
+            outgoing = self._unconfirmed.pop(tag, None)
+            if outgoing is None:
+                continue
+            CONFIRM_SECONDS.observe(now - self._sent_at.pop(tag, now))
+            if acked:
+                self.pool.confirmed += 1
+                outgoing.future.set_result(tag)
+            else:
+                self.pool.nacked += 1
+                NACKED.inc()
+                outgoing.future.set_exception(PublishNacked(
+                    f"Broker rejected message for {outgoing.routing_key}"))
+            self._settle()
+
+    # Put unconfirmed messages back in front of the outbox for the next
+    # connection
+    def _on_channel_closed(self, _, reason):
+        if self._channel is not None and not self.pool.closing:
+            logging.warning(f"Publisher channel {self.name} closed: {reason}")
+        self._channel = None
+        self._opening = False
+        unconfirmed = [self._unconfirmed[tag]
+                       for tag in sorted(self._unconfirmed)]
+        self._unconfirmed = {}
+        self._sent_at = {}
+        with self._outbox_lock:
+            self._outbox.extendleft(reversed(unconfirmed))
+        if not self.pool.closing and self.pool.connection is not None:
+            self.pool.connection.ioloop.call_later(
+                self.pool.reconnect_delay,
+                lambda: self._reopen(self.pool.connection))
+
+    def _reopen(self, connection):
+        if (self._channel is None and not self._opening
+                and connection is self.pool.connection and connection.is_open):
+            self._open(connection)
+
+    # Fail everything not yet confirmed; used when the pool closes
+    def _abandon(self):
+        with self._outbox_lock:
+            pending = list(self._unconfirmed.values()) + list(self._outbox)
+            self._outbox.clear()
+        self._unconfirmed = {}
+        self._sent_at = {}
+        for outgoing in pending:
+            outgoing.future.set_exception(
+                pika.exceptions.ConnectionClosed(320, "Publisher pool closed"))
+            self._settle()
+
+
+# Thread-safe publisher. A single SelectConnection runs on its own IO
+# thread. Each publishing thread gets its own confirm-mode channel until
+# `max_channels` exist, after which threads share them round-robin, so
+# thread-per-request servers do not open a channel per request. Threads
+# that need one ordered stream share a named channel instead.
+# publish() returns a concurrent.futures.Future resolved when the broker
+# confirms the message, or raises TimeoutError when the confirm window stays
+# full for `publish_timeout` seconds, e.g. while the broker is down. The
+# connection is re-established with exponential backoff and unconfirmed
+# messages are republished, so delivery is at-least-once.
+class ChannelPool:
+
+    def __init__(self,
+                 parameters,
+                 queues=(),
+                 declarations=(),
+                 confirm_window=DEFAULT_CONFIRM_WINDOW,
+                 max_channels=DEFAULT_MAX_CHANNELS,
+                 reconnect_delay=DEFAULT_RECONNECT_DELAY,
+                 max_reconnect_delay=DEFAULT_MAX_RECONNECT_DELAY,
+                 publish_timeout=DEFAULT_PUBLISH_TIMEOUT):
+        self.parameters = parameters
+        # Channel calls as (method name, kwargs), e.g. from
+        # topology.Topology.declarations(), followed by durable `queues`
+        self.declarations = list(declarations) + [
+            ('queue_declare', {'queue': queue, 'durable': True})
+            for queue in queues
+        ]
+        self.confirm_window = confirm_window
+        self.max_channels = max_channels
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.publish_timeout = publish_timeout
+        self.connection = None
+        self.closing = False
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.reconnects = 0
+        self._channels = {}
+        self._thread_channels = []
+        self._next_shared = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._thread = None
+
+    # Start the IO thread and wait up to `timeout` seconds for the connection
+    def start(self, timeout=10):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='channel-pool',
+                                            daemon=True)
+            self._thread.start()
+        if not self._connected.wait(timeout):
+            logging.warning("Publisher pool not connected yet; messages are "
+                            "queued until it is")
+        return self
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self.closing:
+            connection = pika.SelectConnection(
+                self.parameters,
+                on_open_callback=self._on_open,
+                on_open_error_callback=self._on_open_error,
+                on_close_callback=self._on_close)
+            connection.ioloop.start()
+            if self.closing:
+                break
+            if self._connected.is_set():
+                delay = self.reconnect_delay
+            self._connected.clear()
+            self.reconnects += 1
+            logging.info(f"Reconnecting publisher pool in {delay:.1f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _on_open(self, connection):
+        with self._lock:
+            self.connection = connection
+            channels = list(self._channels.values())
+        for pooled in channels:
+            pooled._open(connection)
+        self._connected.set()
+
+    def _on_open_error(self, connection, error):
+        logging.error(f"Publisher pool could not connect: {error}")
+        connection.ioloop.stop()
+
+    def _on_close(self, connection, reason):
+        with self._lock:
+            self.connection = None
+        if not self.closing:
+            logging.warning(f"Publisher pool connection closed: {reason}")
+        connection.ioloop.stop()
+
+    # Run `callback` on the IO thread and return True. Without a connection
+    # it is not run and False is returned; channels drain their outbox again
+    # once reconnected.
+    def call_soon(self, callback):
+        with self._lock:
+            connection = self.connection
+        if connection is None:
+            return False
+        connection.ioloop.add_callback_threadsafe(callback)
+        return True
+
+    # Channel of the calling thread, or the channel called `name`
+    def channel(self, name=None):
+        if name is not None:
+            with self._lock:
+                return self._get_channel(name)
+        pooled = getattr(self._local, 'channel', None)
+        if pooled is None:
+            with self._lock:
+                if len(self._thread_channels) < self.max_channels:
+                    pooled = self._get_channel(
+                        f"thread-{len(self._thread_channels)}")
+                    self._thread_channels.append(pooled)
+                else:
+                    pooled = self._thread_channels[self._next_shared %
+                                                   self.max_channels]
+                    self._next_shared += 1
+            self._local.channel = pooled
+        return pooled
+
+    # Must be called with self._lock held
+    def _get_channel(self, name):
+        pooled = self._channels.get(name)
+        if pooled is None:
+            pooled = self._channels[name] = PooledChannel(self, name)
+            connection = self.connection
+            if connection is not None:
+                connection.ioloop.add_callback_threadsafe(
+                    lambda: pooled._reopen(connection))
+        return pooled
+
+    def publish(self, routing_key, body, exchange='', properties=None,
+                timeout=None):
+        return self.channel().publish(routing_key, body, exchange,
+                                      properties, timeout)
+
+    # Wait until every message published so far is confirmed
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                channels = list(self._channels.values())
+            if not any(pooled.outstanding for pooled in channels):
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.001)
+
+    def stats(self):
+        with self._lock:
+            channels = list(self._channels.values())
+        return {
+            "connected": self._connected.is_set(),
+            "channels": len(channels),
+            "published": self.published,
+            "confirmed": self.confirmed,
+            "nacked": self.nacked,
+            "outstanding": sum(pooled.outstanding for pooled in channels),
+            "reconnects": self.reconnects,
+        }
+
+    def close(self, timeout=5):
+        self.flush(timeout)
+        self.closing = True
+        with self._lock:
+            connection = self.connection
+            channels = list(self._channels.values())
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(connection.close)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for pooled in channels:
+            pooled._abandon()
+
+
+# Log publishes the broker did not confirm
+def log_failure(future):
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Publish failed: {error}")
+
+
+# Started pool for the rabbitmq_address and "publisher" section of
+# config.json; the in-memory broker's address gets an InMemoryPublisher
+def pool_from_config(config, queues=(), declarations=()):
+    if is_memory_address(config['rabbitmq_address']):
+        return InMemoryPublisher(shared_broker(), queues, declarations)
+    settings = config.get('publisher', {})
+    return ChannelPool(
+        pika.URLParameters(config['rabbitmq_address']),
+        queues=queues,
+        declarations=declarations,
+        confirm_window=settings.get('confirm_window', DEFAULT_CONFIRM_WINDOW),
+        max_channels=settings.get('max_channels', DEFAULT_MAX_CHANNELS),
+        reconnect_delay=settings.get('reconnect_delay',
+                                     DEFAULT_RECONNECT_DELAY),
+        max_reconnect_delay=settings.get('max_reconnect_delay',
+                                         DEFAULT_MAX_RECONNECT_DELAY),
+        publish_timeout=settings.get('publish_timeout',
+                                     DEFAULT_PUBLISH_TIMEOUT)).start()
@@ -0,0 +1,212 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from metrics import counter, gauge, histogram
+
+# A message handed to a batch handler
+Delivery = namedtuple('Delivery',
+                      ['delivery_tag', 'properties', 'body', 'received_at'])
+
+DEFAULT_PREFETCH_COUNT = 200
+DEFAULT_BATCH_SIZE = 50
+
+CONSUMED = counter('consumer_messages_total',
+                   "Messages handled by a consumer", ['queue'])
+HANDLER_ERRORS = counter('consumer_handler_errors_total',
+                         "Handler calls that raised", ['queue'])
+HANDLER_SECONDS = histogram('consumer_handler_seconds',
+                            "Time spent in one handler call (a whole batch "
+                            "for threaded consumers)", ['queue'])
+BACKLOG = gauge('consumer_backlog',
+                "Messages received but not yet handed to the handler",
+                ['queue'])
+LAG_SECONDS = histogram('consumer_lag_seconds',
+                        "Time from a message's delivery to the start of its "
+                        "processing", ['queue'])
+
+
+# Prefetch-bounded consumer that hands messages to `handler` in batches.
+#
+# The consumer owns its channel, because acks use `multiple=True` and
+# delivery tags are scoped to a channel. Messages received by pika are put
+# on a bounded work queue and processed on a worker thread; the handler is
+# called as `handler(batch, ack)` and must call `ack()` once the batch is
+# done (immediately, or from a BatchWriter.after_commit callback). `ack()`
+# is thread-safe and acknowledges the whole batch with a single frame;
+# `ack.requeue()` returns the batch to the queue instead, e.g. when the
+# writer dropped its rows. If the handler raises, the batch is requeued too:
+# rows it already queued may not be committed yet, and redelivered rows are
+# ignored by the writers' unique indexes.
+class BatchConsumer:
+
+    def __init__(self,
+                 connection,
+                 queue_name,
+                 handler,
+                 prefetch_count=DEFAULT_PREFETCH_COUNT,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 max_backlog=None):
+        self.connection = connection
+        self.queue_name = queue_name
+        self.handler = handler
+        self.prefetch_count = prefetch_count
+        self.batch_size = batch_size
+        self.channel = None
+        self.received = 0
+        self.processed = 0
+        self.acked = 0
+        self.requeued = 0
+        self.batches = 0
+        self.lag_seconds = 0.0
+        self._work = queue.Queue(maxsize=max_backlog or prefetch_count)
+        self._lock = threading.Lock()
+        self._rate_mark = (time.monotonic(), 0)
+        self._consumed = CONSUMED.labels(queue_name)
+        self._errors = HANDLER_ERRORS.labels(queue_name)
+        self._handler_seconds = HANDLER_SECONDS.labels(queue_name)
+        self._lag_seconds = LAG_SECONDS.labels(queue_name)
+        self._backlog = BACKLOG.labels(queue_name)
+        self._stopping = threading.Event()
+        self._worker = threading.Thread(target=self._run,
+                                        name=f"BatchConsumer({queue_name})",
+                                        daemon=True)
+
+    # Open the channel and start consuming; must be called from the thread
+    # that drives the connection
+    def start(self):
+        self.channel = self.connection.channel()
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(queue=self.queue_name,
+                                   on_message_callback=self._on_message,
+                                   auto_ack=False)
+        self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._worker.join(timeout)
+
+    # Counters for monitoring. `throughput` is messages per second since the
+    # previous call and `lag_seconds` is the time the last batch's oldest
+    # message spent waiting before it was handled.
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            mark_time, mark_processed = self._rate_mark
+            elapsed = now - mark_time
+            throughput = ((self.processed - mark_processed) /
+                          elapsed if elapsed > 0 else 0.0)
+            self._rate_mark = (now, self.processed)
+            return {
+                "queue": self.queue_name,
+                "received": self.received,
+                "processed": self.processed,
+                "acked": self.acked,
+                "requeued": self.requeued,
+                "batches": self.batches,
+                "backlog": self._work.qsize(),
+                "unacked": self.received - self.acked,
+                "throughput": throughput,
+                "lag_seconds": self.lag_seconds,
+            }
+
+    def _on_message(self, _, method, properties, body):
+        with self._lock:
+            self.received += 1
+        self._work.put(
+            Delivery(method.delivery_tag, properties, body, time.monotonic()))
+
+    def _next_batch(self):
+        try:
+            batch = [self._work.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._work.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            ack, requeue = self._make_ack(batch)
+            started = time.monotonic()
+            self._backlog.set(self._work.qsize())
+            for delivery in batch:
+                self._lag_seconds.observe(started - delivery.received_at)
+            with self._lock:
+                self.lag_seconds = started - batch[0].received_at
+            try:
+                self.handler(batch, ack)
+            except Exception as e:
+                self._errors.inc()
+                logging.error(f"Error processing batch from "
+                              f"{self.queue_name}, requeueing it: {e}")
+                requeue()
+            self._handler_seconds.observe(time.monotonic() - started)
+            self._consumed.inc(len(batch))
+            with self._lock:
+                self.processed += len(batch)
+                self.batches += 1
+
+    # Callbacks settling a batch exactly once: `ack` acknowledges it and
+    # `requeue` returns it to the queue, whichever is called first
+    def _make_ack(self, batch):
+        tags = [delivery.delivery_tag for delivery in batch]
+        done = []
+
+        def settle(callback):
+            with self._lock:
+                if done:
+                    return
+                done.append(True)
+            self.connection.add_callback_threadsafe(callback)
+
+        def ack():
+            settle(lambda: self._ack(tags[-1], len(tags)))
+
+        def requeue():
+            settle(lambda: self._requeue(tags))
+
+        ack.requeue = requeue
+        return ack, requeue
+
+    def _ack(self, delivery_tag, count):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        with self._lock:
+            self.acked += count
+
+    # Nack each message on its own: multiple=True would also reject earlier
+    # batches still waiting for their commit, whose acks would then fail.
+    # Last first, so the queue gets them back in their original order.
+    def _requeue(self, tags):
+        for tag in reversed(tags):
+            self.channel.basic_nack(delivery_tag=tag, requeue=True)
+        with self._lock:
+            self.requeued += len(tags)
+
+
+# Build a consumer using the "consumer" section of config.json
+def create_consumer(connection, queue_name, handler, config):
+    settings = config.get('consumer', {})
+    return BatchConsumer(
+        connection,
+        queue_name,
+        handler,
+        prefetch_count=settings.get('prefetch_count', DEFAULT_PREFETCH_COUNT),
+        batch_size=settings.get('batch_size', DEFAULT_BATCH_SIZE),
+        max_backlog=settings.get('max_backlog'))
+
+
+# Drive a BlockingConnection until interrupted; this dispatches deliveries
+# for every channel on the connection and runs thread-safe ack callbacks
+def consume_forever(connection):
+    while True:
+        connection.process_data_events(time_limit=None)
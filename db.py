@@ -0,0 +1,183 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from metrics import counter, gauge
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CACHED_STATEMENTS = 256
+DEFAULT_SYNCHRONOUS = 'NORMAL'
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_BUSY_TIMEOUT = 5.0
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+CONNECTIONS_OPENED = counter('sqlite_connections_opened_total',
+                             "Connections opened by a Database pool",
+                             ['database', 'mode'])
+CONNECTIONS_IDLE = gauge('sqlite_connections_idle',
+                         "Pooled connections waiting for a request",
+                         ['database', 'mode'])
+
+
+# Open a SQLite connection tuned for the services: WAL so readers never
+# block the writer, NORMAL sync (a crash can lose the last commits but never
+# corrupts the file) and reads served from a memory map
+def connect(path,
+            synchronous=DEFAULT_SYNCHRONOUS,
+            mmap_size=DEFAULT_MMAP_SIZE,
+            **kwargs):
+    if synchronous.upper() not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Unknown synchronous mode {synchronous!r}")
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={synchronous.upper()}')
+    conn.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+    return conn
+
+
+# Open a read-only connection. It reads a consistent WAL snapshot and can
+# never take the write lock, so report queries do not contend with the
+# BatchWriter committing behind them.
+def connect_readonly(path, mmap_size=DEFAULT_MMAP_SIZE, **kwargs):
+    uri = f"file:{quote(os.path.abspath(path))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, **kwargs)
+    conn.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+    return conn
+
+
+# Connections to one SQLite database shared by the Flask request threads.
+# The schema is created once by setup() at startup. A request thread takes
+# a connection for the length of the request and gives it back after, so a
+# connection and its prepared statement cache outlive the short-lived
+# threads of the development server. Read-only connections ("replicas") are
+# pooled apart from the read-write ones. At most `pool_size` idle
+# connections of each kind are kept; a burst opens more and closes them
+# when done.
+class Database:
+
+    def __init__(self,
+                 path,
+                 schema=(),
+                 pool_size=DEFAULT_POOL_SIZE,
+                 cached_statements=DEFAULT_CACHED_STATEMENTS,
+                 synchronous=DEFAULT_SYNCHRONOUS,
+                 mmap_size=DEFAULT_MMAP_SIZE,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT,
+                 row_factory=None):
+        self.path = path
+        self.schema = list(schema)
+        self.pool_size = pool_size
+        self.cached_statements = cached_statements
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.row_factory = row_factory
+        self.schema_ready = False
+        # Most recently returned last, so the warmest connection is reused
+        self._idle = {False: [], True: []}
+        self._lock = threading.Lock()
+        self._opened = {
+            readonly: CONNECTIONS_OPENED.labels(path, mode)
+            for readonly, mode in ((False, 'rw'), (True, 'ro'))
+        }
+        self._idle_gauge = {
+            readonly: CONNECTIONS_IDLE.labels(path, mode)
+            for readonly, mode in ((False, 'rw'), (True, 'ro'))
+        }
+
+    # Apply the "sqlite" section of config.json. Idle connections are closed
+    # so new ones pick up the settings.
+    def configure(self, config):
+        settings = config.get('sqlite', {})
+        synchronous = settings.get('synchronous', self.synchronous)
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode {synchronous!r}")
+        self.synchronous = synchronous
+        self.pool_size = settings.get('pool_size', self.pool_size)
+        self.cached_statements = settings.get('cached_statements',
+                                              self.cached_statements)
+        self.mmap_size = settings.get('mmap_size', self.mmap_size)
+        self.busy_timeout = settings.get('busy_timeout', self.busy_timeout)
+        self.close()
+
+    # Create the schema; later calls do nothing
+    def setup(self):
+        with self._lock:
+            if self.schema_ready:
+                return
+            conn = self._open(False)
+            try:
+                for statement in self.schema:
+                    conn.execute(statement)
+                conn.commit()
+            finally:
+                conn.close()
+            self.schema_ready = True
+
+    def _open(self, readonly):
+        kwargs = {
+            'timeout': self.busy_timeout,
+            'cached_statements': self.cached_statements,
+            # Connections move between request threads, one at a time
+            'check_same_thread': False
+        }
+        if readonly:
+            conn = connect_readonly(self.path, self.mmap_size, **kwargs)
+        else:
+            conn = connect(self.path, self.synchronous, self.mmap_size,
+                           **kwargs)
+        if self.row_factory is not None:
+            conn.row_factory = self.row_factory
+        self._opened[readonly].inc()
+        return conn
+
+    # Take a connection for this thread's exclusive use until release()
+    def acquire(self, readonly=False):
+        if not self.schema_ready:
+            self.setup()
+        with self._lock:
+            idle = self._idle[readonly]
+            if idle:
+                conn = idle.pop()
+                self._idle_gauge[readonly].set(len(idle))
+                return conn
+        return self._open(readonly)
+
+    # Give a connection back. Uncommitted changes are rolled back, as
+    # closing it would have done.
+    def release(self, conn, readonly=False):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logging.error(f"Dropping connection to {self.path}: {e}")
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle[readonly]
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                self._idle_gauge[readonly].set(len(idle))
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self, readonly=False):
+        conn = self.acquire(readonly)
+        try:
+            yield conn
+        finally:
+            self.release(conn, readonly)
+
+    # Close every idle connection
+    def close(self):
+        with self._lock:
+            for readonly, idle in self._idle.items():
+                for conn in idle:
+                    conn.close()
+                idle.clear()
+                self._idle_gauge[readonly].set(0)
@@ -0,0 +1,264 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from db import (
+    DEFAULT_BUSY_TIMEOUT,
+    DEFAULT_MMAP_SIZE,
+    DEFAULT_SYNCHRONOUS,
+    SYNCHRONOUS_MODES,
+    connect,
+)
+from metrics import counter, histogram
+
+# Marker queued by flush() to wake the writer and signal completion
+_FLUSH = object()
+
+# Marker for rows queued by submit_many(), which commit or fail together
+_GROUP = object()
+
+COMMIT_SECONDS = histogram('sqlite_commit_seconds',
+                           "Time to write and commit one batch",
+                           ['database'])
+ROWS_WRITTEN = counter('sqlite_rows_written_total',
+                       "Rows committed by a BatchWriter", ['database'])
+COMMIT_FAILURES = counter('sqlite_batch_failures_total',
+                          "Batches that failed and were retried row by row",
+                          ['database'])
+
+
+# Ack a RabbitMQ delivery from any thread. BlockingConnection is not
+# thread-safe, so the ack is handed back to the connection's own thread.
+def threadsafe_ack(ch, delivery_tag):
+    ch.connection.add_callback_threadsafe(
+        lambda: ch.basic_ack(delivery_tag=delivery_tag))
+
+
+# Write-behind persistence shared by the consumer services. Rows are queued
+# by submit() and written by a background thread in one transaction per
+# `batch_size` rows or `flush_interval` seconds, whichever comes first.
+# Rows queued together by submit_many() are never split across batches.
+# Callbacks registered with after_commit() run once everything queued before
+# them is durable, which is where consumers ack their messages. A callback
+# covers the rows its own thread submitted since its previous callback; if
+# any of them was dropped, its failure callback runs instead. Queue items
+# are (sql, params, callback, thread) tuples.
+class BatchWriter:
+
+    def __init__(self,
+                 path,
+                 schema=(),
+                 batch_size=500,
+                 flush_interval=0.05,
+                 max_pending=10000,
+                 synchronous=DEFAULT_SYNCHRONOUS,
+                 mmap_size=DEFAULT_MMAP_SIZE,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        self.path = path
+        self.schema = list(schema)
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.batches_committed = 0
+        self._commit_seconds = COMMIT_SECONDS.labels(path)
+        self._rows_written = ROWS_WRITTEN.labels(path)
+        self._failures = COMMIT_FAILURES.labels(path)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._ready = threading.Event()
+        self._closed = False
+        self._error = None
+        self._conn = None
+        # Submitting threads with rows dropped since their last callback
+        self._dropped_by = set()
+        self._thread = threading.Thread(target=self._run,
+                                        name=f"BatchWriter({path})",
+                                        daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    # Queue a statement; blocks when `max_pending` rows are outstanding
+    def submit(self, sql, params=()):
+        if self._closed:
+            raise RuntimeError("BatchWriter is closed")
+        self._queue.put((sql, params, None, threading.get_ident()))
+
+    # Queue `sql` once per entry of `params_seq` as a single unit: the rows
+    # land in the same transaction, and a failing row drops all of them
+    def submit_many(self, sql, params_seq):
+        if self._closed:
+            raise RuntimeError("BatchWriter is closed")
+        rows = [(sql, params) for params in params_seq]
+        if rows:
+            self._queue.put((_GROUP, rows, None, threading.get_ident()))
+
+    # Run `callback` once every row this thread submitted so far has been
+    # committed, or `on_failure` (when given) if one of them was dropped
+    def after_commit(self, callback, on_failure=None):
+        if self._closed:
+            raise RuntimeError("BatchWriter is closed")
+        self._queue.put((None, on_failure, callback, threading.get_ident()))
+
+    # Commit everything queued so far and wait for it
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self._queue.put((_FLUSH, None, done.set, None))
+        return done.wait(timeout)
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _connect(self):
+        return connect(self.path,
+                       self.synchronous,
+                       self.mmap_size,
+                       timeout=self.busy_timeout,
+                       isolation_level=None)
+
+    def _run(self):
+        try:
+            self._conn = self._connect()
+            for statement in self.schema:
+                self._conn.execute(statement)
+        except sqlite3.Error as e:
+            logging.error(f"Error preparing database {self.path}: {e}")
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                stop = item[0] is _FLUSH
+                while not stop and len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(item)
+                    stop = item[0] is _FLUSH
+                self._commit(batch)
+        finally:
+            self._conn.close()
+
+    def _commit(self, batch):
+        # Rows of the batch as units of (position, [(sql, params), ...])
+        units = [
+            (position, params if sql is _GROUP else [(sql, params)])
+            for position, (sql, params, _, _) in enumerate(batch)
+            if sql is not None and sql is not _FLUSH
+        ]
+        rows = [row for _, unit in units for row in unit]
+        dropped = set()
+        started = time.perf_counter()
+        try:
+            self._conn.execute('BEGIN')
+            for sql, params in rows:
+                self._conn.execute(sql, params)
+            self._conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            self._rollback()
+            self._failures.inc()
+            logging.error(f"Batch of {len(rows)} rows failed ({e}), "
+                          f"retrying row by row")
+            rows = self._commit_each(units, dropped)
+        self._commit_seconds.observe(time.perf_counter() - started)
+        self._rows_written.inc(len(rows))
+        self.rows_written += len(rows)
+        self.batches_committed += 1
+        for position, (sql, on_failure, callback, owner) in enumerate(batch):
+            if position in dropped:
+                self._dropped_by.add(owner)
+            if callback is None:
+                continue
+            if sql is None and owner in self._dropped_by:
+                self._dropped_by.discard(owner)
+                if on_failure is None:
+                    logging.error("Skipping after-commit callback: rows "
+                                  "submitted before it were dropped")
+                    continue
+                callback = on_failure
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Error in after-commit callback: {e}")
+
+    # Fallback for a failed batch so one bad row does not drop the others.
+    # Each unit is a single row or a submit_many() group, committed alone;
+    # the batch positions of dropped units are added to `dropped`.
+    def _commit_each(self, units, dropped):
+        written = []
+        for position, unit in units:
+            try:
+                self._conn.execute('BEGIN')
+                for sql, params in unit:
+                    self._conn.execute(sql, params)
+                self._conn.execute('COMMIT')
+                written.extend(unit)
+            except sqlite3.Error as e:
+                self._rollback()
+                dropped.add(position)
+                logging.error(f"Dropping {len(unit)} row(s), first "
+                              f"{unit[0][1]}: {e}")
+        return written
+
+    # Roll back the open transaction. When that fails too the connection
+    # is in an unknown state, so it is replaced by a new one; the writer
+    # thread keeps retrying rather than exit and leave submit() blocked.
+    def _rollback(self):
+        if not self._conn.in_transaction:
+            return
+        try:
+            self._conn.execute('ROLLBACK')
+            return
+        except sqlite3.Error as e:
+            logging.error(f"Rollback on {self.path} failed ({e}), "
+                          f"reopening the connection")
+        try:
+            self._conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error closing {self.path}: {e}")
+        while True:
+            try:
+                self._conn = self._connect()
+                return
+            except sqlite3.Error as e:
+                logging.error(f"Reopening {self.path} failed: {e}")
+                time.sleep(self.flush_interval)
+
+
+# Build a writer using the pragmas of the "sqlite" section of config.json,
+# the same settings Database.configure() applies to the request pools
+def writer_from_config(path, config, schema=()):
+    settings = config.get('sqlite', {})
+    synchronous = settings.get('synchronous', DEFAULT_SYNCHRONOUS)
+    if synchronous.upper() not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Unknown synchronous mode {synchronous!r}")
+    return BatchWriter(path,
+                       schema=schema,
+                       synchronous=synchronous,
+                       mmap_size=settings.get('mmap_size', DEFAULT_MMAP_SIZE),
+                       busy_timeout=settings.get('busy_timeout',
+                                                 DEFAULT_BUSY_TIMEOUT))
@@ -0,0 +1,171 @@
+import json
+import logging
+import threading
+import zlib
+
+from metrics import counter, histogram
+
+# Room every client joins until it reports the region it is viewing
+ALL_REGIONS_ROOM = 'region:all'
+
+DEFAULT_WINDOW_SECONDS = 0.1
+DEFAULT_REGION_SIZE = (5, 5)
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+UPDATES = counter('movement_updates_total',
+                  "Movement updates received by the coalescer")
+BATCHES = counter('movement_batches_total',
+                  "Movement batches emitted to Socket.IO rooms")
+FLUSH_SECONDS = histogram('movement_flush_seconds',
+                          "Time to encode and emit one window of batches")
+
+
+# Room of the clients viewing the rectangle of regions (rx0, ry0) to
+# (rx1, ry1) inclusive
+def view_room(rx0, ry0, rx1, ry1):
+    return f"region:{rx0}:{ry0}:{rx1}:{ry1}"
+
+
+# Collects movement updates and emits them as one batch per client per
+# window instead of one Socket.IO emit per message. Messages are decoded by
+# messages.decode, so locations are (x, y) tuples. Each update is buffered
+# once, under the map region it falls in. A client is in ALL_REGIONS_ROOM,
+# which gets every update, or in the room of the regions it views, which
+# gets the slices of those regions in a single batch. Within a batch the
+# updates of a region keep their order. Batches are columnar
+# ({"users", "locations", "turns"}) and, above `compress_threshold` bytes,
+# sent deflated as {"encoding": "deflate", "data": <bytes>}.
+class EmitCoalescer:
+
+    def __init__(self,
+                 socketio,
+                 event='movement_batch',
+                 window_seconds=DEFAULT_WINDOW_SECONDS,
+                 region_size=DEFAULT_REGION_SIZE,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        self.socketio = socketio
+        self.event = event
+        self.window_seconds = window_seconds
+        self.region_width, self.region_height = region_size
+        self.compress_threshold = compress_threshold
+        self.updates_received = 0
+        self.batches_emitted = 0
+        # Buffered updates per (rx, ry) region, None for no location
+        self._buffers = {}
+        # Joined view rooms: clients in the room and the regions it covers
+        self._viewers = {}
+        self._view_regions = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    # Room of the regions covering the cells from (x0, y0) to (x1, y1)
+    # inclusive
+    def room_for_view(self, x0, y0, x1, y1):
+        return view_room(x0 // self.region_width, y0 // self.region_height,
+                         x1 // self.region_width, y1 // self.region_height)
+
+    # Count a client joining or leaving a room from room_for_view(); rooms
+    # without clients are not sent anything
+    def join_view(self, room):
+        rx0, ry0, rx1, ry1 = (int(part) for part in room.split(':')[1:])
+        with self._lock:
+            self._viewers[room] = self._viewers.get(room, 0) + 1
+            self._view_regions[room] = [(rx, ry)
+                                        for ry in range(ry0, ry1 + 1)
+                                        for rx in range(rx0, rx1 + 1)]
+
+    def leave_view(self, room):
+        with self._lock:
+            if room not in self._viewers:
+                return
+            self._viewers[room] -= 1
+            if not self._viewers[room]:
+                del self._viewers[room]
+                del self._view_regions[room]
+
+    def _region_for(self, message):
+        try:
+            x, y = message['location']
+        except (KeyError, TypeError, ValueError):
+            return None
+        return x // self.region_width, y // self.region_height
+
+    def add(self, message):
+        entry = (message.get('user'), message.get('location'),
+                 message.get('turn'))
+        region = self._region_for(message)
+        UPDATES.inc()
+        with self._lock:
+            self.updates_received += 1
+            self._buffers.setdefault(region, []).append(entry)
+
+    def encode(self, entries):
+        payload = {
+            "users": [user for user, _, _ in entries],
+            "locations": [location for _, location, _ in entries],
+            "turns": [turn for _, _, turn in entries],
+        }
+        if not self.compress_threshold:
+            return payload
+        raw = json.dumps(payload, separators=(',', ':')).encode()
+        if len(raw) < self.compress_threshold:
+            return payload
+        return {"encoding": "deflate", "data": zlib.compress(raw)}
+
+    # Emit everything buffered so far, one batch per room with updates
+    def flush(self):
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+            views = list(self._view_regions.items())
+        if not buffers:
+            return
+        batches = [(ALL_REGIONS_ROOM, [
+            entry for entries in buffers.values() for entry in entries
+        ])]
+        for room, regions in views:
+            entries = [
+                entry for region in regions
+                for entry in buffers.get(region, ())
+            ]
+            if entries:
+                batches.append((room, entries))
+        with FLUSH_SECONDS.time():
+            for room, entries in batches:
+                self.socketio.emit(self.event, self.encode(entries), to=room)
+                self.batches_emitted += 1
+        BATCHES.inc(len(batches))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "updates_received": self.updates_received,
+                "batches_emitted": self.batches_emitted,
+                "buffered_regions": len(self._buffers),
+                "view_rooms": len(self._viewers),
+            }
+
+    # Flush every `window_seconds` on a Socket.IO background task
+    def start(self):
+        if self._started or not self.window_seconds:
+            return
+        self._started = True
+        self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.window_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing movement batch: {e}")
+
+
+# Build a coalescer from the "movement_broadcast" section of config.json
+def coalescer_from_config(socketio, config):
+    settings = config.get('movement_broadcast', {})
+    return EmitCoalescer(
+        socketio,
+        window_seconds=settings.get('window_seconds', DEFAULT_WINDOW_SECONDS),
+        region_size=tuple(settings.get('region_size', DEFAULT_REGION_SIZE)),
+        compress_threshold=settings.get('compress_threshold',
+                                        DEFAULT_COMPRESS_THRESHOLD))
@@ -0,0 +1,157 @@
+import json
+import logging
+import random
+from functools import lru_cache
+
+# Terrain codes, one byte per cell
+OPEN = 0
+WALL = 1
+OBSTACLE = 2
+
+TERRAIN_CODES = {' ': OPEN, '/': WALL, 'H': OBSTACLE}
+TERRAIN_SYMBOLS = {code: symbol for symbol, code in TERRAIN_CODES.items()}
+
+# Cells a user cannot move onto
+BLOCKING_CODES = frozenset([OBSTACLE])
+
+# Position offsets for each move direction
+DIRECTIONS = {'N': (0, -1), 'S': (0, 1), 'E': (1, 0), 'W': (-1, 0)}
+DIRECTION_DX = {direction: dx for direction, (dx, _) in DIRECTIONS.items()}
+DIRECTION_DY = {direction: dy for direction, (_, dy) in DIRECTIONS.items()}
+
+
+# Static map layout shared by the services. Terrain is a row-major bytearray
+# of uint8 codes with a parallel 0/1 obstacle mask, so checks are single
+# index lookups and the grid can be handed out or sent as-is through the
+# buffer protocol (see `buffer()` / `from_buffer()`).
+class GameMap:
+
+    def __init__(self, width, height, cells):
+        if len(cells) != width * height:
+            raise ValueError(f"Expected {width * height} cells, "
+                             f"got {len(cells)}")
+        self.width = width
+        self.height = height
+        self.cells = bytearray(cells)
+        self.obstacle_mask = bytearray(
+            1 if code in BLOCKING_CODES else 0 for code in self.cells)
+        self._open_cells = [
+            i for i, code in enumerate(self.cells) if code == OPEN
+        ]
+
+    @classmethod
+    def from_layout(cls, layout):
+        height = len(layout)
+        width = len(layout[0]) if height else 0
+        cells = bytearray()
+        for y, row in enumerate(layout):
+            if len(row) != width:
+                raise ValueError(f"Map row {y} has {len(row)} cells, "
+                                 f"expected {width}")
+            for symbol in row:
+                if symbol not in TERRAIN_CODES:
+                    raise ValueError(f"Unknown map symbol: {symbol!r}")
+                cells.append(TERRAIN_CODES[symbol])
+        return cls(width, height, cells)
+
+    @classmethod
+    def from_config(cls, config):
+        game_map = cls.from_layout(config['map_layout'])
+        map_size = config.get('map_size')
+        if map_size and tuple(map_size) != game_map.size:
+            logging.warning(f"map_size {map_size} does not match the "
+                            f"{game_map.size} map_layout; using the layout")
+        return game_map
+
+    # Rebuild a map from bytes produced by buffer(), without re-parsing
+    @classmethod
+    def from_buffer(cls, width, height, buffer):
+        return cls(width, height, buffer)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    # Zero-copy view of the terrain codes
+    def buffer(self):
+        return memoryview(self.cells)
+
+    def __bytes__(self):
+        return bytes(self.cells)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def cell(self, x, y):
+        return TERRAIN_SYMBOLS[self.cells[y * self.width + x]]
+
+    def is_obstacle(self, x, y):
+        return self.obstacle_mask[y * self.width + x] == 1
+
+    def is_open(self, x, y):
+        return self.cells[y * self.width + x] == OPEN
+
+    # Whether a user may stand on (x, y)
+    def can_enter(self, x, y):
+        return (0 <= x < self.width and 0 <= y < self.height
+                and not self.obstacle_mask[y * self.width + x])
+
+    # Target of a move; unknown directions leave the position unchanged
+    @staticmethod
+    def step(x, y, direction):
+        dx, dy = DIRECTIONS.get(direction, (0, 0))
+        return x + dx, y + dy
+
+    # Check many positions at once; returns a bytearray of 1 (valid) / 0.
+    # This is a convenience over can_enter(), not a vectorized kernel: one
+    # comprehension with the attribute lookups hoisted measured faster than
+    # gathering from a precomputed mask with map() / itemgetter().
+    def check_positions(self, xs, ys):
+        width, height, mask = self.width, self.height, self.obstacle_mask
+        return bytearray([
+            1 if 0 <= x < width and 0 <= y < height
+            and not mask[y * width + x] else 0
+            for x, y in zip(xs, ys, strict=True)
+        ])
+
+    # Resolve a batch of moves from `positions` [(x, y), ...] in the given
+    # `directions`; returns [(new_x, new_y, valid), ...]
+    def check_moves(self, positions, directions):
+        dx, dy = DIRECTION_DX.get, DIRECTION_DY.get
+        moves = list(zip(positions, directions, strict=True))
+        xs = [x + dx(direction, 0) for (x, _), direction in moves]
+        ys = [y + dy(direction, 0) for (_, y), direction in moves]
+        valid = map(bool, self.check_positions(xs, ys))
+        return list(zip(xs, ys, valid, strict=True))
+
+    # Random open (spawnable) cell
+    def random_open_cell(self, rng=random):
+        if not self._open_cells:
+            raise ValueError("Map has no open cells")
+        index = rng.choice(self._open_cells)
+        return index % self.width, index // self.width
+
+    # Layout as a list of rows of single-character strings
+    def rows(self):
+        symbols = TERRAIN_SYMBOLS
+        return [[
+            symbols[code]
+            for code in self.cells[y * self.width:(y + 1) * self.width]
+        ] for y in range(self.height)]
+
+
+# Value shown on a map cell after `user` moves onto it: the user on an
+# open cell, X where several users met, terrain otherwise
+def update_map_cell(value, user):
+    if value == ' ':
+        return str(user)
+    elif isinstance(value, str) and value.isdigit():
+        return 'X'
+    return value
+
+
+# Map from config.json, parsed once per process
+@lru_cache(maxsize=None)
+def load_game_map(path='config.json'):
+    with open(path) as f:
+        return GameMap.from_config(json.load(f))
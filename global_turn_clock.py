@@ -1,9 +1,24 @@
 import json
 import logging
-import time
 
-import pika
-import pika.exceptions
+from channel_pool import log_failure, pool_from_config
+from messages import (
+    JSON_CODEC,
+    codec_from_config,
+    message_properties,
+    turn_message,
+)
+from metrics import counter, histogram
+from topology import TURNS_EXCHANGE, topology_from_config
+from turn_scheduler import scheduler_from_config
+
+# Seconds between summary log lines; single turns are logged at debug level
+# since the clock may run at 100 turns per second
+SUMMARY_INTERVAL = 10.0
+
+TURNS = counter('turns_broadcast_total', "Turn updates published")
+TURN_LATENESS = histogram('turn_lateness_seconds',
+                          "Time between a turn's deadline and its broadcast")
 
 
 # Load the configuration file
@@ -24,60 +39,61 @@ def setup_logging():
     logging.basicConfig(level=logging.INFO)
 
 
-# Establish RabbitMQ connection
+# Publisher pool with confirms; it reconnects on its own if RabbitMQ drops
 def setup_rabbitmq(config):
-    try:
-        rabbitmq_address = config.get("rabbitmq_address")
-        connection = pika.BlockingConnection(
-            pika.URLParameters(rabbitmq_address))
-        channel = connection.channel()
-
-        # Declare turn_updates queue with durability to ensure persistence
-        channel.queue_declare(queue='turn_updates', durable=True)
-        return connection, channel
-    except pika.exceptions.AMQPConnectionError as e:
-        logging.error(f"Error connecting to RabbitMQ: {e}")
-        exit(1)
+    # Declare the durable exchanges and every service's queue, so turns are
+    # kept for services that start later
+    return pool_from_config(
+        config, declarations=topology_from_config(config).declarations())
 
 
-# Broadcast the turn update to RabbitMQ
-def broadcast_turn(channel, turn):
+# Broadcast the turn update to every service through the turns fanout
+# exchange; the broker's confirm is awaited in the background so a slow
+# confirm does not delay the next turn. `epoch` is the turn's scheduled
+# start in seconds since the Unix epoch.
+def broadcast_turn(publisher, turn, codec=JSON_CODEC, epoch=None):
+    message = turn_message(turn) if epoch is None else turn_message(
+        turn, epoch=epoch)
     try:
-        message = json.dumps({"action": "turn_update", "turn": turn})
-        channel.basic_publish(
-            exchange='',
-            routing_key='turn_updates',
-            body=message,
-            properties=pika.BasicProperties(
-                delivery_mode=2  # Make message persistent
-            ))
-        logging.info(f"Turn {turn} broadcasted")
-    except pika.exceptions.AMQPError as e:
-        logging.error(f"Error broadcasting turn {turn}: {e}")
-        raise
+        publisher.publish(
+            '',
+            codec.encode(message),
+            exchange=TURNS_EXCHANGE,
+            properties=message_properties(codec)  # Persistent message
+        ).add_done_callback(log_failure)
+    except TimeoutError as e:
+        # The clock keeps ticking; this turn is not broadcast
+        logging.error(f"Turn {turn} not broadcast: {e}")
+        return
+    logging.debug(f"Turn {turn} broadcasted")
 
 
 # Main function to run the global turn clock
 def main():
     setup_logging()
     config = load_config()
-    turn_duration = config.get("turn_duration", 1.0)
-    connection, channel = setup_rabbitmq(config)
+    codec = codec_from_config(config)
+    publisher = setup_rabbitmq(config)
+    scheduler = scheduler_from_config(config)
+    summary_every = max(1, round(SUMMARY_INTERVAL / scheduler.period))
+
+    # Turns start on absolute deadlines, so publish time does not add drift
+    def tick(turn, deadline):
+        TURN_LATENESS.observe(max(0.0, scheduler.clock() - deadline))
+        TURNS.inc()
+        broadcast_turn(publisher, turn, codec, scheduler.wall_time(deadline))
+        if turn % summary_every == 0:
+            logging.info(f"Turn {turn} broadcasted; {scheduler.stats()}")
 
-    turn = 0
     try:
-        while True:
-            broadcast_turn(channel, turn)
-            turn += 1
-            time.sleep(turn_duration)
+        scheduler.run(tick)
     except KeyboardInterrupt:
         logging.info("Turn clock stopped by user.")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
     finally:
-        if connection:
-            connection.close()
-            logging.info("RabbitMQ connection closed.")
+        publisher.close()
+        logging.info("RabbitMQ connection closed.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import threading
+from array import array
+from collections import namedtuple
+
+from game_map import GameMap
+
+# A detected intersection. `location` is the (x, y) cell the users share;
+# for near misses `near` holds the second cell, otherwise it is None.
+Intersection = namedtuple('Intersection', ['users', 'location', 'near'])
+
+
+# Positions reported during a single turn, stored as two parallel int arrays
+# (interned user id and flat cell index) instead of per-location lists.
+class TurnPositions:
+
+    def __init__(self):
+        self.users = array('i')
+        self.cells = array('i')
+
+    def __len__(self):
+        return len(self.cells)
+
+
+# Spatial-hash intersection engine backed by a flat grid of `width * height`
+# cells. Each turn is resolved in a single pass over its positions: entries
+# are chained per cell through the `_head` / `chain` arrays, so same-cell
+# matches and neighbours within `radius` are found without comparing every
+# pair of users. Turns are resolved in order: detect() moves a watermark up
+# to the turn it resolves, drops older turns never resolved, and positions
+# added later for a turn at or below the watermark are counted in `late`
+# and dropped. All methods are safe to call from multiple threads.
+class IntersectionEngine:
+
+    def __init__(self, width, height, radius=0):
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid map size: {width}x{height}")
+        if radius < 0:
+            raise ValueError(f"Invalid proximity radius: {radius}")
+        self.width = width
+        self.height = height
+        self.radius = radius
+        self._head = array('i', [-1]) * (width * height)
+        self._user_ids = {}
+        self._user_names = []
+        self._turns = {}
+        self._resolved = None
+        self.late = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._offsets = self._neighbour_offsets(radius)
+
+    # Cell offsets within `radius` (euclidean), limited to the half-plane that
+    # follows the origin cell so every neighbouring pair is visited once
+    @staticmethod
+    def _neighbour_offsets(radius):
+        r = int(radius)
+        offsets = []
+        for dy in range(0, r + 1):
+            for dx in range(-r, r + 1):
+                if dy == 0 and dx <= 0:
+                    continue
+                if dx * dx + dy * dy <= radius * radius:
+                    offsets.append((dx, dy))
+        return offsets
+
+    def _intern(self, user):
+        user_id = self._user_ids.get(user)
+        if user_id is None:
+            user_id = len(self._user_names)
+            self._user_ids[user] = user_id
+            self._user_names.append(user)
+        return user_id
+
+    # Record a user's position for a turn
+    def add(self, turn, user, x, y):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise ValueError(f"Location {x},{y} is outside the map")
+        with self._lock:
+            if self._resolved is not None and turn <= self._resolved:
+                self.late += 1
+                return
+            positions = self._turns.get(turn)
+            if positions is None:
+                positions = self._turns[turn] = TurnPositions()
+            positions.users.append(self._intern(user))
+            positions.cells.append(y * self.width + x)
+
+    # A single engine covers the whole map; shards own only their tiles
+    def owns(self, _x, _y):
+        return True
+
+    # Number of positions buffered for a turn
+    def pending(self, turn):
+        with self._lock:
+            positions = self._turns.get(turn)
+            return len(positions) if positions is not None else 0
+
+    # Drop a turn's positions without resolving it
+    def discard(self, turn):
+        with self._lock:
+            self._turns.pop(turn, None)
+
+    # Clear the watermark for a restarted turn clock, which numbers turns
+    # from 0 again. Turns buffered above the watermark are left over from
+    # the old clock and dropped; lower ones already belong to the new one.
+    def reset(self):
+        with self._lock:
+            if self._resolved is not None:
+                for turn in [t for t in self._turns if t > self._resolved]:
+                    self.dropped += len(self._turns.pop(turn))
+            self._resolved = None
+
+    # Resolve and release a turn, returning its intersections ordered by
+    # cell. Older turns still buffered are dropped; a turn at or below the
+    # watermark has nothing left to resolve.
+    def detect(self, turn):
+        with self._lock:
+            if self._resolved is not None and turn <= self._resolved:
+                return []
+            self._resolved = turn
+            for older in [t for t in self._turns if t < turn]:
+                self.dropped += len(self._turns.pop(older))
+            positions = self._turns.pop(turn, None)
+            if not positions:
+                return []
+            return self._resolve(positions)
+
+    def _resolve(self, positions):
+        head = self._head
+        users = positions.users
+        cells = positions.cells
+        chain = array('i', [-1]) * len(cells)
+        occupied = []
+
+        # Single pass: chain every entry onto its cell
+        for i, cell in enumerate(cells):
+            if head[cell] == -1:
+                occupied.append(cell)
+            chain[i] = head[cell]
+            head[cell] = i
+
+        # Distinct users in a cell, in arrival order
+        def cell_users(cell):
+            stack = []
+            i = head[cell]
+            while i != -1:
+                stack.append(users[i])
+                i = chain[i]
+            found = []
+            for user_id in reversed(stack):
+                if user_id not in found:
+                    found.append(user_id)
+            return found
+
+        results = []
+        try:
+            occupied.sort()
+            width, height = self.width, self.height
+            names = self._user_names
+            for cell in occupied:
+                here = cell_users(cell)
+                x, y = cell % width, cell // width
+                if len(here) > 1:
+                    results.append(
+                        Intersection(tuple(names[u] for u in here), (x, y),
+                                     None))
+                for dx, dy in self._offsets:
+                    nx, ny = x + dx, y + dy
+                    if not (0 <= nx < width and 0 <= ny < height):
+                        continue
+                    other = ny * width + nx
+                    if head[other] == -1:
+                        continue
+                    there = cell_users(other)
+                    for a in here:
+                        for b in there:
+                            if a != b:
+                                results.append(
+                                    Intersection((names[a], names[b]),
+                                                 (x, y), (nx, ny)))
+        finally:
+            # Only the touched cells need resetting for the next turn
+            for cell in occupied:
+                head[cell] = -1
+        return results
+
+
+# Build an engine sized to the configured map
+def engine_from_config(config):
+    width, height = GameMap.from_config(config).size
+    return IntersectionEngine(width, height,
+                              radius=config.get('intersection_radius', 0))
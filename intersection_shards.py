@@ -0,0 +1,111 @@
+from game_map import GameMap
+from intersection_engine import IntersectionEngine
+
+DEFAULT_TILE_SIZE = (5, 5)
+
+
+# Partition of the map into tiles shared out among `workers` shards. Tiles
+# are the topology's map regions, so a shard's movements can be selected by
+# routing key. Tiles are dealt round-robin in row-major order.
+#
+# Every shard also receives the halo around its tiles: the cells within the
+# intersection radius of a cell it owns. An intersection belongs to the shard
+# owning its `location` cell, and any `near` cell is within the radius of it,
+# so each shard sees every position its intersections involve, and the
+# union of the shards' output equals the single-engine output.
+class ShardLayout:
+
+    def __init__(self, width, height, workers, tile_size=DEFAULT_TILE_SIZE,
+                 radius=0):
+        if workers < 1:
+            raise ValueError(f"Invalid number of shard workers: {workers}")
+        self.width = width
+        self.height = height
+        self.workers = workers
+        self.tile_width, self.tile_height = tile_size
+        self.radius = radius
+        self.tiles_x = -(-width // self.tile_width)
+        self.tiles_y = -(-height // self.tile_height)
+
+    def tile_of(self, x, y):
+        return x // self.tile_width, y // self.tile_height
+
+    def tile_owner(self, tx, ty):
+        return (ty * self.tiles_x + tx) % self.workers
+
+    # Shard owning cell (x, y)
+    def owner(self, x, y):
+        return self.tile_owner(*self.tile_of(x, y))
+
+    def tiles(self, worker):
+        return [(tx, ty) for ty in range(self.tiles_y)
+                for tx in range(self.tiles_x)
+                if self.tile_owner(tx, ty) == worker]
+
+    # Flat width * height mask of the cells a shard needs: its own cells
+    # plus the halo within `radius` of them
+    def cell_mask(self, worker):
+        reach = int(self.radius)
+        mask = bytearray(self.width * self.height)
+        for tx, ty in self.tiles(worker):
+            x0 = max(0, tx * self.tile_width - reach)
+            x1 = min(self.width, (tx + 1) * self.tile_width + reach)
+            for y in range(max(0, ty * self.tile_height - reach),
+                           min(self.height,
+                               (ty + 1) * self.tile_height + reach)):
+                mask[y * self.width + x0:y * self.width + x1] = (
+                    b'\x01' * (x1 - x0))
+        return mask
+
+    # Tiles a shard must subscribe to: its own and those its halo reaches
+    def tiles_needed(self, worker):
+        mask = self.cell_mask(worker)
+        return sorted({
+            self.tile_of(cell % self.width, cell // self.width)
+            for cell, needed in enumerate(mask) if needed
+        }, key=lambda tile: (tile[1], tile[0]))
+
+
+# One shard of the intersection detector: an engine fed only with the
+# positions in the shard's tiles and halo, reporting only the intersections
+# located in its own tiles
+class IntersectionShard:
+
+    def __init__(self, layout, worker):
+        self.layout = layout
+        self.worker = worker
+        self.engine = IntersectionEngine(layout.width, layout.height,
+                                         layout.radius)
+        self._mask = layout.cell_mask(worker)
+
+    # Whether a position at (x, y) is needed by this shard
+    def accepts(self, x, y):
+        return (0 <= x < self.layout.width and 0 <= y < self.layout.height
+                and self._mask[y * self.layout.width + x] == 1)
+
+    def owns(self, x, y):
+        return self.layout.owner(x, y) == self.worker
+
+    # Record a position if it is in the shard's tiles or halo
+    def add(self, turn, user, x, y):
+        if self.accepts(x, y):
+            self.engine.add(turn, user, x, y)
+
+    def reset(self):
+        self.engine.reset()
+
+    def detect(self, turn):
+        return [
+            hit for hit in self.engine.detect(turn) if self.owns(*hit.location)
+        ]
+
+
+# Shard layout for the "intersection_shards" section of config.json. Tiles
+# follow the topology's region size so each tile has its own routing key.
+def layout_from_config(config):
+    width, height = GameMap.from_config(config).size
+    settings = config.get('intersection_shards', {})
+    tile_size = config.get('topology', {}).get('region_size',
+                                               DEFAULT_TILE_SIZE)
+    return ShardLayout(width, height, settings.get('workers', 1),
+                       tuple(tile_size), config.get('intersection_radius', 0))
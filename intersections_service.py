@@ -1,11 +1,29 @@
+import argparse
+import asyncio
 import json
 import logging
-import sqlite3
-from collections import defaultdict
+import multiprocessing
 from datetime import datetime
 import pika
 import pika.exceptions
 
+from async_runtime import (connect_from_config, prefetch_from_config,
+                           use_asyncio)
+from consumer import consume_forever, create_consumer
+from db import connect
+from db_writer import writer_from_config
+from intersection_engine import engine_from_config
+from intersection_shards import IntersectionShard, layout_from_config
+from memory_broker import blocking_connection
+from messages import decode, format_location, is_clock_restart, turn_lag
+from metrics import LogSampler, counter
+from topology import (MOVEMENT_QUEUES, TURN_QUEUES, shard_movement_queue,
+                      shard_turn_queue, topology_from_config)
+
+# This service's own copies of the movement and turn streams
+MOVEMENTS_QUEUE = MOVEMENT_QUEUES['intersections']
+TURNS_QUEUE = TURN_QUEUES['intersections']
+
 
 # Load configuration from config.json
 def load_config():
@@ -23,16 +41,19 @@ def load_config():
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
+# Intersections are logged by sample; all of them are counted
+log_sampler = LogSampler()
+INTERSECTIONS = counter('intersections_recorded_total',
+                        "Intersections queued for the database")
+
 
 # Initialize RabbitMQ connection
-def setup_rabbitmq():
-    config = load_config()
+def setup_rabbitmq(config=None):
+    config = config or load_config()
     try:
-        connection = pika.BlockingConnection(
-            pika.URLParameters(config['rabbitmq_address']))
+        connection = blocking_connection(config['rabbitmq_address'])
         channel = connection.channel()
-        channel.queue_declare(queue='movement_updates', durable=True)
-        channel.queue_declare(queue='turn_updates', durable=True)
+        topology_from_config(config).declare(channel)
         logging.info("RabbitMQ connection established.")
         return connection, channel
     except pika.exceptions.AMQPConnectionError as e:
@@ -40,176 +61,345 @@ def setup_rabbitmq():
         exit(1)
 
 
+# Database schema. Dedup is enforced by unique indexes so redelivered
+# messages can be written with INSERT OR IGNORE. Movements are keyed on the
+# turn and timestamp the message carries, so a redelivery processed later
+# still collides with the first delivery. Intersections are keyed on
+# their turn, not the wall-clock second, so the same pair meeting in the
+# same cell on two sub-second turns is recorded twice. Rows written before
+# the turn column existed have a NULL turn and never collide.
+DATABASE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT,
+        location TEXT,
+        turn INTEGER,
+        timestamp TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS intersections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        users TEXT,
+        location TEXT,
+        turn INTEGER,
+        timestamp TEXT
+    )
+    ''',
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS movements_message_dedup
+    ON movements (user, location, IFNULL(turn, -1), IFNULL(timestamp, ''))
+    ''',
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS intersections_turn_dedup
+    ON intersections (users, location, turn)
+    ''',
+]
+
+
+# Add the turn column to an intersections table created without it, and
+# drop dedup indexes keyed on values taken at processing time
+def migrate_database(path):
+    conn = connect(path)
+    try:
+        columns = [
+            row[1] for row in conn.execute('PRAGMA table_info(intersections)')
+        ]
+        if columns and 'turn' not in columns:
+            conn.execute('ALTER TABLE intersections ADD COLUMN turn INTEGER')
+        conn.execute('DROP INDEX IF EXISTS intersections_dedup')
+        conn.execute('DROP INDEX IF EXISTS movements_dedup')
+        conn.commit()
+    finally:
+        conn.close()
+
+
 # Database setup
-def setup_database():
-    conn = sqlite3.connect(
-        'local_database.db')  # Each microservice should have its own database
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS movements (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT,
-            location TEXT,
-            turn INTEGER,
-            timestamp TEXT
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS intersections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            users TEXT,
-            location TEXT,
-            timestamp TEXT
-        )
-    ''')
-    conn.commit()
+def setup_database(config):
+    # Each microservice should have its own database
+    migrate_database('local_database.db')
+    writer = writer_from_config('local_database.db',
+                                config,
+                                schema=DATABASE_SCHEMA)
     logging.info("Database setup complete.")
-    return conn
-
+    return writer
 
-# Insert movement into database if not exists
-def insert_movement_if_not_exists(user, location, turn, timestamp, conn):
-    cursor = conn.cursor()
-    # Check if the timestamp already exists
-    cursor.execute('SELECT COUNT(*) FROM movements WHERE timestamp = ?',
-                   (timestamp, ))
-    exists = cursor.fetchone()[0]
 
-    if exists == 0:  # Only insert if it doesn't exist
-        cursor.execute(
-            'INSERT INTO movements (user, location, turn, timestamp) VALUES (?, ?, ?, ?)',
-            (user, location, turn, timestamp))
-        conn.commit()
-        logging.info(
-            f"Inserted new movement into database: {user}, {location}, {turn}, {timestamp}"
-        )
-    else:
-        logging.info(
-            f"Movement already exists in database for timestamp: {timestamp}")
+# Queue a movement for insertion; duplicates are ignored by the unique index
+def insert_movement_if_not_exists(user, location, turn, timestamp, writer):
+    writer.submit(
+        'INSERT OR IGNORE INTO movements (user, location, turn, timestamp) '
+        'VALUES (?, ?, ?, ?)', (user, location, turn, timestamp))
 
 
-# Insert intersection into database
-def insert_intersection(users, location, timestamp, conn):
-    cursor = conn.cursor()
+# Queue an intersection for insertion; a redelivered turn update is ignored
+# by the unique index
+def insert_intersection(users, location, turn, timestamp, writer):
     users_str = ', '.join(users)
-    cursor.execute(
-        'INSERT INTO intersections (users, location, timestamp) VALUES (?, ?, ?)',
-        (users_str, location, timestamp))
-    conn.commit()
-    logging.info(
-        f"Inserted intersection into database: {users_str}, {location}, {timestamp}"
-    )
+    writer.submit(
+        'INSERT OR IGNORE INTO intersections (users, location, turn, '
+        'timestamp) VALUES (?, ?, ?, ?)',
+        (users_str, location, turn, timestamp))
 
 
-# Storage for tracking user positions by turn
-user_positions_by_turn = defaultdict(lambda: defaultdict(list))
+# Format an engine hit as the location string stored in the database;
+# near misses record both cells as "x1,y1;x2,y2"
+def format_intersection_location(hit):
+    location = format_location(hit.location)
+    if hit.near is not None:
+        location += f";{format_location(hit.near)}"
+    return location
 
 
 # Record intersections in the database
-def record_intersection(users, location, timestamp, conn):
-    logging.info(
-        f"Intersection detected between users {users} at location {location} "
-        f"on {timestamp}")
-    insert_intersection(users, location, timestamp, conn)
-
-
-# Callback function for processing movement messages
-def on_movement_message(ch, method, _, body,
-                        conn):  # `_` marks `properties` as unused
+def record_intersection(users, location, turn, timestamp, writer):
+    log_sampler.log(
+        'intersection',
+        "Intersection detected between users %s at location %s on %s", users,
+        location, timestamp)
+    INTERSECTIONS.inc()
+    insert_intersection(users, location, turn, timestamp, writer)
+
+
+# Turn of movements that do not carry one (moves from movement_service):
+# the turn after the last turn update received
+open_turn = 0
+# (turn, epoch) of the latest turn update, to notice a restarted turn clock
+latest_turn = None
+
+# Movements and turn updates come from separate queues, consumed
+# concurrently, so a turn update may be handled before the last movements
+# of its turn. A turn is resolved only after this many further turn updates,
+# set by "intersection_resolve_delay" in config.json.
+DEFAULT_RESOLVE_DELAY = 1
+resolve_delay = DEFAULT_RESOLVE_DELAY
+
+
+# Time a movement was published, as stored in the database; None for
+# messages without a timestamp
+def message_time(message):
+    timestamp = message.get('timestamp')
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Process a single movement message; errors are logged and the message is
+# still acknowledged with the rest of its batch
+def on_movement_message(body, writer, engine, properties=None):
     try:
-        message = json.loads(body)
+        message = decode(body, properties)
         user = message['user']
-        location = tuple(map(int, message['location'].split(',')))
-        turn = message['turn']
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # Insert movement to database if not already exists
-        insert_movement_if_not_exists(user, f"{location[0]},{location[1]}",
-                                      turn, timestamp, conn)
+        location = message['location']
+        turn = message.get('turn', open_turn)
+
+        # Insert movement to database if not already exists; a shard only
+        # records movements in its own tiles, not those in its halo. The
+        # row holds the message's own turn and timestamp, so a redelivery
+        # has the same key.
+        if engine.owns(*location):
+            insert_movement_if_not_exists(user, format_location(location),
+                                          message.get('turn'),
+                                          message_time(message), writer)
 
         # Store each user's position by turn
-        user_positions_by_turn[turn][location].append(user)
-
-        # Acknowledge the message after processing
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        engine.add(turn, user, location[0], location[1])
 
-    except json.JSONDecodeError:
-        logging.error("Failed to decode JSON from movement message.")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    except ValueError as e:
+        logging.error(f"Failed to decode movement message: {e}")
     except KeyError as e:
         logging.error(f"Missing key in movement message: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
         logging.error(f"Error processing movement message: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
-# Callback for processing turn updates and checking intersections
-def on_turn_update(ch, method, _, body,
-                   conn):  # `_` marks `properties` as unused
+# Process a turn update and record the intersections of the turn
+# `resolve_delay` turns before it
+def on_turn_update(body, writer, engine, properties=None):
+    global open_turn, latest_turn
     try:
-        message = json.loads(body)
+        message = decode(body, properties)
         turn = message['turn']
+        if is_clock_restart(latest_turn, turn, message.get('epoch')):
+            logging.info(f"Turn clock restarted at turn {turn}")
+            engine.reset()
+            open_turn = 0
+            latest_turn = None
+        open_turn = max(open_turn, turn + 1)
+        if latest_turn is None or turn >= latest_turn[0]:
+            latest_turn = (turn, message.get('epoch'))
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # Check each location for intersections in the current turn
-        for location, users in user_positions_by_turn[turn].items():
-            if len(users) > 1:  # More than one user in the same location
-                record_intersection(users, f"{location[0]},{location[1]}",
-                                    timestamp, conn)
-
-        # Clear processed turn data to avoid memory bloat
-        user_positions_by_turn.pop(turn, None)
-
-        # Acknowledge the turn update message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-
-    except json.JSONDecodeError:
-        logging.error("Failed to decode JSON from turn update message.")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        lag = turn_lag(message)
+        if lag is not None:
+            logging.debug(f"Turn {turn} received {lag * 1000:.1f} ms after "
+                          "it started")
+
+        # Resolve the turn in one pass; this also releases its positions
+        resolved = turn - resolve_delay
+        if resolved < 0:
+            return
+        for hit in engine.detect(resolved):
+            record_intersection(list(hit.users),
+                                format_intersection_location(hit), resolved,
+                                timestamp, writer)
+
+    except ValueError as e:
+        logging.error(f"Failed to decode turn update message: {e}")
     except KeyError as e:
         logging.error(f"Missing key in turn update message: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
         logging.error(f"Error processing turn update message: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
-# Main function to consume messages
-def main():
-    connection, channel = setup_rabbitmq()
-    db_conn = setup_database()
-
-    # Consume from the movement_updates queue
-    channel.basic_consume(
-        queue='movement_updates',
-        on_message_callback=lambda ch, method, properties, body:
-        on_movement_message(ch, method, properties, body, db_conn),
-        auto_ack=False)
-
-    # Consume from the turn_updates queue
-    channel.basic_consume(
-        queue='turn_updates',
-        on_message_callback=lambda ch, method, properties, body:
-        on_turn_update(ch, method, properties, body, db_conn),
-        auto_ack=False)
+# Batch handler for the movements consumer
+def on_movement_batch(batch, ack, writer, engine):
+    for delivery in batch:
+        on_movement_message(delivery.body, writer, engine,
+                            delivery.properties)
+    # Acknowledge the batch once its rows have been committed
+    writer.after_commit(ack, ack.requeue)
+
+
+# Batch handler for the turns consumer
+def on_turn_batch(batch, ack, writer, engine):
+    for delivery in batch:
+        on_turn_update(delivery.body, writer, engine, delivery.properties)
+    # Acknowledge the turn updates once their intersections are committed
+    writer.after_commit(ack, ack.requeue)
+
+
+# Asyncio variant of run_consumers(): both queues are consumed by coroutines
+# over a single connection, and each message is acked once its rows are
+# committed
+async def consume_async(config, db_writer, engine, movements_queue,
+                        turns_queue):
+    runtime = await connect_from_config(config)
+    await runtime.declare_topology(topology_from_config(config))
+    prefetch_count = prefetch_from_config(config)
+
+    async def handle_movement(body, properties):
+        on_movement_message(body, db_writer, engine, properties)
+        await runtime.wait_for_commit(db_writer)
+
+    async def handle_turn(body, properties):
+        on_turn_update(body, db_writer, engine, properties)
+        await runtime.wait_for_commit(db_writer)
+
+    await runtime.consume(movements_queue, handle_movement, prefetch_count)
+    await runtime.consume(turns_queue, handle_turn, prefetch_count)
+    logging.info("Intersection service started on the asyncio runtime.")
+    await runtime.wait_closed()
+
+
+# Consume a movement and a turn queue into `engine`, which is either the
+# whole-map IntersectionEngine or one IntersectionShard
+def run_consumers(config, engine, movements_queue, turns_queue):
+    global resolve_delay
+    log_sampler.configure(config)
+    resolve_delay = max(
+        0, config.get('intersection_resolve_delay', DEFAULT_RESOLVE_DELAY))
+    db_writer = setup_database(config)
+
+    if use_asyncio(config):
+        try:
+            asyncio.run(
+                consume_async(config, db_writer, engine, movements_queue,
+                              turns_queue))
+        except KeyboardInterrupt:
+            logging.info("Intersection service stopped by user.")
+        finally:
+            db_writer.close()
+        return
+
+    connection, _ = setup_rabbitmq(config)
+
+    # Each consumer gets its own prefetch-bounded channel
+    create_consumer(
+        connection, movements_queue,
+        lambda batch, ack: on_movement_batch(batch, ack, db_writer, engine),
+        config).start()
+    create_consumer(
+        connection, turns_queue,
+        lambda batch, ack: on_turn_batch(batch, ack, db_writer, engine),
+        config).start()
 
     logging.info(
-        "Intersection service started, listening for movement and turn updates..."
-    )
+        f"Intersection service started, listening on {movements_queue} and "
+        f"{turns_queue}...")
     try:
-        channel.start_consuming()
+        consume_forever(connection)
     except KeyboardInterrupt:
         logging.info("Intersection service stopped by user.")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
     finally:
+        if db_writer:
+            db_writer.close()
+            logging.info("SQLite writer flushed and closed.")
         if connection:
             connection.close()
             logging.info("RabbitMQ connection closed.")
-        if db_conn:
-            db_conn.close()
-            logging.info("SQLite connection closed.")
+
+
+# Entry point of one shard worker process
+def run_shard(config, worker):
+    shard = IntersectionShard(layout_from_config(config), worker)
+    run_consumers(config, shard, shard_movement_queue(worker),
+                  shard_turn_queue(worker))
+
+
+# Run one worker process per shard and wait for them
+def run_sharded(config, layout):
+    workers = [
+        multiprocessing.Process(target=run_shard,
+                                args=(config, worker),
+                                name=f"intersections-shard-{worker}")
+        for worker in range(layout.workers)
+    ]
+    for process in workers:
+        process.start()
+    logging.info(f"Started {layout.workers} intersection shards over "
+                 f"{layout.tiles_x}x{layout.tiles_y} tiles")
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        logging.info("Intersection service stopped by user.")
+        for process in workers:
+            process.join(timeout=10)
+
+
+# Command line options; --workers defaults to the "intersection_shards"
+# section of config.json
+def parse_args(config):
+    parser = argparse.ArgumentParser(description="Intersection service")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=layout_from_config(config).workers,
+        help="shard processes, each owning a share of the map tiles (the "
+        "other services must be configured with the same "
+        "intersection_shards to route movements to them)")
+    return parser.parse_args()
+
+
+# Main function to consume messages; sharded when --workers or the
+# "intersection_shards" section of config.json asks for more than one worker
+def main():
+    config = load_config()
+    workers = max(1, parse_args(config).workers)
+    if workers != layout_from_config(config).workers:
+        logging.warning(f"Running {workers} intersection shards; "
+                        f"config.json has "
+                        f"{layout_from_config(config).workers}")
+        config.setdefault('intersection_shards', {})['workers'] = workers
+    layout = layout_from_config(config)
+    if layout.workers > 1:
+        run_sharded(config, layout)
+        return
+    run_consumers(config, engine_from_config(config), MOVEMENTS_QUEUE,
+                  TURNS_QUEUE)
 
 
 if __name__ == "__main__":
@@ -1,71 +1,372 @@
+import json
+import logging
 import os
+import signal
 import subprocess
+import sys
+import threading
 import time
-import signal
+import urllib.request
+from collections import namedtuple
 
+import pika.exceptions
 
-def start_microservice(name, service_path):
-    print(f"Starting {name} microservice...")
-    process = subprocess.Popen(['python', service_path],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    print(f"{name} microservice started with PID {process.pid}")
-    return process
+from intersection_shards import layout_from_config
+from memory_broker import blocking_connection
+from topology import MOVEMENT_QUEUES, shard_movement_queue
 
+DEFAULT_READY_TIMEOUT = 60.0
+DEFAULT_INITIAL_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+DEFAULT_HEALTH_INTERVAL = 5.0
+DEFAULT_UNHEALTHY_AFTER = 3
 
-def launch_microservices():
-    # List all microservices to start
-    microservices = {
-        "GlobalTurnClock": "global_turn_clock.py",
-        "IntersectionsService": "intersections_service.py",
-        "MapBuilderService": "mapbuilder.py",
-        "ReportService": "report_service.py",
-        "MovementService": "movement_service.py"
-    }
-
-    processes = {}
-
-    # Start each service and store the process in a dictionary
-    for name, path in microservices.items():
-        if os.path.isfile(path):
-            processes[name] = start_microservice(name, path)
+# A replica that stays up this long has its restart backoff reset
+STABLE_SECONDS = 30.0
+# How long a service without a probe must stay up to count as ready
+GRACE_SECONDS = 1.0
+POLL_INTERVAL = 0.2
+STOP_TIMEOUT = 10.0
+
+# Environment variables telling a replica its index and the replica count
+REPLICA_ENV = 'SERVICE_REPLICA'
+REPLICAS_ENV = 'SERVICE_REPLICAS'
+
+# A supervised service. Services of a `stage` are started together once
+# every earlier stage is ready; `probe(replicas)` tells whether the service
+# is ready and healthy (None: running for GRACE_SECONDS is enough). Only
+# `scalable` services may run more than one replica on their queues.
+Service = namedtuple('Service', ['name', 'path', 'stage', 'probe', 'scalable'])
+
+
+# Config to load
+def load_config():
+    with open('config.json') as f:
+        return json.load(f)
+
+
+# Probe passing when GET `url` answers 200
+def http_probe(url):
+
+    # Any replica answering is enough
+    def probe(_replicas):
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                return response.status == 200
+        except OSError:
+            return False
+
+    return probe
+
+
+# Probe passing when every queue has one consumer per replica. The passive
+# declaration fails until some service has declared the queue.
+def queue_probe(address, queues):
+
+    def probe(replicas):
+        try:
+            connection = blocking_connection(address)
+        except pika.exceptions.AMQPError:
+            return False
+        try:
+            channel = connection.channel()
+            for queue in queues:
+                declared = channel.queue_declare(queue=queue, passive=True)
+                if declared.method.consumer_count < replicas:
+                    return False
+            return True
+        except pika.exceptions.AMQPError:
+            return False
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    return probe
+
+
+# Probe passing when all of `probes` pass
+def all_probes(*probes):
+    return lambda replicas: all(probe(replicas) for probe in probes)
+
+
+# The services in start order: the consumers first so nothing published is
+# missed, then the movement service, then the turn clock driving them all
+def services_from_config(config):
+    address = config['rabbitmq_address']
+    layout = layout_from_config(config)
+    if layout.workers > 1:
+        intersection_queues = [
+            shard_movement_queue(worker) for worker in range(layout.workers)
+        ]
+    else:
+        intersection_queues = [MOVEMENT_QUEUES['intersections']]
+    return [
+        Service("IntersectionsService", "intersections_service.py", 0,
+                queue_probe(address, intersection_queues), False),
+        Service(
+            "ReportService", "report_service.py", 0,
+            all_probes(http_probe('http://127.0.0.1:5001/metrics'),
+                       queue_probe(address, [MOVEMENT_QUEUES['reports']])),
+            True),
+        Service("MapBuilderService", "mapbuilder.py", 0,
+                http_probe('http://127.0.0.1:5002/metrics'), False),
+        Service("MovementService", "movement_service.py", 1,
+                http_probe('http://127.0.0.1:5003/metrics'), False),
+        Service("GlobalTurnClock", "global_turn_clock.py", 2, None, False),
+    ]
+
+
+# Log every line of a child's output as it arrives, so a chatty service
+# never blocks on a full pipe
+def drain_output(label, stream):
+    for line in iter(stream.readline, b''):
+        logging.info(f"[{label}] {line.decode(errors='replace').rstrip()}")
+    stream.close()
+
+
+# One process of a service, restarted with exponential backoff
+class Replica:
+
+    def __init__(self, service, index, replicas):
+        self.service = service
+        self.index = index
+        self.replicas = replicas
+        self.label = (service.name
+                      if replicas == 1 else f"{service.name}#{index}")
+        self.process = None
+        self.started_at = None
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self):
+        env = dict(os.environ)
+        env[REPLICA_ENV] = str(self.index)
+        env[REPLICAS_ENV] = str(self.replicas)
+        self.process = subprocess.Popen([sys.executable, self.service.path],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        env=env)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        threading.Thread(target=drain_output,
+                         args=(self.label, self.process.stdout),
+                         name=f"drain-{self.label}",
+                         daemon=True).start()
+        logging.info(f"Started {self.label} with PID {self.process.pid}")
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def uptime(self):
+        return time.monotonic() - self.started_at if self.running() else 0.0
+
+    # Schedule a restart if the process exited, and start it when due
+    def check(self, initial_backoff, max_backoff):
+        if self.process is None:
+            return
+        now = time.monotonic()
+        if self.restart_at is None:
+            code = self.process.poll()
+            if code is None:
+                return
+            if now - self.started_at >= STABLE_SECONDS:
+                self.failures = 0
+            delay = min(max_backoff, initial_backoff * 2**self.failures)
+            self.failures += 1
+            self.restart_at = now + delay
+            logging.warning(f"{self.label} exited with return code {code}; "
+                            f"restarting in {delay:.1f}s")
+        elif now >= self.restart_at:
+            self.start()
+
+    def terminate(self):
+        if self.running():
+            self.process.terminate()
+
+    # SIGINT lets the service flush and close its connections
+    def interrupt(self):
+        if self.running():
+            self.process.send_signal(signal.SIGINT)
+
+    # Wait for an interrupted replica to exit, killing it after STOP_TIMEOUT
+    def wait_stopped(self):
+        if self.running():
+            try:
+                self.process.wait(timeout=STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logging.warning(f"{self.label} did not stop; killing it")
+                self.process.kill()
+                self.process.wait()
+
+
+# Starts the services stage by stage, all services of a stage in parallel,
+# waits for their readiness probes, then keeps them running: crashed
+# replicas are restarted with exponential backoff, and a service failing its
+# probe `unhealthy_after` times in a row is restarted.
+class Supervisor:
+
+    def __init__(self,
+                 services,
+                 replicas=None,
+                 ready_timeout=DEFAULT_READY_TIMEOUT,
+                 initial_backoff=DEFAULT_INITIAL_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF,
+                 health_interval=DEFAULT_HEALTH_INTERVAL,
+                 unhealthy_after=DEFAULT_UNHEALTHY_AFTER):
+        self.services = [
+            service for service in services if os.path.isfile(service.path)
+        ]
+        for service in services:
+            if service not in self.services:
+                logging.error(f"{service.path} does not exist. "
+                              f"{service.name} not started.")
+        self.ready_timeout = ready_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.health_interval = health_interval
+        self.unhealthy_after = unhealthy_after
+        self.ready_seconds = None
+        self._unhealthy = {}
+        self._replicas = {}
+        for service in self.services:
+            count = max(1, (replicas or {}).get(service.name, 1))
+            if count > 1 and not service.scalable:
+                logging.warning(f"{service.name} keeps state per process "
+                                f"and runs as a single replica")
+                count = 1
+            self._replicas[service.name] = [
+                Replica(service, index, count) for index in range(count)
+            ]
+
+    def replicas(self, service):
+        return self._replicas[service.name]
+
+    def ready(self, service):
+        replicas = self.replicas(service)
+        if not all(replica.running() for replica in replicas):
+            return False
+        if service.probe is None:
+            return all(replica.uptime() >= GRACE_SECONDS
+                       for replica in replicas)
+        return service.probe(len(replicas))
+
+    def check_processes(self):
+        for replicas in self._replicas.values():
+            for replica in replicas:
+                replica.check(self.initial_backoff, self.max_backoff)
+
+    # Start every stage and wait for it to be ready; returns the seconds
+    # until the whole system was ready, or None if some service was not
+    def start(self):
+        started = time.monotonic()
+        all_ready = True
+        for stage in sorted({service.stage for service in self.services}):
+            members = [
+                service for service in self.services if service.stage == stage
+            ]
+            for service in members:
+                for replica in self.replicas(service):
+                    replica.start()
+            all_ready = self.wait_ready(members, started) and all_ready
+        elapsed = time.monotonic() - started
+        if all_ready:
+            self.ready_seconds = elapsed
+            logging.info(f"All services ready in {elapsed:.2f}s")
         else:
-            print(
-                f"Error: {path} does not exist. {name} microservice not started."
-            )
+            logging.warning(f"Started all services in {elapsed:.2f}s, "
+                            f"some of them not ready")
+        return self.ready_seconds
 
-    try:
-        # Monitor each process and log output; restart if it exits
+    # Wait up to `ready_timeout` for `members`, restarting any that crash;
+    # returns whether all of them became ready
+    def wait_ready(self, members, started):
+        pending = list(members)
+        deadline = time.monotonic() + self.ready_timeout
+        while pending:
+            self.check_processes()
+            for service in list(pending):
+                if self.ready(service):
+                    pending.remove(service)
+                    logging.info(f"{service.name} ready after "
+                                 f"{time.monotonic() - started:.2f}s")
+            if pending and time.monotonic() >= deadline:
+                logging.warning(
+                    f"Not ready after {self.ready_timeout:.0f}s: "
+                    f"{', '.join(service.name for service in pending)}; "
+                    f"starting the next services anyway")
+                return False
+            if pending:
+                time.sleep(POLL_INTERVAL)
+        return True
+
+    # Restart the services failing their probe too many times in a row
+    def check_health(self):
+        for service in self.services:
+            replicas = self.replicas(service)
+            if (service.probe is None
+                    or not all(replica.running() for replica in replicas)):
+                continue
+            if service.probe(len(replicas)):
+                self._unhealthy[service.name] = 0
+                continue
+            failures = self._unhealthy.get(service.name, 0) + 1
+            self._unhealthy[service.name] = failures
+            if failures >= self.unhealthy_after:
+                logging.warning(f"{service.name} failed {failures} health "
+                                f"checks; restarting it")
+                self._unhealthy[service.name] = 0
+                for replica in replicas:
+                    replica.terminate()
+
+    def run(self):
+        self.start()
+        next_health_check = time.monotonic() + self.health_interval
         while True:
-            for name, process in list(processes.items()):
-                # Check process status
-                retcode = process.poll()
-                if retcode is not None:  # Process has stopped
-                    print(
-                        f"{name} microservice stopped with return code {retcode}. "
-                        f"Restarting...")
-
-                    # Capture and print stdout and stderr for troubleshooting
-                    stdout, stderr = process.communicate()
-                    if stdout:
-                        print(f"{name} stdout:\n{stdout.decode()}")
-                    if stderr:
-                        print(f"{name} stderr:\n{stderr.decode()}")
-
-                    # Restart the process
-                    processes[name] = start_microservice(
-                        name, microservices[name])
-
-            # Wait before the next check
-            time.sleep(5)
+            self.check_processes()
+            if time.monotonic() >= next_health_check:
+                self.check_health()
+                next_health_check = time.monotonic() + self.health_interval
+            time.sleep(POLL_INTERVAL)
+
+    # Interrupt every replica at once, then wait for them
+    def stop(self):
+        replicas = [
+            replica for service_replicas in self._replicas.values()
+            for replica in service_replicas
+        ]
+        for replica in replicas:
+            replica.interrupt()
+        for replica in replicas:
+            replica.wait_stopped()
+
+
+# Supervisor for the "launcher" section of config.json
+def supervisor_from_config(config):
+    settings = config.get('launcher', {})
+    return Supervisor(
+        services_from_config(config),
+        replicas=settings.get('replicas'),
+        ready_timeout=settings.get('ready_timeout', DEFAULT_READY_TIMEOUT),
+        initial_backoff=settings.get('initial_backoff',
+                                     DEFAULT_INITIAL_BACKOFF),
+        max_backoff=settings.get('max_backoff', DEFAULT_MAX_BACKOFF),
+        health_interval=settings.get('health_interval',
+                                     DEFAULT_HEALTH_INTERVAL),
+        unhealthy_after=settings.get('unhealthy_after',
+                                     DEFAULT_UNHEALTHY_AFTER))
+
+
+def launch_microservices():
+    supervisor = supervisor_from_config(load_config())
+    try:
+        supervisor.run()
     except KeyboardInterrupt:
-        print("Shutting down all microservices...")
-        for name, process in processes.items():
-            process.send_signal(
-                signal.SIGINT)  # Use SIGINT for graceful shutdown
-            process.wait()
-        print("All microservices have been stopped.")
+        logging.info("Shutting down all microservices...")
+        supervisor.stop()
+        logging.info("All microservices have been stopped.")
 
 
 if __name__ == "__main__":
+    # Logged to stdout, which main.py reads
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     launch_microservices()
@@ -0,0 +1,417 @@
+import argparse
+import importlib
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import defaultdict, deque
+
+from memory_broker import MEMORY_ADDRESS
+
+DIRECTIONS = ['N', 'S', 'E', 'W']
+
+
+# Load the configuration the run starts from
+def load_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# Copy of `config` that runs every service in this process on the shared
+# in-memory broker
+def offline_config(config, turn_duration):
+    config = dict(config)
+    config['rabbitmq_address'] = MEMORY_ADDRESS
+    config['runtime'] = 'threaded'
+    config['turn_duration'] = turn_duration
+    config['intersection_shards'] = {'workers': 1}
+    return config
+
+
+def parse_location(text):
+    x, y = text.strip('()').split(',')
+    return int(x), int(y)
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Timestamps (time.perf_counter) of everything the run observes. Moves and
+# emits are matched afterwards, so an emit that overtakes the HTTP response
+# of its move is still counted.
+class Recorder:
+
+    def __init__(self):
+        self.moves = []
+        self.rejected = 0
+        self.emits = []
+        self.turns = {}
+        self.intersections = []
+        self._lock = threading.Lock()
+
+    def move(self, sent, user, location):
+        with self._lock:
+            self.moves.append((sent, user, location))
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def emit(self, received, users, locations):
+        with self._lock:
+            self.emits.extend((received, user, tuple(location))
+                              for user, location in zip(users, locations,
+                                                        strict=True))
+
+    def turn(self, turn, broadcast):
+        with self._lock:
+            self.turns[turn] = broadcast
+
+    def intersections_committed(self, committed, hits):
+        with self._lock:
+            self.intersections.extend(
+                (committed, turn, hit.users) for turn, hit in hits)
+
+    # Seconds from each accepted move to the emit carrying it
+    def emit_latencies(self):
+        pending = defaultdict(deque)
+        for sent, user, location in sorted(self.moves):
+            pending[user, location].append(sent)
+        latencies = []
+        for received, user, location in sorted(self.emits):
+            sent = pending.get((user, location))
+            if sent:
+                latencies.append(received - sent.popleft())
+        return sorted(latencies)
+
+    # Seconds from the last move of an intersection's users before its turn
+    # was broadcast to the commit of the intersection record
+    def intersection_latencies(self):
+        sends = defaultdict(list)
+        for sent, user, _ in sorted(self.moves):
+            sends[user].append(sent)
+        latencies = []
+        for committed, turn, users in self.intersections:
+            broadcast = self.turns.get(turn)
+            if broadcast is None:
+                continue
+            last_moves = []
+            for user in users:
+                times = sends.get(user, [])
+                index = bisect_right(times, broadcast)
+                if index:
+                    last_moves.append(times[index - 1])
+            if last_moves:
+                latencies.append(committed - max(last_moves))
+        return sorted(latencies)
+
+
+# Socket.IO stand-in for main.py's movement coalescer: records every
+# movement batch sent to ALL_REGIONS_ROOM, then emits it as usual
+class EmitProbe:
+
+    def __init__(self, socketio, recorder, event, room):
+        self.socketio = socketio
+        self.recorder = recorder
+        self.event = event
+        self.room = room
+
+    def emit(self, event, data, to=None, **kwargs):
+        if event == self.event and to == self.room:
+            received = time.perf_counter()
+            payload = data
+            if data.get('encoding') == 'deflate':
+                payload = json.loads(zlib.decompress(data['data']))
+            self.recorder.emit(received, payload['users'],
+                               payload['locations'])
+        return self.socketio.emit(event, data, to=to, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.socketio, name)
+
+
+# Intersection engine wrapper keeping the hits of each detect() call until
+# the turn consumer collects them
+class RecordingEngine:
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._hits = []
+        self._lock = threading.Lock()
+
+    def add(self, turn, user, x, y):
+        self.engine.add(turn, user, x, y)
+
+    def owns(self, x, y):
+        return self.engine.owns(x, y)
+
+    def reset(self):
+        self.engine.reset()
+
+    def detect(self, turn):
+        hits = self.engine.detect(turn)
+        with self._lock:
+            self._hits.extend((turn, hit) for hit in hits)
+        return hits
+
+    def take(self):
+        with self._lock:
+            hits, self._hits = self._hits, []
+        return hits
+
+
+# main.py's RabbitMQ listeners and movement coalescer, with the coalescer's
+# emits observed by an EmitProbe
+def start_web(web, recorder):
+    coalescer = web.movement_coalescer
+    coalescer.socketio = EmitProbe(coalescer.socketio, recorder,
+                                   coalescer.event, web.ALL_REGIONS_ROOM)
+    threading.Thread(target=web.listen_to_rabbitmq_updates,
+                     daemon=True).start()
+    coalescer.start()
+
+
+# The intersection service's consumers; the commit time of each turn's
+# intersection records is reported to the recorder
+def start_intersections(intersections, config, recorder):
+    from consumer import consume_forever, create_consumer
+    from intersection_engine import engine_from_config
+    from memory_broker import blocking_connection
+
+    writer = intersections.setup_database(config)
+    engine = RecordingEngine(engine_from_config(config))
+
+    def on_turns(batch, ack):
+        intersections.on_turn_batch(batch, ack, writer, engine)
+        hits = engine.take()
+        writer.after_commit(lambda: recorder.intersections_committed(
+            time.perf_counter(), hits))
+
+    connection = blocking_connection(config['rabbitmq_address'])
+    create_consumer(
+        connection, intersections.MOVEMENTS_QUEUE,
+        lambda batch, ack: intersections.on_movement_batch(
+            batch, ack, writer, engine), config).start()
+    create_consumer(connection, intersections.TURNS_QUEUE, on_turns,
+                    config).start()
+    threading.Thread(target=consume_forever, args=(connection, ),
+                     daemon=True).start()
+    return writer
+
+
+# Run the global turn clock on a background thread
+def start_turn_clock(config, recorder):
+    import global_turn_clock
+    from channel_pool import pool_from_config
+    from messages import codec_from_config
+    from topology import topology_from_config
+    from turn_scheduler import scheduler_from_config
+
+    codec = codec_from_config(config)
+    publisher = pool_from_config(
+        config, declarations=topology_from_config(config).declarations())
+    scheduler = scheduler_from_config(config)
+
+    def tick(turn, deadline):
+        recorder.turn(turn, time.perf_counter())
+        global_turn_clock.broadcast_turn(publisher, turn, codec,
+                                         scheduler.wall_time(deadline))
+
+    threading.Thread(target=scheduler.run, args=(tick, ),
+                     daemon=True).start()
+    return scheduler
+
+
+# Register and log in every simulated user through auth's /login
+def log_in_users(web, users):
+    client = web.app.test_client()
+    for user in users:
+        credentials = {'username': user, 'password': 'loadgen'}
+        client.post('/register', json=credentials)
+        response = client.post('/login', json=credentials)
+        if response.status_code != 200:
+            raise RuntimeError(f"Login of {user} failed: "
+                               f"{response.get_json()}")
+
+
+# Issue moves through movement_service's /move on `threads` threads at a
+# fixed total rate; move k is due at start + k / rate (open loop), and late
+# moves are sent as soon as a thread is free
+def generate_moves(movement_service, users, rate, duration, threads, seed,
+                   recorder):
+    schedule = itertools.count()
+    schedule_lock = threading.Lock()
+    start = time.perf_counter() + 0.1
+    end = start + duration
+
+    def worker(index):
+        client = movement_service.app.test_client()
+        rng = random.Random(seed + index)
+        while True:
+            with schedule_lock:
+                k = next(schedule)
+            due = start + k / rate
+            if due >= end:
+                return
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            user = users[k % len(users)]
+            sent = time.perf_counter()
+            response = client.post('/move',
+                                   json={
+                                       'user_id': user,
+                                       'direction': rng.choice(DIRECTIONS)
+                                   })
+            if response.status_code == 200:
+                recorder.move(sent, user,
+                              parse_location(
+                                  response.get_json()['new_location']))
+            else:
+                recorder.reject()
+
+    workers = [
+        threading.Thread(target=worker, args=(index, ), daemon=True)
+        for index in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def summarize(label, latencies):
+    if not latencies:
+        return {"label": label, "count": 0}
+    return {
+        "label": label,
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def print_report(report):
+    print(f"{report['users']} users, {report['offered_rate']:.0f} moves/s "
+          f"offered for {report['duration']:.1f} s, turns every "
+          f"{report['turn_duration']} s")
+    print(f"moves: {report['accepted']} accepted, {report['rejected']} "
+          f"rejected, {report['accepted_rate']:.0f} accepted/s")
+    for latency in report['latency']:
+        if not latency['count']:
+            print(f"{latency['label']:<28} no samples")
+            continue
+        print(f"{latency['label']:<28} n={latency['count']:<7} "
+              f"p50 {latency['p50_ms']:8.2f} ms  "
+              f"p99 {latency['p99_ms']:8.2f} ms  "
+              f"max {latency['max_ms']:8.2f} ms")
+    print(f"throughput: {report['emitted_rate']:.0f} updates emitted/s, "
+          f"{report['intersection_rate']:.1f} intersections recorded/s")
+    print(f"turn clock: {report['turn_clock']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive the services in-process on the in-memory broker "
+        "and measure move latency and throughput")
+    parser.add_argument('-u', '--users', type=int, default=100)
+    parser.add_argument('-r', '--rate', type=float, default=2.0,
+                        help="moves per second per user")
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help="seconds of load")
+    parser.add_argument('-t', '--threads', type=int, default=8,
+                        help="threads issuing HTTP requests")
+    parser.add_argument('--turn-duration', type=float, default=0.5)
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--workdir',
+                        help="directory for config.json and the databases "
+                        "(default: a temporary directory, removed afterwards)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true',
+                        help="print the report as JSON")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--metrics',
+                        help="write the process's /metrics output here")
+    args = parser.parse_args()
+
+    config = offline_config(load_config(args.config), args.turn_duration)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='loadgen-')
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    # The services read config.json and open their databases relative to
+    # the working directory when they are imported
+    os.chdir(workdir)
+
+    try:
+        web = importlib.import_module('main')
+        movement_service = importlib.import_module('movement_service')
+        intersections = importlib.import_module('intersections_service')
+        logging.getLogger().setLevel(args.log_level)
+
+        recorder = Recorder()
+        start_web(web, recorder)
+        writer = start_intersections(intersections, config, recorder)
+        scheduler = start_turn_clock(config, recorder)
+
+        users = [f"loaduser{i}" for i in range(args.users)]
+        log_in_users(web, users)
+        elapsed = generate_moves(movement_service, users,
+                                 args.users * args.rate, args.duration,
+                                 args.threads, args.seed, recorder)
+
+        # Let the last turns close and their records and emits go out
+        time.sleep(2 * args.turn_duration +
+                   web.movement_coalescer.window_seconds + 0.5)
+        scheduler.stop()
+        writer.flush()
+
+        accepted = len(recorder.moves)
+        report = {
+            "users": args.users,
+            "offered_rate": args.users * args.rate,
+            "duration": elapsed,
+            "turn_duration": args.turn_duration,
+            "accepted": accepted,
+            "rejected": recorder.rejected,
+            "accepted_rate": accepted / elapsed,
+            "emitted_rate": len(recorder.emits) / elapsed,
+            "intersection_rate": len(recorder.intersections) / elapsed,
+            "latency": [
+                summarize("move -> movement emit",
+                          recorder.emit_latencies()),
+                summarize("move -> intersection record",
+                          recorder.intersection_latencies()),
+            ],
+            "turn_clock": scheduler.stats(),
+        }
+        metrics_text = web.app.test_client().get('/metrics').get_data(
+            as_text=True)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics_text)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,20 @@
+import asyncio
 import json
 import logging
 import threading
-import os
-import time
 import subprocess
-import pika
-import pika.exceptions
-from flask import Flask, render_template
-from flask_socketio import SocketIO
+from flask import Flask, jsonify, render_template
+from flask_socketio import SocketIO, join_room, leave_room, rooms
 
+from async_runtime import (connect_from_config, prefetch_from_config,
+                           use_asyncio)
 from auth import auth_blueprint
+from consumer import consume_forever, create_consumer
+from emit_coalescer import ALL_REGIONS_ROOM, coalescer_from_config
+from memory_broker import blocking_connection
+from messages import decode
+from metrics import instrument_app
+from topology import MOVEMENT_QUEUES, TURN_QUEUES, topology_from_config
 from report_service import report_blueprint
 
 # Initialize Flask and SocketIO
@@ -21,6 +26,9 @@ socketio = SocketIO(app)
 app.register_blueprint(auth_blueprint)
 app.register_blueprint(report_blueprint, url_prefix='/report')
 
+# Request timings and every other metric of this process on /metrics
+instrument_app(app)
+
 
 # Load configuration from config.json
 def load_config():
@@ -31,95 +39,222 @@ def load_config():
 config = load_config()
 rabbitmq_address = config['rabbitmq_address']
 
+# Movement updates are batched per map region before reaching the browsers
+movement_coalescer = coalescer_from_config(socketio, config)
+
+# This service's own copies of the movement and turn streams
+topology = topology_from_config(config)
+MOVEMENTS_QUEUE = MOVEMENT_QUEUES['main']
+TURNS_QUEUE = TURN_QUEUES['main']
+
 
 # Setup RabbitMQ and declare necessary queues
 def setup_rabbitmq():
-    connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_address))
+    connection = blocking_connection(rabbitmq_address)
     channel = connection.channel()
 
-    # Declare all relevant queues with durable=True to ensure messages persist
-    channel.queue_declare(queue='movement_updates', durable=True)
-    channel.queue_declare(queue='turn_updates', durable=True)
+    # Declare the exchanges and every service's queues, then the queues
+    # only main.py uses, with durable=True to ensure messages persist
+    topology.declare(channel)
     channel.queue_declare(queue='map_layout', durable=True)
     channel.queue_declare(queue='position', durable=True)
+    channel.queue_declare(queue='map_requests', durable=True)
 
     return connection, channel
 
 
-# Listen to movement_updates queue
-def listen_to_movement_updates():
-    connection, channel = setup_rabbitmq()
-    for method_frame, _, body in channel.consume(queue='movement_updates',
-                                                 auto_ack=False):
-        if body:  # Check if message body is non-empty
-            try:
-                message = json.loads(body)
-                socketio.emit('movement_update', message)
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-            except json.JSONDecodeError:
-                logging.error(
-                    "Failed to decode JSON from movement_updates queue. "
-                    "Message skipped.")
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-        else:
-            logging.warning(
-                "Received empty message in movement_updates queue.")
-            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+# Decode a message body with the codec named by its content type, logging
+# and returning None if it is unusable
+def decode_message(body, queue_name, properties=None):
+    if not body:  # Check if message body is non-empty
+        logging.warning(f"Received empty message in {queue_name} queue.")
+        return None
+    try:
+        return decode(body, properties)
+    except ValueError as e:
+        logging.error(f"Failed to decode message from {queue_name} queue: "
+                      f"{e}. Message skipped.")
+        return None
 
 
-# Listen to turn_updates queue
-def listen_to_turn_updates():
-    connection, channel = setup_rabbitmq()
-    for method_frame, _, body in channel.consume(queue='turn_updates',
-                                                 auto_ack=False):
-        if body:
-            try:
-                message = json.loads(body)
-                socketio.emit('turn_update', {'turn': message.get('turn', 0)})
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-            except json.JSONDecodeError:
-                logging.error(
-                    "Failed to decode JSON from movement_updates queue. "
-                    "Message skipped.")
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-        else:
-            logging.warning("Received empty message in turn_updates queue.")
-            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+# Decode a message and emit it to Socket.IO clients
+def emit_message(body, queue_name, event, transform=None, properties=None):
+    message = decode_message(body, queue_name, properties)
+    if message is None:
+        return
+    socketio.emit(event, transform(message) if transform else message)
+
+
+# Decode each message of a batch and emit it to Socket.IO clients
+def emit_batch(batch, queue_name, event, transform=None):
+    for delivery in batch:
+        emit_message(delivery.body, queue_name, event, transform,
+                     delivery.properties)
+
+
+# Hand a movement update to the coalescer instead of emitting it directly
+def coalesce_movement(body, properties=None):
+    message = decode_message(body, MOVEMENTS_QUEUE, properties)
+    if message is not None:
+        movement_coalescer.add(message)
+
+
+def turn_payload(message):
+    payload = {'turn': message.get('turn', 0)}
+    if 'epoch' in message:
+        payload['epoch'] = message['epoch']
+    return payload
+
+
+# Queues forwarded to browsers as (queue, Socket.IO event, transform)
+FORWARDED_QUEUES = [
+    (MOVEMENTS_QUEUE, 'movement_batch', None),
+    (TURNS_QUEUE, 'turn_update', turn_payload),
+    ('map_layout', 'map_update', None),
+]
+
+
+# Handle batches from the movements queue
+def on_movement_updates(batch, ack):
+    for delivery in batch:
+        coalesce_movement(delivery.body, delivery.properties)
+    ack()
+
+
+# Handle batches from the turns queue
+def on_turn_updates(batch, ack):
+    # Movements of the finished turn reach clients before the turn change
+    movement_coalescer.flush()
+    emit_batch(batch, TURNS_QUEUE, 'turn_update', turn_payload)
+    ack()
+
+
+# Handle batches from the map_layout queue
+def on_map_layout(batch, ack):
+    emit_batch(batch, 'map_layout', 'map_update')
+    ack()
+
+
+# Consumers started by the listener thread, exposed for monitoring
+listeners = []
+
+# Publishes a keyframe request to mapbuilder; set by the running listeners
+publish_map_request = None
 
 
-# Listen to map_layout queue
-def listen_to_map_layout():
+# Consume all listener queues on one connection, each through its own
+# prefetch-bounded channel
+def listen_to_rabbitmq_updates():
+    global publish_map_request
     connection, channel = setup_rabbitmq()
-    for method_frame, _, body in channel.consume(queue='map_layout',
-                                                 auto_ack=False):
-        if body:
-            try:
-                message = json.loads(body)
-                socketio.emit('map_update', message)
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-            except json.JSONDecodeError:
-                logging.error(
-                    "Failed to decode JSON from movement_updates queue. "
-                    "Message skipped.")
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-        else:
-            logging.warning("Received empty message in map_layout queue.")
-            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+    def publish():
+        channel.basic_publish(exchange='', routing_key='map_requests',
+                              body=json.dumps({}))
+
+    def request_map():
+        connection.add_callback_threadsafe(publish)
+
+    publish_map_request = request_map
+    for queue_name, handler in ((MOVEMENTS_QUEUE, on_movement_updates),
+                                (TURNS_QUEUE, on_turn_updates),
+                                ('map_layout', on_map_layout)):
+        listeners.append(
+            create_consumer(connection, queue_name, handler, config).start())
+    consume_forever(connection)
+
+
+# Asyncio variant: every forwarded queue is consumed by coroutines on one
+# event loop over a single connection, one channel per queue
+async def listen_to_rabbitmq_updates_async():
+    global publish_map_request
+    runtime = await connect_from_config(config)
+    await runtime.declare_topology(topology)
+    await runtime.declare('map_requests')
+
+    def request_map():
+        runtime.publish_threadsafe('map_requests', json.dumps({}))
+
+    publish_map_request = request_map
+
+    prefetch_count = prefetch_from_config(config)
+    for queue_name, event, transform in FORWARDED_QUEUES:
+
+        async def forward(body, properties, queue_name=queue_name,
+                          event=event, transform=transform):
+            if queue_name == MOVEMENTS_QUEUE:
+                coalesce_movement(body, properties)
+                return
+            if queue_name == TURNS_QUEUE:
+                movement_coalescer.flush()
+            emit_message(body, queue_name, event, transform, properties)
+
+        await runtime.consume(queue_name, forward, prefetch_count)
+    await runtime.wait_closed()
+
+
+# Clients ask for a full map when they detect a gap in the delta stream
+@socketio.on('request_keyframe')
+def on_request_keyframe():
+    if publish_map_request is not None:
+        publish_map_request()
 
 
-# Background tasks to start RabbitMQ listeners
+# New clients receive movements for the whole map until they report a view
+@socketio.on('connect')
+def on_connect():
+    join_room(ALL_REGIONS_ROOM)
+
+
+# Leave the movement room of this client's current view
+def leave_view_rooms():
+    for room in rooms():
+        if room.startswith('region:'):
+            leave_room(room)
+            if room != ALL_REGIONS_ROOM:
+                movement_coalescer.leave_view(room)
+
+
+@socketio.on('disconnect')
+def on_disconnect():
+    leave_view_rooms()
+
+
+# Clients send the cells they display as {"x0", "y0", "x1", "y1"} and are
+# moved to the room of the regions covering them
+@socketio.on('view_region')
+def on_view_region(data):
+    try:
+        x0, y0, x1, y1 = (int(data[key]) for key in ('x0', 'y0', 'x1', 'y1'))
+    except (KeyError, TypeError, ValueError):
+        logging.warning(f"Ignoring invalid view_region request: {data}")
+        return
+    leave_view_rooms()
+    room = movement_coalescer.room_for_view(min(x0, x1), min(y0, y1),
+                                            max(x0, x1), max(y0, y1))
+    join_room(room)
+    movement_coalescer.join_view(room)
+
+
+# Background tasks to start RabbitMQ listeners, using the runtime selected
+# by the "runtime" setting in config.json
 def start_rabbitmq_listeners():
-    threading.Thread(target=listen_to_movement_updates, daemon=True).start()
-    threading.Thread(target=listen_to_turn_updates, daemon=True).start()
-    threading.Thread(target=listen_to_map_layout, daemon=True).start()
+    if use_asyncio(config):
+
+        def target():
+            asyncio.run(listen_to_rabbitmq_updates_async())
+    else:
+        target = listen_to_rabbitmq_updates
+    threading.Thread(target=target, daemon=True).start()
+    movement_coalescer.start()
 
 
 def run_launcher():
     try:
-        # Start the launcher script and capture output
+        # Start the launcher script and capture its output and errors
         process = subprocess.Popen(['python', 'launcher.py'],
                                    stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
+                                   stderr=subprocess.STDOUT)
 
         # Optionally, read the output in a separate thread to avoid blocking
         def read_output(proc):
@@ -165,6 +300,18 @@ def home():
     return render_template('index.html')
 
 
+# Throughput and lag counters for the RabbitMQ listeners
+@app.route('/listeners')
+def listener_stats():
+    return jsonify([listener.stats() for listener in listeners])
+
+
+# Counters of the movement broadcast coalescer
+@app.route('/broadcast')
+def broadcast_stats():
+    return jsonify(movement_coalescer.stats())
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
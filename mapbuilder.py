@@ -1,9 +1,23 @@
+import argparse
 import json
 import logging
-import pika
+import multiprocessing
+import threading
 from flask import Flask, jsonify, send_from_directory
 from threading import Thread
 
+from channel_pool import log_failure, pool_from_config
+from consumer import consume_forever, create_consumer
+from game_map import GameMap, update_map_cell
+from memory_broker import blocking_connection
+from messages import codec_from_config, decode, message_properties
+from metrics import LogSampler, instrument_app
+from replay import replay_map, replay_response
+from response_cache import ResponseCache
+from topology import (MOVEMENT_QUEUES, TURN_QUEUES, map_worker_queue,
+                      map_workers_from_config, topology_from_config)
+from turn_history import history_from_config
+
 logging.basicConfig(level=logging.INFO)
 
 
@@ -14,64 +28,320 @@ def load_config():
 
 
 config = load_config()
-initial_map_layout = config['map_layout']
-map_size = config['map_size']
+game_map = GameMap.from_config(config)
+codec = codec_from_config(config)
+
+# One map message is published per turn; log a sample of them
+log_sampler = LogSampler()
+log_sampler.configure(config)
+
+initial_map_layout = game_map.rows()
+map_size = game_map.size
+
+# Queue read by main.py and forwarded to browsers as 'map_update'
+MAP_QUEUE = 'map_layout'
+
+# Queue on which clients ask for a fresh keyframe
+MAP_REQUEST_QUEUE = 'map_requests'
+
+# This service's own copies of the movement and turn streams
+MOVEMENTS_QUEUE = MOVEMENT_QUEUES['mapbuilder']
+TURNS_QUEUE = TURN_QUEUES['mapbuilder']
 
 
 # Setup RabbitMQ
 def setup_rabbitmq():
-    connection = pika.BlockingConnection(
-        pika.URLParameters(config['rabbitmq_address']))
+    connection = blocking_connection(config['rabbitmq_address'])
     channel = connection.channel()
-    channel.queue_declare(queue='movement_updates', durable=True)
+    topology_from_config(config).declare(channel)
+    channel.queue_declare(queue=MAP_QUEUE, durable=True)
+    channel.queue_declare(queue=MAP_REQUEST_QUEUE, durable=True)
     return connection, channel
 
 
-# In-memory map storage
-maps_by_turn = {}
+# Pooled channel every map message is published on, set by main(). One
+# channel keeps the messages in `seq` order whichever thread publishes.
+map_channel = None
 
+# Encoded GET /map/<turn> responses, tagged "turn:<n>" and dropped when a
+# movement changes that turn
+map_cache = ResponseCache('map')
+map_cache.configure(config)
 
-# Create a fresh map layout
-def create_map_layout():
-    return [row[:] for row in initial_map_layout]
 
+def turn_tag(turn):
+    return f"turn:{turn}"
 
-# Update the map layout
-def update_map_layout(map_layout, user, x, y):
-    if map_layout[y][x] == ' ':
-        map_layout[y][x] = str(user)
-    elif isinstance(map_layout[y][x], str) and map_layout[y][x].isdigit():
-        map_layout[y][x] = 'X'
-    return map_layout
 
+# Map storage: recent turns in memory, as configured by the "map_history"
+# section of config.json. main() replaces it with a history that spills
+# older turns to disk; importing this module (loadgen, the benches) must
+# not truncate the spill file of a running map builder.
+maps_by_turn = history_from_config(config, initial_map_layout, spill=False)
 
-# Publish map
-def publish_map(channel, map_layout, turn):
-    map_message = {"turn": turn, "map": map_layout}
-    channel.basic_publish(exchange='',
-                          routing_key='position',
-                          body=json.dumps(map_message),
-                          properties=pika.BasicProperties(delivery_mode=2))
-    logging.info(f"Published map for turn {turn}")
 
+# Delta publishing settings. In "delta" mode only changed cells are sent and
+# a full keyframe goes out every `keyframe_interval` turns or on request;
+# "full" mode publishes the whole grid for every change.
+publish_settings = config.get('map_publishing', {})
+delta_mode = publish_settings.get('mode', 'delta') == 'delta'
+keyframe_interval = max(1, publish_settings.get('keyframe_interval', 10))
 
-# Handle movement updates
-def on_movement_message(ch, method, properties, body):
-    message = json.loads(body)
-    user = message['user']
-    x, y = map(int, message['location'].split(','))
-    turn = message.get('turn', 0)
+# Cells that differ from the initial layout, per turn
+dirty_cells_by_turn = {}
+
+# Turn of movements that do not carry one (moves from movement_service):
+# the turn after the last turn update received. main() creates it in
+# shared memory and hands it to the forked map workers, so they read the
+# value the parent's turn consumer sets.
+open_turn = None
+
+# Publishing state shared by the consumer threads
+map_lock = threading.Lock()
+stream = {"seq": 0, "view_turn": None, "keyframe_requested": False}
 
-    if turn not in maps_by_turn:
-        maps_by_turn[turn] = create_map_layout()
 
-    maps_by_turn[turn] = update_map_layout(maps_by_turn[turn], user, x, y)
-    publish_map(ch, maps_by_turn[turn], turn)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+# Publish map
+def publish_map(channel, map_layout, turn):
+    publish_map_message(channel, keyframe_message(map_layout, turn))
+
+
+# Publish a keyframe or delta message
+def publish_map_message(channel, map_message):
+    channel.publish(MAP_QUEUE,
+                    codec.encode(map_message),
+                    properties=message_properties(codec)).add_done_callback(
+                        log_failure)
+    log_sampler.log(map_message['type'], "Published map %s for turn %s",
+                    map_message['type'], map_message['turn'])
+
+
+def next_seq():
+    stream["seq"] += 1
+    return stream["seq"]
+
+
+# Full grid for a turn
+def keyframe_message(map_layout, turn):
+    return {
+        "type": "keyframe",
+        "seq": next_seq(),
+        "turn": turn,
+        "map": map_layout
+    }
+
+
+# Cell-level changes for a turn as [x, y, old, new] entries
+def delta_message(turn, cells):
+    return {"type": "delta", "seq": next_seq(), "turn": turn, "cells": cells}
+
+
+# Messages that move the published view to `turn`. A newer turn becomes the
+# view: clients get a keyframe when one is due, otherwise the cells dirty in
+# either turn. Changes to the current view go out as deltas; late changes to
+# older turns are not published. Must be called with map_lock held.
+def stream_messages(turn, changes):
+    view_turn = stream["view_turn"]
+    if not delta_mode:
+        if view_turn is None or turn > view_turn:
+            stream["view_turn"] = turn
+        return [keyframe_message(maps_by_turn.rows(turn), turn)]
+
+    if view_turn is not None and turn < view_turn:
+        return []
+
+    if view_turn is None or turn > view_turn:
+        stream["view_turn"] = turn
+        previous_cells = dirty_cells_by_turn.get(view_turn, set())
+        # Dirty cells are only needed to leave the current view
+        for old_turn in [t for t in dirty_cells_by_turn if t < turn]:
+            del dirty_cells_by_turn[old_turn]
+        if (view_turn is None or turn % keyframe_interval == 0
+                or stream["keyframe_requested"]):
+            stream["keyframe_requested"] = False
+            return [keyframe_message(maps_by_turn.rows(turn), turn)]
+
+        def previous(x, y):
+            if view_turn in maps_by_turn:
+                return maps_by_turn.get_cell(view_turn, x, y)
+            return maps_by_turn.base_cell(x, y)
+
+        cells = previous_cells | dirty_cells_by_turn.get(turn, set())
+        return [
+            delta_message(turn, [[
+                x, y, previous(x, y),
+                maps_by_turn.get_cell(turn, x, y)
+            ] for x, y in sorted(cells)])
+        ]
+
+    if stream["keyframe_requested"]:
+        stream["keyframe_requested"] = False
+        return [keyframe_message(maps_by_turn.rows(turn), turn)]
+    return [delta_message(turn, changes)] if changes else []
+
+
+# Handle movement updates; returns the turn and its [x, y, old, new] change,
+# or None when the cell did not change
+def on_movement_message(body, properties=None):
+    message = decode(body, properties)
+    user = message['user']
+    x, y = message['location']
+    turn = message.get('turn', open_turn.value)
+
+    if not game_map.in_bounds(x, y):
+        raise ValueError(f"Location {x},{y} is outside the map")
+
+    maps_by_turn.create(turn)
+    old = maps_by_turn.get_cell(turn, x, y)
+    new = update_map_cell(old, user)
+    if new == old:
+        return turn, None
+    maps_by_turn.set_cell(turn, x, y, new)
+    dirty_cells_by_turn.setdefault(turn, set()).add((x, y))
+    return turn, [x, y, old, new]
+
+
+# Apply a batch of movement deliveries to the map; returns the
+# [x, y, old, new] changes of every turn the batch touched
+def apply_movements(batch):
+    changes_by_turn = {}
+    for delivery in batch:
+        try:
+            turn, change = on_movement_message(delivery.body,
+                                               delivery.properties)
+        except (KeyError, ValueError, TypeError) as e:
+            logging.error(f"Skipping invalid movement message: {e}")
+            continue
+        changes = changes_by_turn.setdefault(turn, [])
+        if change is not None:
+            changes.append(change)
+    return changes_by_turn
+
+
+# Publish one message per turn of `changes_by_turn` on the pooled map
+# channel. Must be called with map_lock held, so messages go out in `seq`
+# order.
+def publish_changes(channel, changes_by_turn):
+    map_cache.invalidate(*(turn_tag(turn)
+                           for turn, changes in changes_by_turn.items()
+                           if changes))
+
+    messages = []
+    for turn in sorted(changes_by_turn):
+        messages.extend(stream_messages(turn, changes_by_turn[turn]))
+    for map_message in messages:
+        publish_map_message(channel, map_message)
+
+
+# Apply a batch of movement updates, then publish one message per changed
+# turn on the pooled map channel
+def on_movement_batch(batch, ack, channel):
+    with map_lock:
+        publish_changes(channel, apply_movements(batch))
+    ack()
+
+
+# Apply the changes computed by a map worker. Workers own disjoint regions,
+# so every cell takes the value of the one worker that updates it.
+def merge_changes(changes_by_turn):
+    for turn, changes in changes_by_turn.items():
+        maps_by_turn.create(turn)
+        for x, y, _, new in changes:
+            maps_by_turn.set_cell(turn, x, y, new)
+            dirty_cells_by_turn.setdefault(turn, set()).add((x, y))
+
+
+# Map of a worker process: its regions only, kept in memory. A movement for
+# a turn it has already evicted starts that turn again from the base layout.
+def worker_history():
+    return history_from_config(config, initial_map_layout, spill=False)
+
+
+# Entry point of map worker `worker`: it consumes the movements of its
+# regions on its own connection and sends the changes of every batch to
+# the parent, which publishes them
+def run_map_worker(worker, changes_queue, shared_open_turn):
+    global maps_by_turn, open_turn
+    maps_by_turn = worker_history()
+    open_turn = shared_open_turn
+    connection, _ = setup_rabbitmq()
+
+    def on_worker_batch(batch, ack):
+        changes_by_turn = apply_movements(batch)
+        # Changes only need tracking in the parent
+        dirty_cells_by_turn.clear()
+        if changes_by_turn:
+            changes_queue.put(changes_by_turn)
+        ack()
+
+    create_consumer(connection, map_worker_queue(worker), on_worker_batch,
+                    config).start()
+    try:
+        consume_forever(connection)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
+
+
+# Merge and publish the changes of the map workers
+def publish_worker_changes(changes_queue, channel):
+    while True:
+        changes_by_turn = changes_queue.get()
+        with map_lock:
+            merge_changes(changes_by_turn)
+            publish_changes(channel, changes_by_turn)
+
+
+# Fork `workers` map workers from `context`, sharing the open turn; returns
+# the queue of their changes. Forking starts them from this process's state
+# without importing this module again, so it must happen before any
+# connection, thread or spill file is opened.
+def start_map_workers(context, workers):
+    changes_queue = context.Queue()
+    for worker in range(workers):
+        context.Process(target=run_map_worker,
+                        args=(worker, changes_queue, open_turn),
+                        name=f"mapbuilder-worker-{worker}",
+                        daemon=True).start()
+    logging.info(f"Started {workers} map workers")
+    return changes_queue
+
+
+# Queue a keyframe of the current view, e.g. after a client missed a delta
+def request_keyframe(channel):
+    with map_lock:
+        turn = stream["view_turn"]
+        if turn not in maps_by_turn:
+            stream["keyframe_requested"] = True
+            return
+        publish_map_message(channel,
+                            keyframe_message(maps_by_turn.rows(turn), turn))
+
+
+# Advance the open turn as the turn clock ends turns
+def on_turn_batch(batch, ack):
+    for delivery in batch:
+        try:
+            turn = decode(delivery.body, delivery.properties)['turn']
+        except (KeyError, ValueError, TypeError) as e:
+            logging.error(f"Skipping invalid turn message: {e}")
+            continue
+        with open_turn.get_lock():
+            open_turn.value = max(open_turn.value, turn + 1)
+    ack()
+
+
+# Handle keyframe requests from the map_requests queue
+def on_map_request_batch(batch, ack, channel):
+    if batch:
+        request_keyframe(channel)
+    ack()
 
 
 # Flask API
 app = Flask(__name__)
+instrument_app(app)
 
 
 # Serve the index.html file for initial map load in the browser
@@ -80,27 +350,90 @@ def serve_index():
     return send_from_directory('.', 'index.html')
 
 
-# Endpoint to get map by turn
+# Endpoint to ask for a keyframe of the current map
+@app.route('/map/keyframe', methods=['POST'])
+def post_keyframe_request():
+    if map_channel is None:
+        return jsonify({"error": "Map publishing is not running"}), 503
+    request_keyframe(map_channel)
+    return jsonify({"status": "Keyframe requested"}), 202
+
+
+# Endpoint to get map by turn; turns no longer held in memory are rebuilt
+# from the movement log. Rebuilt maps are not cached: nothing invalidates
+# them while the log is still receiving the turn's movements.
 @app.route('/map/<int:turn>', methods=['GET'])
+@map_cache.cached(lambda turn: [turn_tag(turn)])
 def get_map(turn):
     if turn in maps_by_turn:
-        return jsonify({"turn": turn, "map": maps_by_turn[turn]})
-    else:
+        return jsonify({"turn": turn, "map": maps_by_turn.rows(turn)})
+    rows = replay_map(config, turn)
+    if rows is None:
         return jsonify({"error": "Map for this turn not found"}), 404
+    response = jsonify({"turn": turn, "map": rows})
+    response.cache_control.no_store = True
+    return response
 
 
-def main():
-    # Initialize RabbitMQ and set up initial map
-    connection, channel = setup_rabbitmq()
+# Stream the maps and intersections of ?from=&to= rebuilt from the movement
+# log, as NDJSON keyframes, deltas and intersection lists
+@app.route('/replay', methods=['GET'])
+def get_replay():
+    return replay_response(config)
+
 
-    # Initialize the map for turn 0
-    maps_by_turn[0] = create_map_layout()
-    publish_map(channel, maps_by_turn[0], 0)  # Publish initial map for turn 0
+# Command line options; --workers defaults to the "map_workers" section of
+# config.json
+def parse_args():
+    parser = argparse.ArgumentParser(description="Map builder service")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=map_workers_from_config(config),
+        help="processes applying movements, each owning a share of the map "
+        "regions (the other services must be configured with the same "
+        "map_workers to route movements to them)")
+    return parser.parse_args()
 
-    # Subscribe to 'movement_updates'
-    channel.basic_consume(queue='movement_updates',
-                          on_message_callback=on_movement_message,
-                          auto_ack=False)
+
+def main():
+    global map_channel, maps_by_turn, open_turn
+
+    workers = max(1, parse_args().workers)
+    if workers != map_workers_from_config(config):
+        logging.warning(f"Running {workers} map workers; config.json has "
+                        f"{map_workers_from_config(config)}")
+        config.setdefault('map_workers', {})['workers'] = workers
+    context = multiprocessing.get_context('fork')
+    open_turn = context.Value('q', 0)
+    changes_queue = (start_map_workers(context, workers)
+                     if workers > 1 else None)
+    maps_by_turn = history_from_config(config, initial_map_layout)
+
+    # Initialize RabbitMQ and set up initial map
+    connection, _ = setup_rabbitmq()
+    publisher = pool_from_config(config, queues=(MAP_QUEUE, ))
+    map_channel = publisher.channel(MAP_QUEUE)
+
+    # Initialize the map for turn 0 and publish it as the first keyframe
+    with map_lock:
+        maps_by_turn.create(0)
+        stream["view_turn"] = 0
+        publish_map(map_channel, maps_by_turn.rows(0), 0)
+
+    # Subscribe to the movement stream, or let the workers do it
+    if changes_queue is not None:
+        Thread(target=publish_worker_changes,
+               args=(changes_queue, map_channel),
+               daemon=True).start()
+    else:
+        create_consumer(
+            connection, MOVEMENTS_QUEUE, lambda batch, ack:
+            on_movement_batch(batch, ack, map_channel), config).start()
+    create_consumer(connection, TURNS_QUEUE, on_turn_batch, config).start()
+    create_consumer(
+        connection, MAP_REQUEST_QUEUE, lambda batch, ack:
+        on_map_request_batch(batch, ack, map_channel), config).start()
 
     # Start Flask API on a separate thread
     api_thread = Thread(target=app.run, kwargs={'port': 5002})
@@ -110,13 +443,15 @@ def main():
         "MapBuilder service started, listening for movement updates...")
 
     try:
-        channel.start_consuming()
+        consume_forever(connection)
     except KeyboardInterrupt:
         logging.info("MapBuilder service stopped by user.")
     finally:
+        publisher.close()
         if connection:
             connection.close()
             logging.info("RabbitMQ connection closed.")
+        maps_by_turn.close()
 
 
 if __name__ == '__main__':
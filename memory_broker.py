@@ -0,0 +1,327 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+
+import pika
+
+# rabbitmq_address selecting the process-wide in-memory broker, for running
+# the services together in one process without RabbitMQ (see loadgen.py)
+MEMORY_ADDRESS = 'memory://'
+
+# Stand-ins for the pika frames handed to consumer callbacks
+Method = namedtuple(
+    'Method',
+    ['delivery_tag', 'consumer_tag', 'exchange', 'routing_key', 'redelivered'])
+Message = namedtuple('Message',
+                     ['exchange', 'routing_key', 'properties', 'body'])
+
+
+# AMQP topic matching: words are separated by '.', '*' matches exactly one
+# word and '#' matches zero or more
+def topic_matches(pattern, routing_key):
+
+    def match(pattern_words, key_words):
+        if not pattern_words:
+            return not key_words
+        word, rest = pattern_words[0], pattern_words[1:]
+        if word == '#':
+            return any(
+                match(rest, key_words[i:]) for i in range(len(key_words) + 1))
+        return bool(key_words) and word in ('*', key_words[0]) and match(
+            rest, key_words[1:])
+
+    return match(pattern.split('.'), routing_key.split('.'))
+
+
+# In-memory stand-in for a RabbitMQ server, implementing the subset of the
+# pika BlockingConnection / BlockingChannel API the services use. It honours
+# prefetch counts, multiple acks, requeue-on-close and direct, fanout and
+# topic exchanges, so consumers can be exercised and benchmarked without a
+# broker.
+class InMemoryBroker:
+
+    def __init__(self):
+        self.queues = {}
+        # name -> (type, [(queue, binding key), ...])
+        self.exchanges = {}
+        self._condition = threading.Condition()
+
+    def connection(self):
+        return InMemoryConnection(self)
+
+    # Number of ready (undelivered) messages in a queue
+    def depth(self, queue_name):
+        with self._condition:
+            return len(self.queues.get(queue_name, ()))
+
+    def declare(self, queue_name):
+        with self._condition:
+            self.queues.setdefault(queue_name, deque())
+
+    def declare_exchange(self, exchange, exchange_type='direct'):
+        with self._condition:
+            declared = self.exchanges.setdefault(exchange, (exchange_type, []))
+            if declared[0] != exchange_type:
+                raise ValueError(f"Exchange {exchange} is declared as "
+                                 f"{declared[0]}, not {exchange_type}")
+
+    def bind(self, queue_name, exchange, routing_key=''):
+        with self._condition:
+            if exchange not in self.exchanges:
+                raise ValueError(f"Unknown exchange: {exchange}")
+            bindings = self.exchanges[exchange][1]
+            if (queue_name, routing_key) not in bindings:
+                bindings.append((queue_name, routing_key))
+
+    # Queues a message published to `exchange` with `routing_key` goes to
+    def route(self, exchange, routing_key):
+        if exchange == '':
+            return [routing_key]
+        if exchange not in self.exchanges:
+            raise ValueError(f"Unknown exchange: {exchange}")
+        exchange_type, bindings = self.exchanges[exchange]
+        if exchange_type == 'fanout':
+            matched = [queue_name for queue_name, _ in bindings]
+        elif exchange_type == 'topic':
+            matched = [
+                queue_name for queue_name, key in bindings
+                if topic_matches(key, routing_key)
+            ]
+        else:
+            matched = [
+                queue_name for queue_name, key in bindings
+                if key == routing_key
+            ]
+        # A queue bound more than once still gets one copy
+        return list(dict.fromkeys(matched))
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        with self._condition:
+            targets = self.route(exchange, routing_key)
+            for queue_name in targets:
+                if queue_name in self.queues:
+                    self.queues[queue_name].append(
+                        Message(exchange, routing_key, properties, body))
+            self._condition.notify_all()
+
+    def _requeue(self, queue_name, message):
+        with self._condition:
+            self.queues[queue_name].appendleft(message)
+            self._condition.notify_all()
+
+
+class InMemoryConnection:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self._channels = []
+        self._callbacks = deque()
+        self._channel_numbers = itertools.count(1)
+
+    def channel(self):
+        channel = InMemoryChannel(self, next(self._channel_numbers))
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        with self.broker._condition:
+            self._callbacks.append(callback)
+            self.broker._condition.notify_all()
+
+    # Deliver ready messages and run queued callbacks. With `time_limit=None`
+    # this blocks until at least one event has been processed.
+    def process_data_events(self, time_limit=0):
+        deadline = None if time_limit is None else time.monotonic(
+        ) + time_limit
+        while True:
+            with self.broker._condition:
+                callbacks = list(self._callbacks)
+                self._callbacks.clear()
+                deliveries = []
+                for channel in self._channels:
+                    deliveries.extend(channel._collect())
+                if not callbacks and not deliveries:
+                    remaining = (None if deadline is None else deadline -
+                                 time.monotonic())
+                    if remaining is not None and remaining <= 0:
+                        return
+                    self.broker._condition.wait(remaining)
+                    continue
+            for callback in callbacks:
+                callback()
+            for channel, method, properties, body, on_message in deliveries:
+                on_message(channel, method, properties, body)
+            return
+
+    def sleep(self, duration):
+        self.process_data_events(time_limit=duration)
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+        self.is_open = False
+
+
+class InMemoryChannel:
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.is_open = True
+        self._broker = connection.broker
+        self._prefetch_count = 0
+        self._consumers = OrderedDict()
+        self._unacked = OrderedDict()
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+
+    def queue_declare(self, queue, **_):
+        self._broker.declare(queue)
+
+    def exchange_declare(self, exchange, exchange_type='direct', **_):
+        self._broker.declare_exchange(exchange, exchange_type)
+
+    def queue_bind(self, queue, exchange, routing_key=None, **_):
+        self._broker.bind(queue, exchange, routing_key or '')
+
+    def basic_qos(self, prefetch_count=0, **_):
+        self._prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **_):
+        consumer_tag = f"ctag{self.channel_number}.{next(self._consumer_tags)}"
+        self._consumers[consumer_tag] = (queue, on_message_callback, auto_ack)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        self._consumers.pop(consumer_tag, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      **_):
+        self._broker.publish(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        with self._broker._condition:
+            if multiple:
+                for tag in [t for t in self._unacked if t <= delivery_tag]:
+                    del self._unacked[tag]
+            else:
+                self._unacked.pop(delivery_tag, None)
+            self._broker._condition.notify_all()
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        tags = ([t for t in self._unacked if t <= delivery_tag]
+                if multiple else [delivery_tag])
+        for tag in tags:
+            entry = self._unacked.pop(tag, None)
+            if entry is not None and requeue:
+                self._broker._requeue(*entry)
+
+    def start_consuming(self):
+        while self._consumers and self.connection.is_open:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self):
+        self._consumers.clear()
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._consumers.clear()
+        for queue_name, message in reversed(list(self._unacked.values())):
+            self._broker._requeue(queue_name, message)
+        self._unacked.clear()
+
+    # Pop deliverable messages; called with the broker lock held
+    def _collect(self):
+        deliveries = []
+        queues = self._broker.queues
+        for consumer_tag, (queue_name, on_message,
+                           auto_ack) in self._consumers.items():
+            ready = queues.get(queue_name)
+            while ready and (auto_ack or not self._prefetch_count or
+                             len(self._unacked) < self._prefetch_count):
+                message = ready.popleft()
+                tag = next(self._delivery_tags)
+                if not auto_ack:
+                    self._unacked[tag] = (queue_name, message)
+                method = Method(tag, consumer_tag, message.exchange,
+                                message.routing_key, False)
+                deliveries.append((self, method, message.properties,
+                                   message.body, on_message))
+        return deliveries
+
+
+# Stand-in for a channel_pool.ChannelPool publishing to an in-memory broker.
+# Messages are routed synchronously, so every publish future is already
+# confirmed when it is returned.
+class InMemoryPublisher:
+
+    def __init__(self, broker, queues=(), declarations=()):
+        self.broker = broker
+        self.published = 0
+        self._lock = threading.Lock()
+        channel = broker.connection().channel()
+        for queue_name in queues:
+            channel.queue_declare(queue=queue_name, durable=True)
+        for method, kwargs in declarations:
+            getattr(channel, method)(**kwargs)
+
+    # Every channel publishes straight to the broker
+    def channel(self, _name=None):
+        return self
+
+    # Never blocks, so there is no timeout to apply
+    def publish(self, routing_key, body, exchange='', properties=None,
+                _timeout=None):
+        self.broker.publish(exchange, routing_key, body, properties)
+        with self._lock:
+            self.published += 1
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def flush(self, _timeout=None):
+        return True
+
+    def stats(self):
+        return {
+            "connected": True,
+            "channels": 1,
+            "published": self.published,
+            "confirmed": self.published,
+            "nacked": 0,
+            "outstanding": 0,
+            "reconnects": 0,
+        }
+
+    def close(self, timeout=None):
+        pass
+
+
+_shared_broker = None
+_shared_broker_lock = threading.Lock()
+
+
+# The broker every service of this process uses for MEMORY_ADDRESS
+def shared_broker():
+    global _shared_broker
+    with _shared_broker_lock:
+        if _shared_broker is None:
+            _shared_broker = InMemoryBroker()
+        return _shared_broker
+
+
+def is_memory_address(address):
+    return address == MEMORY_ADDRESS
+
+
+# Blocking connection for a rabbitmq_address: RabbitMQ, or the shared
+# in-memory broker for MEMORY_ADDRESS
+def blocking_connection(address):
+    if is_memory_address(address):
+        return shared_broker().connection()
+    return pika.BlockingConnection(pika.URLParameters(address))
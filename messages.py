@@ -0,0 +1,236 @@
+import contextlib
+import json
+import struct
+import time
+from functools import lru_cache
+
+import pika
+
+try:
+    import msgpack
+except ImportError:  # Optional; JSON and binary need no extra package
+    msgpack = None
+
+# Content types used to negotiate the codec of every message
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/x-rabbit-binary'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+
+# Message schema. Producers build messages with these helpers; after decoding
+# every codec yields the same dict, with `location` as an (x, y) tuple of ints
+# and the user under 'user'.
+def movement_message(user, x, y, turn=None, timestamp=None, action=None):
+    message = {"user": user, "location": (x, y)}
+    if action is not None:
+        message["action"] = action
+    if turn is not None:
+        message["turn"] = turn
+    if timestamp is not None:
+        message["timestamp"] = timestamp
+    return message
+
+
+def turn_message(turn, **extra):
+    return {"action": "turn_update", "turn": turn, **extra}
+
+
+# Seconds between a turn's scheduled start ('epoch') and now, or None for
+# turns from clocks that do not send it
+def turn_lag(message, now=None):
+    epoch = message.get('epoch')
+    if epoch is None:
+        return None
+    return (time.time() if now is None else now) - epoch
+
+
+# Whether a turn update for `turn`, started at `epoch`, comes from a
+# restarted turn clock, given the (turn, epoch) of the latest update seen
+# (None before the first). A restarted clock numbers turns from 0 again; a
+# redelivered update of an earlier turn started before the latest one.
+def is_clock_restart(latest, turn, epoch):
+    if latest is None or turn >= latest[0]:
+        return False
+    latest_epoch = latest[1]
+    return epoch is None or latest_epoch is None or epoch > latest_epoch
+
+
+# "x,y" text, as stored in the databases, to an (x, y) tuple
+def parse_location(text):
+    x, y = text.split(',')
+    return int(x), int(y)
+
+
+def format_location(location):
+    return f"{location[0]},{location[1]}"
+
+
+# Bring a decoded dict to the schema above. Older producers sent 'user_id'
+# and string locations.
+def normalize(message):
+    if 'user_id' in message and 'user' not in message:
+        message['user'] = message.pop('user_id')
+    location = message.get('location')
+    if isinstance(location, str):
+        # Anything other than a single cell, e.g. "x1,y1;x2,y2", stays text
+        with contextlib.suppress(ValueError):
+            message['location'] = parse_location(location)
+    elif isinstance(location, list):
+        message['location'] = tuple(location)
+    return message
+
+
+# JSON, the format every service spoke before codecs were pluggable.
+# Locations stay "x,y" strings on the wire for older consumers.
+class JsonCodec:
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, message):
+        location = message.get('location')
+        if isinstance(location, (tuple, list)):
+            message = dict(message, location=format_location(location))
+        return json.dumps(message, separators=(',', ':')).encode()
+
+    def decode(self, body):
+        message = json.loads(body)
+        if not isinstance(message, dict):
+            raise ValueError("Message is not a JSON object")
+        return normalize(message)
+
+
+# Compact binary format. Movements and turn updates are fixed-size structs
+# with integer coordinates and timestamps, followed by the UTF-8 user name
+# for movements; anything else (map keyframes and deltas, movements with a
+# float timestamp) is JSON behind a one-byte tag.
+class BinaryCodec:
+    content_type = BINARY_CONTENT_TYPE
+
+    OTHER, MOVEMENT, TURN = 0, 1, 2
+    # kind, flags, action, x, y, turn, timestamp
+    MOVEMENT_HEADER = struct.Struct('<BBBiiiq')
+    # kind, flags, turn, epoch
+    TURN_HEADER = struct.Struct('<BBqd')
+    ACTIONS = (None, 'login', 'move')
+    MOVEMENT_KEYS = {'user', 'location', 'turn', 'timestamp', 'action'}
+    TURN_KEYS = {'action', 'turn', 'epoch'}
+    HAS_TURN, HAS_TIMESTAMP, HAS_EPOCH = 1, 2, 4
+
+    def _is_movement(self, message):
+        location = message.get('location')
+        return (message.keys() <= self.MOVEMENT_KEYS
+                and isinstance(message.get('user'), str)
+                and isinstance(location, (tuple, list))
+                and isinstance(message.get('turn', 0), int)
+                and isinstance(message.get('timestamp', 0), int)
+                and message.get('action') in self.ACTIONS)
+
+    def _is_turn(self, message):
+        return (message.get('action') == 'turn_update'
+                and message.keys() <= self.TURN_KEYS
+                and isinstance(message.get('turn'), int))
+
+    def encode(self, message):
+        if self._is_movement(message):
+            flags = ((self.HAS_TURN if 'turn' in message else 0)
+                     | (self.HAS_TIMESTAMP if 'timestamp' in message else 0))
+            x, y = message['location']
+            return self.MOVEMENT_HEADER.pack(
+                self.MOVEMENT, flags,
+                self.ACTIONS.index(message.get('action')), x, y,
+                message.get('turn', 0), message.get('timestamp', 0)
+            ) + message['user'].encode()
+        if self._is_turn(message):
+            flags = self.HAS_EPOCH if 'epoch' in message else 0
+            return self.TURN_HEADER.pack(self.TURN, flags, message['turn'],
+                                         message.get('epoch', 0))
+        location = message.get('location')
+        if isinstance(location, tuple):
+            message = dict(message, location=list(location))
+        return bytes((self.OTHER, )) + json.dumps(
+            message, separators=(',', ':')).encode()
+
+    def decode(self, body):
+        if not body:
+            raise ValueError("Empty binary message")
+        try:
+            kind = body[0]
+            if kind == self.MOVEMENT:
+                (_, flags, action, x, y, turn,
+                 timestamp) = self.MOVEMENT_HEADER.unpack_from(body)
+                return movement_message(
+                    bytes(body[self.MOVEMENT_HEADER.size:]).decode(), x, y,
+                    turn if flags & self.HAS_TURN else None,
+                    timestamp if flags & self.HAS_TIMESTAMP else None,
+                    self.ACTIONS[action])
+            if kind == self.TURN:
+                _, flags, turn, epoch = self.TURN_HEADER.unpack_from(body)
+                if flags & self.HAS_EPOCH:
+                    return turn_message(turn, epoch=epoch)
+                return turn_message(turn)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed binary message: {e}") from e
+        if kind == self.OTHER:
+            return normalize(json.loads(body[1:]))
+        raise ValueError(f"Unknown binary message kind {kind}")
+
+
+# msgpack, when the package is installed
+class MsgpackCodec:
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def encode(self, message):
+        return msgpack.packb(message)
+
+    def decode(self, body):
+        try:
+            message = msgpack.unpackb(body)
+        except Exception as e:
+            raise ValueError(f"Malformed msgpack message: {e}") from e
+        if not isinstance(message, dict):
+            raise ValueError("Message is not a map")
+        return normalize(message)
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+CODECS = {
+    JSON_CONTENT_TYPE: JSON_CODEC,
+    BINARY_CONTENT_TYPE: BINARY_CODEC,
+}
+CODEC_NAMES = {'json': JSON_CODEC, 'binary': BINARY_CODEC}
+if msgpack is not None:
+    CODECS[MSGPACK_CONTENT_TYPE] = CODEC_NAMES['msgpack'] = MsgpackCodec()
+
+
+# Codec selected by the "message_codec" setting of config.json
+def codec_from_config(config):
+    name = config.get('message_codec', 'json')
+    if name not in CODEC_NAMES:
+        raise ValueError(f"Unknown message codec '{name}'; available: "
+                         f"{', '.join(sorted(CODEC_NAMES))}")
+    return CODEC_NAMES[name]
+
+
+# Codec from config.json, read once per process
+@lru_cache(maxsize=None)
+def load_codec(path='config.json'):
+    with open(path) as f:
+        return codec_from_config(json.load(f))
+
+
+# Properties carrying the codec's content type; persistent by default
+def message_properties(codec, delivery_mode=2, **kwargs):
+    return pika.BasicProperties(content_type=codec.content_type,
+                                delivery_mode=delivery_mode,
+                                **kwargs)
+
+
+# Decode a body using the codec named by its content_type. Messages without
+# one are JSON, which is what producers sent before codecs existed.
+def decode(body, properties=None):
+    content_type = getattr(properties, 'content_type', None)
+    codec = CODECS.get(content_type or JSON_CONTENT_TYPE)
+    if codec is None:
+        raise ValueError(f"Unsupported content type '{content_type}'")
+    return codec.decode(body)
@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets in seconds, 0.5 ms to 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DEFAULT_LOG_SAMPLE_EVERY = 1000
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values, strict=True)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+class _CounterValue:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeValue(_CounterValue):
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # Observe the duration of a `with` block
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+# A named metric with one value per combination of label values. Hot paths
+# should look up their labelled value once with labels() and keep it.
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(labels[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = self._new_value()
+            return value
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._items():
+            lines.append(f"{self.name}"
+                         f"{_format_labels(self.labelnames, key)} "
+                         f"{_format_value(value.value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._items():
+            counts, total, count = value.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'), ),
+                                           counts,
+                                           strict=True):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key,
+                                        [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# The metrics of one process. Declaring a metric that already exists returns
+# the existing one, so modules loaded into the same process (main.py imports
+# auth and report_service) can share metric names.
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+        if type(existing) is not type(metric):
+            raise ValueError(f"Metric {metric.name} is already registered "
+                             f"as a {existing.kind}")
+        return existing
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(),
+                             key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labelnames=()):
+    return REGISTRY.register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, labelnames=()):
+    return REGISTRY.register(Gauge(name, help_text, labelnames))
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labelnames, buckets))
+
+
+REQUEST_SECONDS = histogram('http_request_seconds',
+                            "Time to handle an HTTP request",
+                            ['endpoint', 'status'])
+
+
+# Flask response with every metric of this process, for a /metrics route
+def metrics_response():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+# Time every request of a Flask app and serve the registry on /metrics
+def instrument_app(app):
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.get('request_started')
+        if started is not None:
+            REQUEST_SECONDS.labels(request.endpoint or 'unmatched',
+                                   response.status_code).observe(
+                                       time.perf_counter() - started)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_response)
+
+
+# Logging for per-message events: only the first of every `every` calls
+# with the same key is logged, with the number of calls it stands for.
+# Arguments are %-formatted only for the lines that are written.
+class LogSampler:
+
+    def __init__(self, every=DEFAULT_LOG_SAMPLE_EVERY, level=logging.INFO):
+        self.every = max(1, every)
+        self.level = level
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def log(self, key, message, *args):
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+        if (count - 1) % self.every == 0:
+            logging.log(self.level, message + " (%d so far)", *args, count)
+
+    # Apply the "metrics" section of config.json
+    def configure(self, config):
+        self.every = max(
+            1,
+            config.get('metrics', {}).get('log_sample_every', self.every))
@@ -0,0 +1,571 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from messages import (
+    BINARY_CODEC,
+    BinaryCodec,
+    is_clock_restart,
+    movement_message,
+    turn_message,
+)
+from metrics import counter
+
+DEFAULT_PATH = 'movement_log'
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SNAPSHOT_EVERY = 100
+DEFAULT_KEEP_SNAPSHOTS = 8
+
+SEGMENT_MAGIC = b'MVLOG001'
+SNAPSHOT_MAGIC = b'MVSNAP01'
+# Payload length and CRC32 in front of every record
+FRAME = struct.Struct('<HI')
+MAX_PAYLOAD = 0xFFFF
+# turn, segment, offset, users
+SNAPSHOT_HEADER = struct.Struct('<qqqq')
+# x, y, user name length
+SNAPSHOT_ENTRY = struct.Struct('<iiH')
+
+MOVEMENT = BinaryCodec.MOVEMENT
+TURN = BinaryCodec.TURN
+_MOVEMENT_HEADER = BinaryCodec.MOVEMENT_HEADER
+_TURN_HEADER = BinaryCodec.TURN_HEADER
+
+RECORDS = counter('movement_log_records_total',
+                  "Records appended to the movement log", ['kind'])
+
+# A movement, or the end of a turn (kind TURN: user, x and y are None and
+# timestamp is the turn's epoch)
+LogRecord = namedtuple('LogRecord',
+                       ['kind', 'turn', 'user', 'x', 'y', 'timestamp',
+                        'action'])
+# Where a record starts: segment number and byte offset in it
+LogPosition = namedtuple('LogPosition', ['segment', 'offset'])
+
+
+# File names carry the clock epoch after the number; epoch 0 keeps the plain
+# number
+def _file_name(number, clock_epoch, suffix):
+    if clock_epoch == 0:
+        return f"{number:010d}{suffix}"
+    return f"{number:010d}-{clock_epoch:06d}{suffix}"
+
+
+# Number and clock epoch of a segment or snapshot file name
+def _parse_file_name(name, suffix):
+    number, _, clock_epoch = name[:-len(suffix)].partition('-')
+    return int(number), int(clock_epoch or 0)
+
+
+# Records of a segment's bytes from `offset`, as (offset, end, payload);
+# stops at the first truncated or corrupt record
+def _frames(buffer, offset, size):
+    while offset + FRAME.size <= size:
+        length, crc = FRAME.unpack_from(buffer, offset)
+        start = offset + FRAME.size
+        end = start + length
+        if length == 0 or end > size:
+            return
+        payload = buffer[start:end]
+        if zlib.crc32(payload) != crc:
+            return
+        yield offset, end, payload
+        offset = end
+
+
+def _parse(payload):
+    kind = payload[0]
+    if kind == MOVEMENT:
+        (_, flags, action, x, y, turn,
+         timestamp) = _MOVEMENT_HEADER.unpack_from(payload)
+        return LogRecord(
+            MOVEMENT, turn, payload[_MOVEMENT_HEADER.size:].decode(),
+            x, y, timestamp if flags & BinaryCodec.HAS_TIMESTAMP else None,
+            BinaryCodec.ACTIONS[action])
+    _, flags, turn, epoch = _TURN_HEADER.unpack_from(payload)
+    return LogRecord(TURN, turn, None, None, None,
+                     epoch if flags & BinaryCodec.HAS_EPOCH else None, None)
+
+
+# Append-only movement log. Records are BinaryCodec movement and turn
+# messages, each framed by its length and CRC32, in numbered segment files
+# of at most `segment_bytes`. Movements carry the turn they were made in
+# (the turn after the last ended one when they come without one); end_turn()
+# appends a marker closing a turn. A restarted turn clock numbers turns from
+# 0 again, so the log counts clock epochs: a turn end numbered below the last
+# one but started after it begins a new epoch in a new segment, and segment
+# and snapshot names carry their epoch. Every `snapshot_every` turns the
+# positions of all users are written to a snapshot, so positions at any
+# turn are rebuilt from the nearest snapshot plus a sequential read of the
+# records after it. A sealed segment gets a .idx file with its turn range,
+# so replays skip segments outside the turns they ask for.
+#
+# One process appends; others open the log with readonly=True.
+class MovementLog:
+
+    def __init__(self,
+                 path=DEFAULT_PATH,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 snapshot_every=DEFAULT_SNAPSHOT_EVERY,
+                 keep_snapshots=DEFAULT_KEEP_SNAPSHOTS,
+                 fsync=False,
+                 readonly=False):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.snapshot_every = max(1, snapshot_every)
+        self.keep_snapshots = max(1, keep_snapshots)
+        self.fsync = fsync
+        self.readonly = readonly
+        self.snapshot_dir = os.path.join(path, 'snapshots')
+        self.open_turn = 0
+        self.clock_epoch = 0
+        self.positions = {}
+        self._segments = {}
+        self._epochs = {}
+        # (turn, epoch) of the latest turn end of the current clock epoch
+        self._last_end = None
+        self._file = None
+        self._lock = threading.RLock()
+        if not readonly:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+        self._load()
+
+    # Segment numbers with their (min turn, max turn, bytes); the turn range
+    # of the segment being appended to is None in a read-only log
+    def _load(self):
+        if os.path.isdir(self.path):
+            self._epochs = dict(
+                _parse_file_name(name, '.seg')
+                for name in os.listdir(self.path) if name.endswith('.seg'))
+        segments = sorted(self._epochs)
+        for segment in segments[:-1]:
+            self._enter_epoch(self._epochs[segment])
+            self._segments[segment] = self._read_index(segment)
+        if segments:
+            last = segments[-1]
+            self._enter_epoch(self._epochs[last])
+            if self.readonly:
+                self._segments[last] = None
+            else:
+                self._segments[last] = self._recover(last)
+        if not self.readonly:
+            if not segments:
+                self._start_segment(0, 0)
+            else:
+                # Kept open for appending until close()
+                self._file = open(  # noqa: SIM115
+                    self._segment_path(segments[-1]), 'ab')
+            self._rebuild_positions()
+
+    # Continue in `clock_epoch`, whose turns are numbered from 0 again
+    def _enter_epoch(self, clock_epoch):
+        if clock_epoch != self.clock_epoch:
+            self.clock_epoch = clock_epoch
+            self.open_turn = 0
+            self._last_end = None
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path,
+                            _file_name(segment, self._epochs[segment], '.seg'))
+
+    def _index_path(self, segment):
+        return os.path.join(self.path, f"{segment:010d}.idx")
+
+    def _read_index(self, segment):
+        try:
+            with open(self._index_path(segment)) as f:
+                index = json.load(f)
+            self.open_turn = max(self.open_turn, index['open_turn'])
+            if index.get('last_end') is not None:
+                self._last_end = tuple(index['last_end'])
+            return [index['min_turn'], index['max_turn'], index['bytes']]
+        except (OSError, ValueError, KeyError):
+            return self._scan(segment)
+
+    # Turn range and valid length of a segment, read from its records
+    def _scan(self, segment):
+        min_turn = max_turn = None
+        end = len(SEGMENT_MAGIC)
+        with self._map(segment) as buffer:
+            if buffer is not None:
+                for _, frame_end, payload in _frames(buffer, end,
+                                                     len(buffer)):
+                    end = frame_end
+                    record = _parse(payload)
+                    if min_turn is None or record.turn < min_turn:
+                        min_turn = record.turn
+                    if max_turn is None or record.turn > max_turn:
+                        max_turn = record.turn
+                    if record.kind == TURN:
+                        self._ended(record.turn, record.timestamp)
+        return [min_turn, max_turn, end]
+
+    # Drop a torn record left at the end of the last segment by a crash
+    def _recover(self, segment):
+        state = self._scan(segment)
+        path = self._segment_path(segment)
+        if os.path.getsize(path) != state[2]:
+            logging.warning(f"Truncating {path} to its last complete record "
+                            f"at {state[2]} bytes")
+            with open(path, 'r+b') as f:
+                f.truncate(state[2])
+        return state
+
+    def _start_segment(self, segment, clock_epoch):
+        self._epochs[segment] = clock_epoch
+        # Kept open for appending until _roll() or close()
+        self._file = open(self._segment_path(segment), 'wb')  # noqa: SIM115
+        self._file.write(SEGMENT_MAGIC)
+        self._segments[segment] = [None, None, len(SEGMENT_MAGIC)]
+
+    def _current_segment(self):
+        return max(self._segments)
+
+    # Write the turn range of the current segment and continue in a new one
+    # of `clock_epoch` (the current one when None)
+    def _roll(self, clock_epoch=None):
+        segment = self._current_segment()
+        self._file.close()
+        min_turn, max_turn, size = self._segments[segment]
+        with open(self._index_path(segment), 'w') as f:
+            json.dump({
+                "min_turn": min_turn,
+                "max_turn": max_turn,
+                "bytes": size,
+                "open_turn": self.open_turn,
+                "last_end": self._last_end
+            }, f)
+        self._start_segment(
+            segment + 1,
+            self.clock_epoch if clock_epoch is None else clock_epoch)
+
+    def _append(self, payload, turn):
+        frame = FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        segment = self._current_segment()
+        state = self._segments[segment]
+        if (state[2] + len(frame) > self.segment_bytes
+                and state[2] > len(SEGMENT_MAGIC)):
+            self._roll()
+            segment = self._current_segment()
+            state = self._segments[segment]
+        self._file.write(frame)
+        state[2] += len(frame)
+        if state[0] is None or turn < state[0]:
+            state[0] = turn
+        if state[1] is None or turn > state[1]:
+            state[1] = turn
+
+    # Append a movement; `turn` defaults to the turn after the last ended one
+    # Raises ValueError for a movement that has no fixed-size binary record
+    # (e.g. a float timestamp) or does not fit in one frame.
+    def append(self, user, x, y, turn=None, timestamp=None, action=None):
+        with self._lock:
+            if turn is None:
+                turn = self.open_turn
+            try:
+                payload = BINARY_CODEC.encode(
+                    movement_message(user, x, y, turn, timestamp, action))
+            except struct.error as e:
+                raise ValueError(f"Movement cannot be logged: {e}") from e
+            if payload[0] != MOVEMENT:
+                raise ValueError("Movement cannot be logged: fields out of "
+                                 "the binary record's range")
+            if len(payload) > MAX_PAYLOAD:
+                raise ValueError(f"Movement cannot be logged: record of "
+                                 f"{len(payload)} bytes")
+            self._append(payload, turn)
+            self.positions[user] = (x, y)
+        RECORDS.labels('movement').inc()
+
+    # Record the end of `turn`, started at `epoch`, in the current clock
+    # epoch
+    def _ended(self, turn, epoch):
+        self.open_turn = max(self.open_turn, turn + 1)
+        if self._last_end is None or turn >= self._last_end[0]:
+            self._last_end = (turn, epoch)
+
+    # Append the end of `turn`, writing a snapshot every `snapshot_every`
+    # turns
+    def end_turn(self, turn, epoch=None):
+        with self._lock:
+            if is_clock_restart(self._last_end, turn, epoch):
+                logging.info(f"Turn clock restarted at turn {turn}; starting "
+                             f"clock epoch {self.clock_epoch + 1}")
+                self._roll(self.clock_epoch + 1)
+                self._enter_epoch(self.clock_epoch + 1)
+            extra = {} if epoch is None else {"epoch": epoch}
+            self._append(BINARY_CODEC.encode(turn_message(turn, **extra)),
+                         turn)
+            self._ended(turn, epoch)
+            if turn % self.snapshot_every == 0:
+                self.flush()
+                self._write_snapshot(turn)
+        RECORDS.labels('turn').inc()
+
+    # Hand appended records to the OS (and the disk with fsync); call before
+    # acknowledging the messages they came from
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self.flush()
+                self._file.close()
+                self._file = None
+
+    # Position just past the last record
+    def end_position(self):
+        segment = self._current_segment()
+        return LogPosition(segment, self._segments[segment][2])
+
+    def _write_snapshot(self, turn):
+        position = self.end_position()
+        parts = [
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_HEADER.pack(turn, position.segment, position.offset,
+                                 len(self.positions))
+        ]
+        for user, (x, y) in self.positions.items():
+            name = user.encode()
+            parts.append(SNAPSHOT_ENTRY.pack(x, y, len(name)) + name)
+        path = self._snapshot_path(self.clock_epoch, turn)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(parts))
+        os.replace(path + '.tmp', path)
+        for old in self._snapshots()[:-self.keep_snapshots]:
+            os.remove(self._snapshot_path(*old))
+
+    def _snapshot_path(self, clock_epoch, turn):
+        return os.path.join(self.snapshot_dir,
+                            _file_name(turn, clock_epoch, '.snap'))
+
+    # (clock epoch, turn) of every snapshot, oldest first
+    def _snapshots(self):
+        if not os.path.isdir(self.snapshot_dir):
+            return []
+        return sorted(
+            tuple(reversed(_parse_file_name(name, '.snap')))
+            for name in os.listdir(self.snapshot_dir)
+            if name.endswith('.snap'))
+
+    # The latest snapshot at or before `turn` of `clock_epoch` (the current
+    # one when None), or of an earlier epoch, as (turn, LogPosition,
+    # positions); the latest of all when `turn` is None. None without one.
+    def snapshot(self, turn=None, clock_epoch=None):
+        if clock_epoch is None:
+            clock_epoch = self.clock_epoch
+        for snapshot_epoch, snapshot_turn in reversed(self._snapshots()):
+            if turn is not None and (snapshot_epoch,
+                                     snapshot_turn) > (clock_epoch, turn):
+                continue
+            path = self._snapshot_path(snapshot_epoch, snapshot_turn)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if not data.startswith(SNAPSHOT_MAGIC):
+                    raise ValueError("bad magic")
+                offset = len(SNAPSHOT_MAGIC)
+                _, segment, segment_offset, count = (
+                    SNAPSHOT_HEADER.unpack_from(data, offset))
+                offset += SNAPSHOT_HEADER.size
+                positions = {}
+                for _ in range(count):
+                    x, y, length = SNAPSHOT_ENTRY.unpack_from(data, offset)
+                    offset += SNAPSHOT_ENTRY.size
+                    positions[data[offset:offset + length].decode()] = (x, y)
+                    offset += length
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning(f"Skipping unreadable snapshot {path}: {e}")
+                continue
+            if segment in self._segments:
+                return (snapshot_turn, LogPosition(segment, segment_offset),
+                        positions)
+        return None
+
+    def _rebuild_positions(self):
+        snapshot = self.snapshot()
+        start = None
+        if snapshot is not None:
+            _, start, self.positions = snapshot
+        for record in self.records(start):
+            if record.kind == MOVEMENT:
+                self.positions[record.user] = (record.x, record.y)
+
+    # Map a segment read-only for the duration of a `with` block; yields
+    # None for an empty file
+    def _map(self, segment):
+        return _SegmentMap(self._segment_path(segment))
+
+    # Every record from `start` (the beginning of the log when None) in
+    # append order, read sequentially from memory-mapped segments, only
+    # from segments of `clock_epoch` unless it is None. Segments whose turn
+    # range lies outside [from_turn, to_turn] are skipped without being read.
+    def records(self, start=None, from_turn=None, to_turn=None,
+                clock_epoch=None):
+        for _, record in self._records(start, from_turn, to_turn,
+                                       clock_epoch):
+            yield record
+
+    # records() as (clock epoch, record)
+    def _records(self, start=None, from_turn=None, to_turn=None,
+                 clock_epoch=None):
+        if not self.readonly:
+            self.flush()
+        for segment in sorted(self._segments):
+            if start is not None and segment < start.segment:
+                continue
+            segment_epoch = self._epochs[segment]
+            if clock_epoch is not None and segment_epoch != clock_epoch:
+                continue
+            state = self._segments[segment]
+            if state is not None and state[0] is None:
+                continue
+            if state is not None and (
+                    (from_turn is not None and state[1] < from_turn) or
+                    (to_turn is not None and state[0] > to_turn)):
+                continue
+            offset = len(SEGMENT_MAGIC)
+            if start is not None and segment == start.segment:
+                offset = start.offset
+            with self._map(segment) as buffer:
+                if buffer is None:
+                    continue
+                size = len(buffer) if state is None else min(
+                    len(buffer), state[2])
+                for _, _, payload in _frames(buffer, offset, size):
+                    record = _parse(payload)
+                    if from_turn is not None and record.turn < from_turn:
+                        continue
+                    if to_turn is not None and record.turn > to_turn:
+                        continue
+                    yield segment_epoch, record
+
+    # Movements and turn ends whose turn lies in [from_turn, to_turn] of
+    # `clock_epoch`, the current one when None
+    def replay(self, from_turn=None, to_turn=None, clock_epoch=None):
+        if clock_epoch is None:
+            clock_epoch = self.clock_epoch
+        return self.records(None, from_turn, to_turn, clock_epoch)
+
+    # Positions of every user at the end of `turn` of `clock_epoch` (the
+    # current one when None): the nearest snapshot plus the records after it
+    # up to the end of that turn. Positions carry over a clock restart.
+    def positions_at(self, turn, clock_epoch=None):
+        if clock_epoch is None:
+            clock_epoch = self.clock_epoch
+        snapshot = self.snapshot(turn, clock_epoch)
+        if snapshot is None:
+            start, positions = None, {}
+        else:
+            _, start, positions = snapshot
+            positions = dict(positions)
+        for segment_epoch, record in self._records(start):
+            if segment_epoch > clock_epoch or (
+                    segment_epoch == clock_epoch and record.kind == TURN
+                    and record.turn >= turn):
+                break
+            if segment_epoch == clock_epoch and record.turn > turn:
+                continue
+            if record.kind == MOVEMENT:
+                positions[record.user] = (record.x, record.y)
+        return positions
+
+    # Sizes, and turn range and snapshots of the current clock epoch; a
+    # read-only log does not know the turn range of the segment being
+    # appended to, and tracks no positions
+    def stats(self):
+        with self._lock:
+            sealed = [
+                state for segment, state in self._segments.items()
+                if state is not None and state[0] is not None
+                and self._epochs[segment] == self.clock_epoch
+            ]
+            stats = {
+                "segments": len(self._segments),
+                "clock_epoch": self.clock_epoch,
+                "first_turn": min((state[0] for state in sealed),
+                                  default=None),
+                "last_turn": max((state[1] for state in sealed),
+                                 default=None),
+                "snapshots": [
+                    turn for clock_epoch, turn in self._snapshots()
+                    if clock_epoch == self.clock_epoch
+                ]
+            }
+            if not self.readonly:
+                stats["bytes"] = sum(state[2]
+                                     for state in self._segments.values())
+                stats["open_turn"] = self.open_turn
+                stats["users"] = len(self.positions)
+            return stats
+
+
+# Read-only memory map of a segment file, closed with the `with` block
+class _SegmentMap:
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mmap = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'rb')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            return None
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        return self._mmap
+
+    def __exit__(self, *exc):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+# Movement log for the "movement_log" section of config.json
+def log_from_config(config, readonly=False):
+    settings = config.get('movement_log', {})
+    return MovementLog(
+        settings.get('path', DEFAULT_PATH),
+        segment_bytes=settings.get('segment_bytes', DEFAULT_SEGMENT_BYTES),
+        snapshot_every=settings.get('snapshot_every', DEFAULT_SNAPSHOT_EVERY),
+        keep_snapshots=settings.get('keep_snapshots', DEFAULT_KEEP_SNAPSHOTS),
+        fsync=settings.get('fsync', False),
+        readonly=readonly)
+
+
+# Summary of the log, and the time to rebuild positions at a turn
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect the movement log and rebuild positions from it")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--turn', type=int,
+                        help="rebuild the positions at the end of this turn")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    movement_log = log_from_config(config, readonly=True)
+    print(json.dumps(movement_log.stats(), indent=2))
+    if args.turn is not None:
+        started = time.perf_counter()
+        positions = movement_log.positions_at(args.turn)
+        print(f"{len(positions)} positions at the end of turn {args.turn} "
+              f"rebuilt in {time.perf_counter() - started:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,33 @@
+import datetime
 import json
 import logging
-import random
-import sqlite3
-import pika
+import threading
 from flask import Flask, jsonify, request
 
+from channel_pool import log_failure, pool_from_config
+from consumer import consume_forever, create_consumer
+from db import Database
+from db_writer import writer_from_config
+from game_map import GameMap
+from memory_broker import blocking_connection
+from messages import (codec_from_config, decode, message_properties,
+                      movement_message)
+from metrics import LogSampler, counter, instrument_app
+from movement_log import log_from_config
+from position_cache import PositionCache
+from topology import (MOVEMENT_QUEUES, MOVEMENTS_EXCHANGE, TURN_QUEUES,
+                      topology_from_config)
+
 logging.basicConfig(level=logging.INFO)
 
-# Flask app for handling HTTP requests
+# Flask app for handling HTTP requests, with request timings on /metrics
 app = Flask(__name__)
+instrument_app(app)
+
+MOVES = counter('moves_total', "Moves handled by movement_service",
+                ['result'])
+MOVES_ACCEPTED = MOVES.labels('accepted')
+MOVES_REJECTED = MOVES.labels('rejected')
 
 
 # Load configuration and map
@@ -18,94 +37,162 @@ def load_config():
 
 
 config = load_config()
-map_layout = config['map_layout']
-map_size = (len(map_layout[0]), len(map_layout))
+game_map = GameMap.from_config(config)
+codec = codec_from_config(config)
+
+# Per-move log lines are sampled; counts are in the metrics
+log_sampler = LogSampler()
+log_sampler.configure(config)
+
+# Upper bound on the number of moves accepted by one /moves request
+max_batch_moves = config.get('max_batch_moves', 10000)
+
+# Movements are published to the movements exchange, routed by map region;
+# this service keeps its own copy of the movement and turn streams for the
+# movement log
+topology = topology_from_config(config)
+HISTORY_QUEUE = MOVEMENT_QUEUES['history']
+HISTORY_TURNS_QUEUE = TURN_QUEUES['history']
 
 
 # RabbitMQ setup for publishing and subscribing to movements
 def setup_rabbitmq():
-    connection = pika.BlockingConnection(
-        pika.URLParameters(config['rabbitmq_address']))
+    connection = blocking_connection(config['rabbitmq_address'])
     channel = connection.channel()
-    channel.queue_declare(queue='movement_updates', durable=True)
+    topology.declare(channel)
     return connection, channel
 
 
 connection, channel = setup_rabbitmq()
 
-
-# Database setup for tracking user positions
-def setup_database():
-    conn = sqlite3.connect('movements.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_positions (
-            user_id TEXT PRIMARY KEY,
-            x INTEGER,
-            y INTEGER
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS movement_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            x INTEGER,
-            y INTEGER,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    return conn
-
+# Request threads publish through the pool; `connection` only consumes
+# history
+publisher = pool_from_config(config,
+                             declarations=topology.declarations())
+
+
+# Tables for tracking user positions and movement history
+TABLE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS user_positions (
+        user_id TEXT PRIMARY KEY,
+        x INTEGER,
+        y INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS movement_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        x INTEGER,
+        y INTEGER,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+]
 
 # Function to publish updates to RabbitMQ
-def publish_update(channel, user_id, x, y):
-    message = {
-        "user_id": user_id,
-        "location": f"{x},{y}",
-        "timestamp": int(datetime.datetime.now().timestamp())
-    }
-    channel.basic_publish(exchange='',
-                          routing_key='movement_updates',
-                          body=json.dumps(message),
-                          properties=pika.BasicProperties(delivery_mode=2))
-    logging.info(f"Published movement for user {user_id} to {x}, {y}")
-
-
-# Function to save movement to local database
-def save_movement_to_db(conn, user_id, x, y):
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO movement_history (user_id, x, y) VALUES (?, ?, ?)',
-        (user_id, x, y))
-    conn.commit()
-
-
-# Function to handle historical data
-def check_and_store_historical_data(conn):
-    cursor = conn.cursor()
-    for method_frame, properties, body in channel.consume(
-            'movement_updates', inactivity_timeout=1):
-        if body:
-            message = json.loads(body)
-            user_id = message['user_id']
-            x, y = map(int, message['location'].split(','))
-            cursor.execute(
-                'SELECT COUNT(*) FROM movement_history WHERE user_id = ? AND x = ? AND y = ?',
-                (user_id, x, y))
-            if cursor.fetchone(
-            )[0] == 0:  # If this position is not already in history
-                save_movement_to_db(conn, user_id, x, y)
-            channel.basic_ack(method_frame.delivery_tag)
-
-
-# Assign a random starting location within map bounds
+def publish_update(publisher, user_id, x, y):
+    message = movement_message(
+        user_id, x, y, timestamp=int(datetime.datetime.now().timestamp()))
+    publisher.publish(topology.routing_key(x, y),
+                      codec.encode(message),
+                      exchange=MOVEMENTS_EXCHANGE,
+                      properties=message_properties(codec)).add_done_callback(
+                          log_failure)
+    log_sampler.log('published', "Published movement for user %s to %s, %s",
+                    user_id, x, y)
+
+
+# Publish many updates back to back; confirms arrive asynchronously, so up
+# to the pool's confirm window of messages are in flight at once
+def publish_updates(publisher, updates):
+    timestamp = int(datetime.datetime.now().timestamp())
+    properties = message_properties(codec)
+    for user_id, x, y in updates:
+        message = movement_message(user_id, x, y, timestamp=timestamp)
+        publisher.publish(topology.routing_key(x, y),
+                          codec.encode(message),
+                          exchange=MOVEMENTS_EXCHANGE,
+                          properties=properties).add_done_callback(log_failure)
+    log_sampler.log('published_batch', "Published %d movements",
+                    len(updates))
+
+
+# Append a batch of movements to the movement log; the batch is acked once
+# the log has been flushed
+def on_history_batch(batch, ack, movement_log):
+    for delivery in batch:
+        try:
+            message = decode(delivery.body, delivery.properties)
+            x, y = message['location']
+            movement_log.append(message['user'], x, y, message.get('turn'),
+                                message.get('timestamp'),
+                                message.get('action'))
+        except (KeyError, ValueError, TypeError) as e:
+            logging.error(f"Skipping invalid movement message: {e}")
+    movement_log.flush()
+    ack()
+
+
+# Close turns in the movement log as the turn clock ends them
+def on_history_turn_batch(batch, ack, movement_log):
+    for delivery in batch:
+        try:
+            message = decode(delivery.body, delivery.properties)
+            movement_log.end_turn(message['turn'], message.get('epoch'))
+        except (KeyError, ValueError, TypeError) as e:
+            logging.error(f"Skipping invalid turn message: {e}")
+    movement_log.flush()
+    ack()
+
+
+# Consume the movement and turn streams into the movement log on a
+# background thread. The log replaces the movement_history table, which is
+# no longer written.
+def start_history_consumers(movement_log):
+    create_consumer(
+        connection, HISTORY_QUEUE, lambda batch, ack: on_history_batch(
+            batch, ack, movement_log), config).start()
+    create_consumer(
+        connection, HISTORY_TURNS_QUEUE, lambda batch, ack:
+        on_history_turn_batch(batch, ack, movement_log), config).start()
+    threading.Thread(target=consume_forever,
+                     args=(connection, ),
+                     name="history-consumer",
+                     daemon=True).start()
+
+
+# Assign a random starting location on an open cell
 def assign_random_position():
-    while True:
-        x = random.randint(0, map_size[0] - 1)
-        y = random.randint(0, map_size[1] - 1)
-        if map_layout[y][x] == ' ':  # Ensure it's not an obstacle
-            return x, y
+    return game_map.random_open_cell()
+
+
+# Current position of a user, assigning a random one on first sight
+def get_or_assign_position(user_id):
+    position = position_cache.get(user_id)
+    if position is None:
+        position = assign_random_position()
+        position_cache.set(user_id, *position)
+    return position
+
+
+# Shared writer for positions, pooled connections reading them
+# back, and the in-memory position cache that serves every move without
+# reading the database
+movements_db = Database('movements.db', schema=TABLE_SCHEMA)
+movements_db.configure(config)
+movements_db.setup()
+writer = writer_from_config('movements.db', config, schema=TABLE_SCHEMA)
+position_cache = PositionCache(movements_db, writer)
+position_cache.load()
+
+
+# Response for a publish that timed out on a full confirm window, e.g.
+# while the broker is down
+def publisher_unavailable(error):
+    logging.error(f"Publish timed out: {error}")
+    return jsonify({"error": "Movement publisher unavailable"}), 503
 
 
 # Endpoint to process user movement
@@ -121,49 +208,29 @@ def move_user():
     if not user_id or not direction:
         return jsonify({"error":
                         "Missing 'user_id' or 'direction' in JSON"}), 400
-
-    conn = setup_database()
-    cursor = conn.cursor()
-    cursor.execute('SELECT x, y FROM user_positions WHERE user_id = ?',
-                   (user_id, ))
-    row = cursor.fetchone()
+    # Keys of the position cache are TEXT, as stored in user_positions
+    user_id = str(user_id)
 
     # Assign random position if user has no previous position
-    if not row:
-        x, y = assign_random_position()
-        cursor.execute(
-            'INSERT INTO user_positions (user_id, x, y) VALUES (?, ?, ?)',
-            (user_id, x, y))
-        conn.commit()
-    else:
-        x, y = row
+    x, y = get_or_assign_position(user_id)
 
     # Calculate the new position based on direction
-    new_x, new_y = x, y
-    if direction == 'N':
-        new_y -= 1
-    elif direction == 'S':
-        new_y += 1
-    elif direction == 'E':
-        new_x += 1
-    elif direction == 'W':
-        new_x -= 1
+    new_x, new_y = game_map.step(x, y, direction)
 
     # Validate move (within bounds and not into an obstacle)
-    if (0 <= new_x < map_size[0] and 0 <= new_y < map_size[1]
-            and map_layout[new_y][new_x] != 'H'):
-        cursor.execute(
-            'UPDATE user_positions SET x = ?, y = ? WHERE user_id = ?',
-            (new_x, new_y, user_id))
-        conn.commit()
-        publish_update(channel, user_id, new_x, new_y)
-        conn.close()
+    if game_map.can_enter(new_x, new_y):
+        position_cache.set(user_id, new_x, new_y)
+        try:
+            publish_update(publisher, user_id, new_x, new_y)
+        except TimeoutError as e:
+            return publisher_unavailable(e)
+        MOVES_ACCEPTED.inc()
         return jsonify({
             "status": "Move successful",
             "new_location": f"({new_x}, {new_y})"
         }), 200
     else:
-        conn.close()
+        MOVES_REJECTED.inc()
         return jsonify({"error":
                         "Invalid move: obstacle or out of bounds"}), 400
 
@@ -178,34 +245,128 @@ def login():
     user_id = data.get('user_id')
     if not user_id:
         return jsonify({"error": "Missing 'user_id' in JSON"}), 400
+    user_id = str(user_id)
 
-    conn = setup_database()
-    cursor = conn.cursor()
-    cursor.execute('SELECT x, y FROM user_positions WHERE user_id = ?',
-                   (user_id, ))
-    row = cursor.fetchone()
-
-    if not row:
-        x, y = assign_random_position()
-        cursor.execute(
-            'INSERT INTO user_positions (user_id, x, y) VALUES (?, ?, ?)',
-            (user_id, x, y))
-        conn.commit()
-    else:
-        x, y = row
+    x, y = get_or_assign_position(user_id)
 
-    publish_update(channel, user_id, x, y)
-    conn.close()
+    try:
+        publish_update(publisher, user_id, x, y)
+    except TimeoutError as e:
+        return publisher_unavailable(e)
     return jsonify({
         "status": "Login successful",
         "location": f"({x}, {y})"
     }), 200
 
 
+# Validate and apply a list of {"user_id", "direction"} moves in order.
+# Positions come from the cache in one pass; accepted moves are stored in
+# the cache, queued for persistence as one transaction and then published.
+# Returns one result per move.
+def apply_moves(moves):
+    results = [None] * len(moves)
+    pending = []
+    for index, move in enumerate(moves):
+        user_id = move.get('user_id') if isinstance(move, dict) else None
+        direction = move.get('direction') if isinstance(move, dict) else None
+        if not user_id or not direction:
+            results[index] = {
+                "index": index,
+                "error": "Missing 'user_id' or 'direction'"
+            }
+        else:
+            pending.append((index, str(user_id), direction))
+
+    positions = position_cache.get_many(
+        {user_id for _, user_id, _ in pending})
+
+    # Users without a position start on a random open cell
+    moved = {}
+    for _, user_id, _ in pending:
+        if user_id not in positions:
+            positions[user_id] = moved[user_id] = assign_random_position()
+
+    updates = []
+    for index, user_id, direction in pending:
+        x, y = positions[user_id]
+        new_x, new_y = game_map.step(x, y, direction)
+        if game_map.can_enter(new_x, new_y):
+            positions[user_id] = moved[user_id] = (new_x, new_y)
+            updates.append((user_id, new_x, new_y))
+            results[index] = {
+                "index": index,
+                "user_id": user_id,
+                "status": "Move successful",
+                "new_location": f"({new_x}, {new_y})"
+            }
+        else:
+            results[index] = {
+                "index": index,
+                "user_id": user_id,
+                "error": "Invalid move: obstacle or out of bounds"
+            }
+
+    position_cache.set_many(moved)
+    if updates:
+        publish_updates(publisher, updates)
+    MOVES_ACCEPTED.inc(len(updates))
+    MOVES_REJECTED.inc(len(moves) - len(updates))
+    return results
+
+
+# Endpoint to process many user movements in one request. The resulting
+# positions are written to the database in a single transaction, after the
+# response: all of them are persisted or, on a database error, none are.
+@app.route('/moves', methods=['POST'])
+def move_users():
+    if not request.is_json:
+        return jsonify({"error": "Invalid JSON format"}), 400
+
+    data = request.get_json() or {}
+    moves = data.get('moves')
+    if not isinstance(moves, list) or not moves:
+        return jsonify({"error": "Missing 'moves' list in JSON"}), 400
+    if len(moves) > max_batch_moves:
+        return jsonify({
+            "error": f"Too many moves; the limit is {max_batch_moves}"
+        }), 413
+
+    try:
+        results = apply_moves(moves)
+    except TimeoutError as e:
+        return publisher_unavailable(e)
+    return jsonify({
+        "results": results,
+        "accepted": sum(1 for result in results if "error" not in result)
+    }), 200
+
+
+# Hit/miss counters of the position cache
+@app.route('/positions/stats', methods=['GET'])
+def position_stats():
+    return jsonify(position_cache.stats()), 200
+
+
+# Publish and confirm counters of the publisher pool
+@app.route('/publisher/stats', methods=['GET'])
+def publisher_stats():
+    return jsonify(publisher.stats()), 200
+
+
+# Compare the position cache against movements.db
+@app.route('/positions/consistency', methods=['GET'])
+def position_consistency():
+    report = position_cache.check_consistency()
+    return jsonify(report), 200 if report["consistent"] else 409
+
+
 def main():
-    conn = setup_database()
-    check_and_store_historical_data(conn)
-    app.run(port=5003)
+    movement_log = log_from_config(config)
+    start_history_consumers(movement_log)
+    try:
+        app.run(port=5003)
+    finally:
+        movement_log.close()
 
 
 if __name__ == '__main__':
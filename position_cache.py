@@ -0,0 +1,100 @@
+import threading
+
+# Upsert used to persist positions through the BatchWriter
+UPSERT_POSITION = ('INSERT INTO user_positions (user_id, x, y) '
+                   'VALUES (?, ?, ?) ON CONFLICT(user_id) '
+                   'DO UPDATE SET x = excluded.x, y = excluded.y')
+
+
+# Authoritative in-process copy of the user_positions table. All positions
+# are loaded once at startup, so lookups never touch the disk; writes update
+# the dict immediately and are persisted asynchronously through a
+# BatchWriter. A miss means the user has no stored position yet.
+class PositionCache:
+
+    def __init__(self, database, writer):
+        self.database = database
+        self.writer = writer
+        self.hits = 0
+        self.misses = 0
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    # Load every stored position; call once the table exists
+    def load(self):
+        with self.database.connection(readonly=True) as conn:
+            rows = conn.execute(
+                'SELECT user_id, x, y FROM user_positions').fetchall()
+        with self._lock:
+            self._positions = {user_id: (x, y) for user_id, x, y in rows}
+        return len(rows)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def get(self, user_id):
+        with self._lock:
+            position = self._positions.get(user_id)
+            if position is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return position
+
+    # Positions of many users; users without one are left out
+    def get_many(self, user_ids):
+        found = {}
+        with self._lock:
+            for user_id in user_ids:
+                position = self._positions.get(user_id)
+                if position is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    found[user_id] = position
+        return found
+
+    def set(self, user_id, x, y):
+        with self._lock:
+            self._positions[user_id] = (x, y)
+        self.writer.submit(UPSERT_POSITION, (user_id, x, y))
+
+    # Positions of many users, persisted together in one transaction
+    def set_many(self, positions):
+        with self._lock:
+            self._positions.update(positions)
+        self.writer.submit_many(
+            UPSERT_POSITION,
+            [(user_id, x, y) for user_id, (x, y) in positions.items()])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "users": len(self._positions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "rows_written": self.writer.rows_written,
+            }
+
+    # Compare the cache with the database after flushing pending writes.
+    # Returns the users that differ, grouped by kind of mismatch.
+    def check_consistency(self):
+        self.writer.flush()
+        with self.database.connection(readonly=True) as conn:
+            stored = {
+                user_id: (x, y)
+                for user_id, x, y in conn.execute(
+                    'SELECT user_id, x, y FROM user_positions')
+            }
+        with self._lock:
+            cached = dict(self._positions)
+        return {
+            "consistent": stored == cached,
+            "missing_in_db": sorted(set(cached) - set(stored)),
+            "missing_in_cache": sorted(set(stored) - set(cached)),
+            "mismatched": sorted(user_id for user_id in set(cached)
+                                 & set(stored)
+                                 if cached[user_id] != stored[user_id]),
+        }
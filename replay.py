@@ -0,0 +1,227 @@
+import argparse
+import contextlib
+import json
+import logging
+import time
+from collections import namedtuple
+
+from flask import Response, jsonify, request, stream_with_context
+
+from game_map import GameMap, update_map_cell
+from intersection_engine import engine_from_config
+from movement_log import MOVEMENT, log_from_config
+
+DEFAULT_KEYFRAME_INTERVAL = 10
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# State of one replayed turn: the movements made in it, the [x, y, old,
+# new] cells that differ from the previous replayed turn's map, and the
+# intersections the engine found
+ReplayTurn = namedtuple('ReplayTurn',
+                        ['turn', 'movements', 'changes', 'intersections'])
+
+
+# Rebuilds the map and intersections turn by turn from the movement log,
+# the way mapbuilder and the intersection service build them live. Each
+# turn's map starts from the base layout, so only the cells touched in the
+# previous turn and this one are updated. A turn is resolved when its end
+# marker is read; movements for a turn that has already been resolved are
+# counted as late and left out, as they are live.
+class Replayer:
+
+    def __init__(self, movement_log, game_map, engine):
+        self.movement_log = movement_log
+        self.game_map = game_map
+        self.engine = engine
+        self.base = game_map.rows()
+        self.grid = [row[:] for row in self.base]
+        self.movements = 0
+        self.late = 0
+        self._dirty = set()
+
+    # Rows of the map of the last replayed turn
+    def map_rows(self):
+        return [row[:] for row in self.grid]
+
+    # ReplayTurn of every turn in [from_turn, to_turn] with records in the
+    # log, in the order the turns ended
+    def turns(self, from_turn=None, to_turn=None):
+        pending = {}
+        resolved = set()
+        for record in self.movement_log.replay(from_turn, to_turn):
+            if record.kind == MOVEMENT:
+                if record.turn in resolved:
+                    self.late += 1
+                elif self.game_map.in_bounds(record.x, record.y):
+                    pending.setdefault(record.turn, []).append(
+                        (record.user, record.x, record.y))
+            elif record.turn not in resolved:
+                resolved.add(record.turn)
+                yield self._resolve(record.turn,
+                                    pending.pop(record.turn, []))
+        # Turns still open at the end of the log
+        for turn in sorted(pending):
+            yield self._resolve(turn, pending[turn])
+
+    def _resolve(self, turn, moves):
+        cells = {}
+        for user, x, y in moves:
+            self.engine.add(turn, user, x, y)
+            cell = (x, y)
+            cells[cell] = update_map_cell(
+                cells.get(cell, self.base[y][x]), user)
+        self.movements += len(moves)
+
+        changes = []
+        for x, y in self._dirty - cells.keys():
+            changes.append([x, y, self.grid[y][x], self.base[y][x]])
+            self.grid[y][x] = self.base[y][x]
+        for (x, y), value in cells.items():
+            if self.grid[y][x] != value:
+                changes.append([x, y, self.grid[y][x], value])
+                self.grid[y][x] = value
+        self._dirty = {(x, y)
+                       for (x, y), value in cells.items()
+                       if value != self.base[y][x]}
+        return ReplayTurn(turn, len(moves), sorted(changes),
+                          self.engine.detect(turn))
+
+
+def intersection_json(hit):
+    return {
+        "users": list(hit.users),
+        "location": list(hit.location),
+        "near": list(hit.near) if hit.near is not None else None
+    }
+
+
+# Replay messages for [from_turn, to_turn]: a keyframe for the first turn
+# and every `keyframe_interval` turns, deltas in between (the same shapes
+# mapbuilder publishes), an "intersections" message for every turn that had
+# any, and a closing "end" message with totals
+def replay_messages(replayer, from_turn=None, to_turn=None,
+                    keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+    turns = 0
+    intersections = 0
+    for seq, state in enumerate(replayer.turns(from_turn, to_turn), start=1):
+        if turns == 0 or state.turn % keyframe_interval == 0:
+            yield {
+                "type": "keyframe",
+                "seq": seq,
+                "turn": state.turn,
+                "map": replayer.map_rows()
+            }
+        else:
+            yield {
+                "type": "delta",
+                "seq": seq,
+                "turn": state.turn,
+                "cells": state.changes
+            }
+        if state.intersections:
+            yield {
+                "type": "intersections",
+                "turn": state.turn,
+                "intersections": [
+                    intersection_json(hit) for hit in state.intersections
+                ]
+            }
+        turns += 1
+        intersections += len(state.intersections)
+    yield {
+        "type": "end",
+        "turns": turns,
+        "movements": replayer.movements,
+        "late_movements": replayer.late,
+        "intersections": intersections
+    }
+
+
+# Keyframe interval of the live map stream, used for replays too
+def keyframe_interval_from_config(config):
+    return max(
+        1,
+        config.get('map_publishing',
+                   {}).get('keyframe_interval', DEFAULT_KEYFRAME_INTERVAL))
+
+
+# Replayer over the movement log of config.json. The log is opened
+# read-only on every call, so segments written since are included.
+def replayer_from_config(config):
+    return Replayer(log_from_config(config, readonly=True),
+                    GameMap.from_config(config), engine_from_config(config))
+
+
+# Map of `turn` rebuilt from the movement log, or None if the log has no
+# record of that turn
+def replay_map(config, turn):
+    replayer = replayer_from_config(config)
+    for _ in replayer.turns(turn, turn):
+        return replayer.map_rows()
+    return None
+
+
+# Flask response streaming the replay of ?from=&to= (both optional and
+# inclusive) as NDJSON
+def replay_response(config):
+    try:
+        from_turn = request.args.get('from', type=int)
+        to_turn = request.args.get('to', type=int)
+        if 'from' in request.args and from_turn is None:
+            raise ValueError("from must be a turn number")
+        if 'to' in request.args and to_turn is None:
+            raise ValueError("to must be a turn number")
+        if (from_turn is not None and to_turn is not None
+                and to_turn < from_turn):
+            raise ValueError("to must not be before from")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    keyframe_interval = keyframe_interval_from_config(config)
+    replayer = replayer_from_config(config)
+
+    def generate():
+        for message in replay_messages(replayer, from_turn, to_turn,
+                                       keyframe_interval):
+            yield json.dumps(message, separators=(',', ':')) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+# Replay a turn range from the command line and report the throughput
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild maps and intersections from the movement log")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--from', dest='from_turn', type=int)
+    parser.add_argument('--to', dest='to_turn', type=int)
+    parser.add_argument('--output',
+                        help="write the replay messages here as NDJSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    replayer = replayer_from_config(config)
+    started = time.perf_counter()
+    with (open(args.output, 'w')
+          if args.output else contextlib.nullcontext()) as output:
+        for message in replay_messages(replayer, args.from_turn, args.to_turn,
+                                       keyframe_interval_from_config(config)):
+            if output is not None:
+                output.write(json.dumps(message, separators=(',', ':')))
+                output.write('\n')
+    elapsed = time.perf_counter() - started
+
+    # The last message holds the totals
+    summary = dict(message)
+    del summary["type"]
+    summary["seconds"] = round(elapsed, 3)
+    summary["movements_per_second"] = round(
+        summary["movements"] / elapsed) if elapsed else None
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,30 @@
+import asyncio
+import base64
+import binascii
+import heapq
 import json
 import logging
+import os
 import sqlite3
-import pika
-from flask import Blueprint, Flask, jsonify
+from threading import Thread
+from flask import (Blueprint, Flask, Response, jsonify, request,
+                   stream_with_context)
 from datetime import datetime
 
+from async_runtime import (connect_from_config, prefetch_from_config,
+                           use_asyncio)
+from consumer import consume_forever, create_consumer
+from db import Database, connect
+from db_writer import writer_from_config
+from memory_broker import blocking_connection
+from messages import decode, format_location
+from metrics import instrument_app
+from response_cache import ResponseCache
+from topology import MOVEMENT_QUEUES, topology_from_config
+
+# This service's own copy of the movement stream
+MOVEMENTS_QUEUE = MOVEMENT_QUEUES['reports']
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
@@ -25,171 +45,642 @@ def load_config():
         exit(1)
 
 
-# SQLite setup for reports
-def get_db_connection():
-    conn = sqlite3.connect('reports.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS movements (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT,
-            location TEXT,
-            timestamp TEXT
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS intersections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user1 TEXT,
-            user2 TEXT,
-            location TEXT,
-            timestamp TEXT
-        )
-    ''')
-    conn.commit()
-    return conn
+# Report tables
+REPORT_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT,
+        location TEXT,
+        timestamp TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS intersections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user1 TEXT,
+        user2 TEXT,
+        location TEXT,
+        timestamp TEXT
+    )
+    ''',
+    # Report queries read one user's rows in (timestamp, id) order
+    '''
+    CREATE INDEX IF NOT EXISTS movements_user_time
+    ON movements (user, timestamp)
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS intersections_user1_time
+    ON intersections (user1, timestamp)
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS intersections_user2_time
+    ON intersections (user2, timestamp)
+    ''',
+    # Rollups kept up to date by the ingest triggers below
+    '''
+    CREATE TABLE IF NOT EXISTS user_totals (
+        user TEXT PRIMARY KEY,
+        movements INTEGER NOT NULL DEFAULT 0,
+        intersections INTEGER NOT NULL DEFAULT 0,
+        first_seen TEXT,
+        last_seen TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS cell_visits (
+        location TEXT PRIMARY KEY,
+        visits INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pair_intersections (
+        user1 TEXT,
+        user2 TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user1, user2)
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS pair_intersections_user2
+    ON pair_intersections (user2)
+    ''',
+]
+
+# Rollups are built from the raw tables once, when they are first created,
+# and from then on updated by triggers in the transaction that inserts the
+# raw row. INSERT OR IGNORE does not fire them for duplicates, so the counts
+# match the deduplicated tables.
+ROLLUP_SCHEMA = [
+    '''
+    INSERT INTO user_totals (user, movements, intersections, first_seen,
+                             last_seen)
+    SELECT user, SUM(movements), SUM(intersections), MIN(first_seen),
+           MAX(last_seen)
+    FROM (
+        SELECT user, COUNT(*) AS movements, 0 AS intersections,
+               MIN(timestamp) AS first_seen, MAX(timestamp) AS last_seen
+        FROM movements GROUP BY user
+        UNION ALL
+        SELECT user1, 0, COUNT(*), NULL, NULL FROM intersections
+        WHERE user2 IS NOT NULL GROUP BY user1
+        UNION ALL
+        SELECT user2, 0, COUNT(*), NULL, NULL FROM intersections
+        WHERE user1 IS NOT NULL AND user2 <> user1 GROUP BY user2
+    )
+    WHERE user IS NOT NULL AND NOT EXISTS (SELECT 1 FROM user_totals)
+    GROUP BY user
+    ''',
+    '''
+    INSERT INTO cell_visits (location, visits)
+    SELECT location, COUNT(*) FROM movements
+    WHERE location IS NOT NULL AND NOT EXISTS (SELECT 1 FROM cell_visits)
+    GROUP BY location
+    ''',
+    '''
+    INSERT INTO pair_intersections (user1, user2, count)
+    SELECT user1, user2, COUNT(*) FROM intersections
+    WHERE user1 IS NOT NULL AND user2 IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM pair_intersections)
+    GROUP BY user1, user2
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS movements_user_totals
+    AFTER INSERT ON movements WHEN NEW.user IS NOT NULL
+    BEGIN
+        INSERT INTO user_totals (user, movements, first_seen, last_seen)
+        VALUES (NEW.user, 1, NEW.timestamp, NEW.timestamp)
+        ON CONFLICT (user) DO UPDATE SET
+            movements = movements + 1,
+            first_seen = CASE WHEN first_seen IS NULL
+                                OR excluded.first_seen < first_seen
+                              THEN excluded.first_seen ELSE first_seen END,
+            last_seen = CASE WHEN last_seen IS NULL
+                               OR excluded.last_seen > last_seen
+                             THEN excluded.last_seen ELSE last_seen END;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS movements_cell_visits
+    AFTER INSERT ON movements WHEN NEW.location IS NOT NULL
+    BEGIN
+        INSERT INTO cell_visits (location, visits) VALUES (NEW.location, 1)
+        ON CONFLICT (location) DO UPDATE SET visits = visits + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS intersections_rollups
+    AFTER INSERT ON intersections
+    WHEN NEW.user1 IS NOT NULL AND NEW.user2 IS NOT NULL
+    BEGIN
+        INSERT INTO pair_intersections (user1, user2, count)
+        VALUES (NEW.user1, NEW.user2, 1)
+        ON CONFLICT (user1, user2) DO UPDATE SET count = count + 1;
+        INSERT INTO user_totals (user, intersections)
+        VALUES (NEW.user1, 1)
+        ON CONFLICT (user) DO UPDATE SET intersections = intersections + 1;
+        INSERT INTO user_totals (user, intersections)
+        SELECT NEW.user2, 1 WHERE NEW.user2 <> NEW.user1
+        ON CONFLICT (user) DO UPDATE SET intersections = intersections + 1;
+    END
+    ''',
+]
+
+# Rewrites a report database created before the unique indexes below
+# existed, so they can be built: duplicate rows are removed and pairs are
+# ordered. Run once by migrate_database().
+DEDUP_MIGRATION = {
+    'movements_dedup': [
+        '''
+        DELETE FROM movements WHERE id NOT IN (
+            SELECT MIN(id) FROM movements GROUP BY user, location, timestamp)
+        ''',
+    ],
+    'intersections_dedup': [
+        '''
+        UPDATE intersections SET user1 = user2, user2 = user1
+        WHERE user1 > user2
+        ''',
+        '''
+        DELETE FROM intersections WHERE id NOT IN (
+            SELECT MIN(id) FROM intersections
+            GROUP BY user1, user2, location, timestamp)
+        ''',
+    ],
+}
+
+# Unique indexes used by the batched writer in place of SELECT-then-INSERT.
+# Intersection pairs are stored with user1 <= user2 so (a, b) and (b, a)
+# collapse to one row.
+INGEST_SCHEMA = REPORT_SCHEMA + [
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS movements_dedup
+    ON movements (user, location, timestamp)
+    ''',
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS intersections_dedup
+    ON intersections (user1, user2, location, timestamp)
+    ''',
+] + ROLLUP_SCHEMA
+
+
+# Rows per JSON report page unless the request asks for fewer
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Encoded report responses, tagged "user:<name>" and "heatmap". Only the
+# process that ingests the reports can tell when they change, so main()
+# enables it there; processes that just mount the blueprint (main.py) read
+# through to SQLite.
+report_cache = ResponseCache('reports', enabled=False)
+HEATMAP_TAG = 'heatmap'
+
+
+def user_tag(user):
+    return f"user:{user}"
+
+
+# Report queries run on pooled read-only connections, so they never contend
+# with the BatchWriter for the write lock
+reports_db = Database('reports.db', schema=REPORT_SCHEMA)
+
+
+# The report schema is created once, when the blueprint is registered
+@report_blueprint.record_once
+def setup_reports_db(_state):
+    reports_db.configure(load_config())
+    reports_db.setup()
 
 
 # RabbitMQ Setup
 def setup_rabbitmq(config):
-    connection = pika.BlockingConnection(
-        pika.URLParameters(config['rabbitmq_address']))
+    connection = blocking_connection(config['rabbitmq_address'])
     channel = connection.channel()
-    channel.queue_declare(queue='movement_updates', durable=True)
+    topology_from_config(config).declare(channel)
     channel.queue_declare(queue='intersections', durable=True)
     return connection, channel
 
 
-# Process movement updates and log to database
-def on_movement_update(ch, method, body, db_conn):
-    message = json.loads(body)
+# Process movement updates and log to database; returns the cache tags of
+# the reports the row changes
+def on_movement_update(body, writer, properties=None):
+    message = decode(body, properties)
     user = message.get("user")
     location = message.get("location")
+    if isinstance(location, tuple):
+        location = format_location(location)
     timestamp = message.get("timestamp")
 
-    cursor = db_conn.cursor()
-    # Check if this movement already exists
-    cursor.execute(
-        'SELECT COUNT(*) FROM movements WHERE user = ? AND location = ? AND timestamp = ?',
-        (user, location, timestamp))
-
-    if cursor.fetchone(
-    )[0] == 0:  # If this movement is not already in the database
-        cursor.execute(
-            'INSERT INTO movements (user, location, timestamp) VALUES (?, ?, ?)',
-            (user, location, timestamp))
-        db_conn.commit()
-        logging.info(f"Movement recorded: {user} at {location} at {timestamp}")
+    writer.submit(
+        'INSERT OR IGNORE INTO movements (user, location, timestamp) '
+        'VALUES (?, ?, ?)', (user, location, timestamp))
+    return user_tag(user), HEATMAP_TAG
 
-    ch.basic_ack(delivery_tag=method.delivery_tag)
 
-
-# Process intersections and log to database
-def on_intersection_update(ch, method, body, db_conn):
-    message = json.loads(body)
+# Process intersections and log to database; returns the cache tags of the
+# reports the row changes
+def on_intersection_update(body, writer, properties=None):
+    message = decode(body, properties)
     user1 = message.get("user1")
     user2 = message.get("user2")
     location = message.get("location")
+    if isinstance(location, tuple):
+        location = format_location(location)
     timestamp = message.get("timestamp")
 
-    cursor = db_conn.cursor()
-    # Check if this intersection already exists
-    cursor.execute(
-        'SELECT COUNT(*) FROM intersections WHERE (user1 = ? AND user2 = ? AND location = ? AND timestamp = ?) OR (user1 = ? AND user2 = ? AND location = ? AND timestamp = ?)',
-        (user1, user2, location, timestamp, user2, user1, location, timestamp))
+    # Store the pair in a canonical order for the unique index
+    if user1 is not None and user2 is not None and user1 > user2:
+        user1, user2 = user2, user1
 
-    if cursor.fetchone(
-    )[0] == 0:  # If this intersection is not already in the database
-        cursor.execute(
-            'INSERT INTO intersections (user1, user2, location, timestamp) '
-            'VALUES (?, ?, ?, ?)', (user1, user2, location, timestamp))
-        db_conn.commit()
-        logging.info(
-            f"Intersection recorded between {user1} and {user2} at {location} at {timestamp}"
-        )
+    writer.submit(
+        'INSERT OR IGNORE INTO intersections (user1, user2, location, '
+        'timestamp) VALUES (?, ?, ?, ?)', (user1, user2, location, timestamp))
+    return user_tag(user1), user_tag(user2)
 
-    ch.basic_ack(delivery_tag=method.delivery_tag)
 
+# Run `on_update` for every message of a batch. Once the writer has
+# committed its rows the cached reports they change are dropped and the
+# batch is acked.
+def on_report_batch(batch, ack, on_update, writer):
+    tags = set()
+    for delivery in batch:
+        try:
+            tags.update(on_update(delivery.body, writer, delivery.properties))
+        except ValueError as e:
+            logging.error(f"Failed to decode report message: {e}")
+
+    def committed():
+        report_cache.invalidate(*tags)
+        ack()
+
+    writer.after_commit(committed, ack.requeue)
 
-# Fetch Movement History
-@report_blueprint.route('/report/movement/<user>', methods=['GET'])
-def movement_report(user):
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
+# Opaque page token holding the (timestamp, id) of the last row returned
+def encode_cursor(timestamp, row_id):
+    raw = json.dumps([timestamp, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        timestamp, row_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor '{token}'") from e
+    if not isinstance(row_id, int) or not (
+            timestamp is None or isinstance(timestamp, (str, int, float))):
+        raise ValueError(f"Invalid cursor '{token}'")
+    return timestamp, row_id
+
+
+# Position of a row in report order: rows without a timestamp first, then
+# by timestamp and id
+def row_order(row):
+    timestamp, row_id = row[0], row[1]
+    return timestamp is not None, timestamp or '', row_id
+
+
+# Stream a user's rows of `table` as (timestamp, id, *columns) in report
+# order, starting after the decoded cursor `after`. `since` (inclusive) and
+# `until` (exclusive) bound the timestamp and leave out rows without one.
+# Both queries walk the (user, timestamp) index, so nothing is sorted or
+# loaded up front. `condition` is an extra (sql, params) filter.
+def iter_user_rows(conn, table, columns, user_column, user, after=None,
+                   since=None, until=None, condition=None):
+    select = (f"SELECT timestamp, id, {', '.join(columns)} FROM {table} "
+              f"WHERE {user_column} = ?")
+    params = [user]
+    if condition is not None:
+        select += f" AND {condition[0]}"
+        params.extend(condition[1])
+
+    after_timestamp, after_id = after if after is not None else (None, 0)
+    if since is None and until is None and after_timestamp is None:
+        for row in conn.execute(
+                select + " AND timestamp IS NULL AND id > ? ORDER BY id",
+                params + [after_id]):
+            yield row
+
+    sql = select + " AND timestamp IS NOT NULL"
+    range_params = list(params)
+    if after_timestamp is not None:
+        sql += " AND (timestamp, id) > (?, ?)"
+        range_params.extend([after_timestamp, after_id])
+    if since is not None:
+        sql += " AND timestamp >= ?"
+        range_params.append(since)
+    if until is not None:
+        sql += " AND timestamp < ?"
+        range_params.append(until)
+    for row in conn.execute(sql + " ORDER BY timestamp, id", range_params):
+        yield row
+
+
+def movement_rows(conn, user, after=None, since=None, until=None):
+    return iter_user_rows(conn, 'movements', ['location'], 'user', user,
+                          after, since, until)
+
+
+# Intersections of a user, merged from the user1 and user2 indexes
+def intersection_rows(conn, user, after=None, since=None, until=None):
+    columns = ['user1', 'user2', 'location']
+    return heapq.merge(
+        iter_user_rows(conn, 'intersections', columns, 'user1', user, after,
+                       since, until),
+        iter_user_rows(conn, 'intersections', columns, 'user2', user, after,
+                       since, until, condition=('user1 <> ?', [user])),
+        key=row_order)
+
+
+# Paging and filter parameters of a report request:
+#   cursor  next_cursor of the previous page
+#   since   first timestamp to include, until  first timestamp to leave out,
+#           both in the stored format (epoch seconds for movements)
+#   limit   rows per page
+#   format  "ndjson" (or Accept: application/x-ndjson) streams every row
+#           as one JSON object per line instead of returning a page
+def report_query():
+    args = request.args
+    stream = (args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best_match(
+                  ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE)
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError(f"Invalid limit '{limit}'") from None
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    elif not stream:
+        limit = DEFAULT_PAGE_SIZE
+    cursor = args.get('cursor')
+    return {
+        "after": decode_cursor(cursor) if cursor else None,
+        "since": args.get('since'),
+        "until": args.get('until'),
+        "limit": limit,
+        "stream": stream,
+    }
+
+
+# Respond with the rows of `fetch(conn, user, after, since, until)`: a JSON
+# page of at most `limit` rows under `key` with the cursor of the next page,
+# or an NDJSON stream in which every row carries its own resume cursor
+def report_response(user, fetch, key, page_row, stream_row):
     try:
-        cursor.execute(
-            'SELECT location, timestamp FROM movements WHERE user = ?',
-            (user, ))
-        movements = cursor.fetchall()
+        query = report_query()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = reports_db.acquire(readonly=True)
+    rows = fetch(conn, user, query['after'], query['since'], query['until'])
+    limit = query['limit']
+
+    # Finish the row queries before the connection goes back to the pool
+    def release():
+        rows.close()
+        reports_db.release(conn, readonly=True)
+
+    if query['stream']:
+
+        def generate():
+            try:
+                for count, row in enumerate(rows):
+                    if limit is not None and count >= limit:
+                        break
+                    item = stream_row(row)
+                    item["cursor"] = encode_cursor(row[0], row[1])
+                    yield json.dumps(item) + '\n'
+            except sqlite3.Error as e:
+                logging.error(f"Error streaming {key}: {e}")
+            finally:
+                release()
+
+        return Response(stream_with_context(generate()),
+                        mimetype=NDJSON_MIMETYPE)
+
+    try:
+        page = []
+        next_cursor = None
+        for row in rows:
+            if len(page) == limit:
+                last = page[-1]
+                next_cursor = encode_cursor(last[0], last[1])
+                break
+            page.append(row)
+    finally:
+        release()
+    return jsonify({
+        key: [page_row(row) for row in page],
+        "next_cursor": next_cursor
+    }), 200
 
-        movement_history = [{
-            "location": loc,
-            "timestamp": ts
-        } for loc, ts in movements]
 
-        return jsonify({"movement_history": movement_history}), 200
+# Fetch Movement History
+@report_blueprint.route('/report/movement/<user>', methods=['GET'])
+@report_cache.cached(lambda user: [user_tag(user)])
+def movement_report(user):
+    try:
+        return report_response(
+            user, movement_rows, "movement_history",
+            lambda row: {"location": row[2], "timestamp": row[0]},
+            lambda row: {"location": row[2], "timestamp": row[0]})
     except Exception as e:
         logging.error(f"Error fetching movement history: {e}")
         return jsonify({"error": "Error fetching movement history"}), 500
-    finally:
-        conn.close()
 
 
-# Fetch Intersections
+# Fetch Intersections; pages keep the [user1, user2, location, timestamp]
+# rows of earlier versions
 @report_blueprint.route('/report/intersection/<user>', methods=['GET'])
+@report_cache.cached(lambda user: [user_tag(user)])
 def intersection_report(user):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        'SELECT user1, user2, location, timestamp FROM intersections '
-        'WHERE user1 = ? OR user2 = ?', (user, user))
-    intersections = cursor.fetchall()
-    conn.close()
-    return jsonify({"intersection_history": intersections}), 200
+    try:
+        return report_response(
+            user, intersection_rows, "intersection_history",
+            lambda row: [row[2], row[3], row[4], row[0]],
+            lambda row: {
+                "user1": row[2],
+                "user2": row[3],
+                "location": row[4],
+                "timestamp": row[0]
+            })
+    except Exception as e:
+        logging.error(f"Error fetching intersection history: {e}")
+        return jsonify({"error": "Error fetching intersection history"}), 500
+
+
+# Totals of a user from the rollups, with the `partners` users they
+# intersected most often (10 unless the request asks for up to 100)
+@report_blueprint.route('/report/summary/<user>', methods=['GET'])
+@report_cache.cached(lambda user: [user_tag(user)])
+def user_summary(user):
+    partners = request.args.get('partners', '10')
+    if not partners.isdigit() or int(partners) > 100:
+        return jsonify({"error": "partners must be between 0 and 100"}), 400
+
+    try:
+        with reports_db.connection(readonly=True) as conn:
+            totals = conn.execute(
+                'SELECT movements, intersections, first_seen, last_seen '
+                'FROM user_totals WHERE user = ?', (user, )).fetchone()
+            if totals is None:
+                return jsonify(
+                    {"error": f"No activity recorded for {user}"}), 404
+            top_partners = conn.execute(
+                'SELECT CASE WHEN user1 = ? THEN user2 ELSE user1 END, count '
+                'FROM pair_intersections WHERE user1 = ? OR user2 = ? '
+                'ORDER BY count DESC LIMIT ?',
+                (user, user, user, int(partners))).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Error fetching summary for {user}: {e}")
+        return jsonify({"error": "Error fetching summary"}), 500
+
+    movements, intersections, first_seen, last_seen = totals
+    return jsonify({
+        "user": user,
+        "movements": movements,
+        "intersections": intersections,
+        "first_seen": first_seen,
+        "last_seen": last_seen,
+        "top_partners": [{
+            "user": partner,
+            "intersections": count
+        } for partner, count in top_partners]
+    }), 200
+
+
+# Visits per cell over every recorded movement, from the rollups
+@report_blueprint.route('/report/heatmap', methods=['GET'])
+@report_cache.cached(lambda: [HEATMAP_TAG])
+def heatmap():
+    try:
+        with reports_db.connection(readonly=True) as conn:
+            cells = conn.execute(
+                'SELECT location, visits FROM cell_visits').fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Error fetching heatmap: {e}")
+        return jsonify({"error": "Error fetching heatmap"}), 500
+    return jsonify({
+        "cells": dict(cells),
+        "total_visits": sum(visits for _, visits in cells)
+    }), 200
+
+
+# Asyncio variant of the consumers: both queues run as coroutines over one
+# connection, and each message is acked once its row is committed
+async def consume_async(config, db_writer):
+    runtime = await connect_from_config(config)
+    await runtime.declare_topology(topology_from_config(config))
+    prefetch_count = prefetch_from_config(config)
+
+    def handler(on_update):
+
+        async def handle(body, properties):
+            try:
+                tags = on_update(body, db_writer, properties)
+            except ValueError as e:
+                logging.error(f"Failed to decode report message: {e}")
+                return
+            await runtime.wait_for_commit(db_writer)
+            report_cache.invalidate(*tags)
+
+        return handle
+
+    await runtime.consume(MOVEMENTS_QUEUE, handler(on_movement_update),
+                          prefetch_count)
+    await runtime.consume('intersections', handler(on_intersection_update),
+                          prefetch_count)
+    await runtime.wait_closed()
+
+
+# Deduplicate the tables of a report database whose unique indexes are
+# missing. A new database, or one already migrated, is left untouched.
+def migrate_database(path):
+    conn = connect(path)
+    try:
+        names = {
+            row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type IN "
+                "('table', 'index')")
+        }
+        for index, statements in DEDUP_MIGRATION.items():
+            table = index.rsplit('_', 1)[0]
+            if table in names and index not in names:
+                logging.info(f"Removing duplicate {table} before creating "
+                             f"{index}")
+                for statement in statements:
+                    conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
 
 
 # Main function to consume messages
 def main():
     config = load_config()
-    connection, channel = setup_rabbitmq(config)
-    db_conn = get_db_connection()
+    migrate_database('reports.db')
+    db_writer = writer_from_config('reports.db',
+                                   config,
+                                   schema=INGEST_SCHEMA)
+
+    # Replicas started by launcher.py share the report queues. Only the
+    # first serves the API, and it can only cache reports when it sees
+    # every write.
+    replica = int(os.environ.get('SERVICE_REPLICA', 0))
+    replicas = int(os.environ.get('SERVICE_REPLICAS', 1))
+    report_cache.enabled = replicas == 1
+    report_cache.configure(config)
+
+    # Start Flask API in a separate thread
+    if replica == 0:
+        app = Flask(__name__)
+        app.register_blueprint(report_blueprint)
+        instrument_app(app)
+
+        flask_thread = Thread(target=app.run, kwargs={'port': 5001})
+        flask_thread.start()
+
+    if use_asyncio(config):
+        try:
+            asyncio.run(consume_async(config, db_writer))
+        except KeyboardInterrupt:
+            logging.info("Report Service stopped by user.")
+        finally:
+            db_writer.close()
+        return
+
+    connection, _ = setup_rabbitmq(config)
 
     # Consume movement updates
-    channel.basic_consume(queue='movement_updates',
-                          on_message_callback=lambda ch, method, body:
-                          on_movement_update(ch, method, body, db_conn),
-                          auto_ack=False)
+    create_consumer(
+        connection, MOVEMENTS_QUEUE, lambda batch, ack: on_report_batch(
+            batch, ack, on_movement_update, db_writer), config).start()
 
     # Consume intersection updates
-    channel.basic_consume(queue='intersections',
-                          on_message_callback=lambda ch, method, body:
-                          on_intersection_update(ch, method, body, db_conn),
-                          auto_ack=False)
+    create_consumer(
+        connection, 'intersections', lambda batch, ack: on_report_batch(
+            batch, ack, on_intersection_update, db_writer), config).start()
 
     logging.info(
         "Report Service started, listening for movement and intersection updates..."
     )
 
-    # Start Flask API in a separate thread
-    app = Flask(__name__)
-    app.register_blueprint(report_blueprint)
-
-    from threading import Thread
-    flask_thread = Thread(target=app.run, kwargs={'port': 5001})
-    flask_thread.start()
-
     try:
-        channel.start_consuming()
+        consume_forever(connection)
     except KeyboardInterrupt:
         logging.info("Report Service stopped by user.")
     finally:
+        if db_writer:
+            db_writer.close()
+            logging.info("SQLite writer flushed and closed.")
         if connection:
             connection.close()
             logging.info("RabbitMQ connection closed.")
-        if db_conn:
-            db_conn.close()
-            logging.info("SQLite connection closed.")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from metrics import counter, gauge
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+CACHE_REQUESTS = counter('response_cache_requests_total',
+                         "Requests by result: hit, miss, or bypass for "
+                         "responses that cannot be cached",
+                         ['cache', 'result'])
+CACHE_HIT_RATIO = gauge('response_cache_hit_ratio',
+                        "Hits over hits and misses since startup", ['cache'])
+CACHE_BYTES = gauge('response_cache_bytes',
+                    "Encoded response bytes held by the cache", ['cache'])
+CACHE_ENTRIES = gauge('response_cache_entries', "Responses held by the cache",
+                      ['cache'])
+CACHE_INVALIDATIONS = counter('response_cache_invalidations_total',
+                              "Responses dropped because their data changed",
+                              ['cache'])
+
+# An encoded 200 response with its strong ETag
+CachedResponse = namedtuple('CachedResponse',
+                            ['body', 'etag', 'mimetype', 'tags'])
+
+
+# In-process LRU of encoded Flask responses, keyed by path, query string and
+# Accept header. Every entry carries tags (e.g. "user:alice", "turn:12")
+# naming the data it was built from; invalidate() drops the entries of a tag
+# when the consumers ingest new data for it. Entries are bounded both by
+# count and by encoded size. Responses are served with their ETag, and a
+# matching If-None-Match gets an empty 304.
+class ResponseCache:
+
+    def __init__(self,
+                 name,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 enabled=True):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        # Bumped by every invalidation, so a response built while its data
+        # changed is not stored
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self._hit = CACHE_REQUESTS.labels(name, 'hit')
+        self._miss = CACHE_REQUESTS.labels(name, 'miss')
+        self._bypass = CACHE_REQUESTS.labels(name, 'bypass')
+        self._hit_ratio = CACHE_HIT_RATIO.labels(name)
+        self._bytes = CACHE_BYTES.labels(name)
+        self._entry_count = CACHE_ENTRIES.labels(name)
+        self._invalidations = CACHE_INVALIDATIONS.labels(name)
+
+    # Apply the "response_cache" section of config.json
+    def configure(self, config):
+        settings = config.get('response_cache', {})
+        self.max_entries = settings.get('max_entries', self.max_entries)
+        self.max_bytes = settings.get('max_bytes', self.max_bytes)
+        self.enabled = self.enabled and settings.get('enabled', True)
+        with self._lock:
+            self._evict()
+
+    # Entry for `key` and the epoch to pass to store() on a miss
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._hit.inc()
+                self._update_hit_ratio()
+            return entry, self._epoch
+
+    # Cache an encoded body (counted as a miss) unless an invalidation ran
+    # since `epoch`
+    def store(self, key, body, mimetype, tags, epoch):
+        entry = CachedResponse(body,
+                               hashlib.blake2b(body,
+                                               digest_size=16).hexdigest(),
+                               mimetype, tuple(tags))
+        with self._lock:
+            self.misses += 1
+            self._miss.inc()
+            self._update_hit_ratio()
+            if epoch != self._epoch or len(body) > self.max_bytes:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            self.size_bytes += len(body)
+            for tag in entry.tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            self._evict()
+        return entry
+
+    # Drop every response built from the data of any of `tags`
+    def invalidate(self, *tags):
+        with self._lock:
+            self._epoch += 1
+            for tag in tags:
+                for key in self._keys_by_tag.pop(tag, ()):
+                    if self._remove(key):
+                        self._invalidations.inc()
+            self._update_gauges()
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self.size_bytes = 0
+            self._update_gauges()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
+
+    # Decorator caching a Flask view's 200 responses. `tags` maps the view's
+    # URL arguments to the tags of the data the response is built from.
+    # Streamed, non-200 and Cache-Control: no-store responses pass through
+    # uncached.
+    def cached(self, tags):
+
+        def decorator(view):
+
+            @wraps(view)
+            def wrapper(**kwargs):
+                if not self.enabled:
+                    return view(**kwargs)
+                key = (request.path,
+                       tuple(sorted(request.args.items(multi=True))),
+                       request.headers.get('Accept', ''))
+                entry, epoch = self.lookup(key)
+                if entry is None:
+                    response = make_response(view(**kwargs))
+                    if (response.status_code != 200 or response.is_streamed
+                            or response.cache_control.no_store):
+                        self._bypass.inc()
+                        return response
+                    entry = self.store(key, response.get_data(),
+                                       response.mimetype, tags(**kwargs),
+                                       epoch)
+                return self.respond(entry)
+
+            return wrapper
+
+        return decorator
+
+    # Response for a cached entry, or a 304 when the client already has it
+    @staticmethod
+    def respond(entry):
+        if request.if_none_match.contains(entry.etag):
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        # Browsers revalidate with If-None-Match instead of reusing the body
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    # Must be called with the lock held; returns whether `key` was cached
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size_bytes -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+        return True
+
+    # Drop least recently used entries until within both budgets. Must be
+    # called with the lock held.
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self.size_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+        self._update_gauges()
+
+    def _update_hit_ratio(self):
+        self._hit_ratio.set(self.hits / (self.hits + self.misses))
+
+    def _update_gauges(self):
+        self._bytes.set(self.size_bytes)
+        self._entry_count.set(len(self._entries))
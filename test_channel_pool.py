@@ -0,0 +1,19 @@
+import time
+
+import pytest
+
+from channel_pool import ChannelPool
+
+
+def test_publish_times_out_while_the_broker_is_down():
+    # Never started, so the pool has no connection and nothing is confirmed
+    pool = ChannelPool(None, confirm_window=1, publish_timeout=0.05)
+
+    first = pool.publish('movements', b"0")
+    assert not first.done()
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        pool.publish('movements', b"1")
+    assert time.monotonic() - started < 1.0
+    assert pool.stats()["outstanding"] == 1
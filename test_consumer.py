@@ -0,0 +1,87 @@
+import threading
+import time
+
+from consumer import BatchConsumer
+from memory_broker import InMemoryBroker
+
+QUEUE = 'test.movements'
+
+
+# Broker with `count` messages b"0", b"1", ... on QUEUE
+def broker_with_messages(count):
+    broker = InMemoryBroker()
+    broker.declare(QUEUE)
+    for i in range(count):
+        broker.publish('', QUEUE, str(i).encode())
+    return broker
+
+
+# Drive the connection until `condition()` holds
+def run_until(connection, condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        connection.process_data_events(time_limit=0.01)
+
+
+def test_batch_is_acked_only_when_the_handler_acks():
+    broker = broker_with_messages(5)
+    connection = broker.connection()
+    batches = []
+
+    # Like a BatchWriter.after_commit callback, the ack comes later
+    def handler(batch, ack):
+        batches.append((batch, ack))
+
+    consumer = BatchConsumer(connection, QUEUE, handler, batch_size=5).start()
+    try:
+        run_until(connection, lambda: batches)
+        batch, ack = batches[0]
+        assert [delivery.body for delivery in batch] == [
+            b"0", b"1", b"2", b"3", b"4"
+        ]
+        connection.process_data_events(time_limit=0.05)
+        assert len(consumer.channel._unacked) == 5
+
+        ack()
+        ack()
+        run_until(connection, lambda: consumer.acked == 5)
+        assert not consumer.channel._unacked
+        assert broker.depth(QUEUE) == 0
+    finally:
+        consumer.stop()
+
+
+def test_failed_batch_is_requeued_and_redelivered():
+    broker = broker_with_messages(3)
+    connection = broker.connection()
+    attempts = []
+    committed = []
+    # Acks run on another thread, as they do from a BatchWriter
+    pending_acks = []
+
+    def handler(batch, ack):
+        attempts.append([delivery.body for delivery in batch])
+        if len(attempts) == 1:
+            # The ack is registered before the failure, as a handler that
+            # queued some rows would
+            pending_acks.append(ack)
+            raise RuntimeError("database unavailable")
+        committed.extend(delivery.body for delivery in batch)
+        threading.Thread(target=ack).start()
+
+    consumer = BatchConsumer(connection, QUEUE, handler, batch_size=3).start()
+    try:
+        run_until(connection, lambda: consumer.acked == 3)
+        # The late ack of the failed batch must not settle it again
+        pending_acks[0]()
+        connection.process_data_events(time_limit=0.05)
+
+        assert attempts == [[b"0", b"1", b"2"], [b"0", b"1", b"2"]]
+        assert committed == [b"0", b"1", b"2"]
+        assert consumer.requeued == 3
+        assert consumer.acked == 3
+        assert not consumer.channel._unacked
+        assert broker.depth(QUEUE) == 0
+    finally:
+        consumer.stop()
@@ -0,0 +1,78 @@
+import sqlite3
+import threading
+
+import pytest
+
+from db import Database
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS items (name TEXT PRIMARY KEY)']
+
+
+def make_database(tmp_path, **kwargs):
+    return Database(str(tmp_path / 'items.db'), schema=SCHEMA, **kwargs)
+
+
+def test_connection_is_reused_across_threads(tmp_path):
+    database = make_database(tmp_path)
+    with database.connection() as conn:
+        conn.execute("INSERT INTO items VALUES ('a')")
+        conn.commit()
+        first = conn
+    seen = []
+
+    def request():
+        with database.connection() as conn:
+            seen.append(conn)
+            seen.append(conn.execute('SELECT name FROM items').fetchall())
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    thread.join()
+    assert seen == [first, [('a', )]]
+    database.close()
+
+
+def test_pool_keeps_at_most_pool_size_idle_connections(tmp_path):
+    database = make_database(tmp_path, pool_size=2)
+    burst = [database.acquire() for _ in range(3)]
+    assert len(set(map(id, burst))) == 3
+    for conn in burst:
+        database.release(conn)
+    assert len(database._idle[False]) == 2
+    with pytest.raises(sqlite3.ProgrammingError):
+        burst[-1].execute('SELECT 1')
+    database.close()
+
+
+def test_release_rolls_back_uncommitted_changes(tmp_path):
+    database = make_database(tmp_path, pool_size=1)
+    with database.connection() as conn:
+        conn.execute("INSERT INTO items VALUES ('lost')")
+    with database.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM items').fetchone() == (0, )
+    database.close()
+
+
+def test_readonly_connections_are_pooled_apart(tmp_path):
+    database = make_database(tmp_path)
+    with database.connection() as conn:
+        writer = conn
+    with database.connection(readonly=True) as conn:
+        assert conn is not writer
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO items VALUES ('a')")
+    database.close()
+
+
+def test_configure_applies_the_sqlite_section(tmp_path):
+    database = make_database(tmp_path)
+    with database.connection() as conn:
+        assert conn.execute('PRAGMA synchronous').fetchone() == (1, )
+    database.configure({"sqlite": {"synchronous": "FULL", "pool_size": 1}})
+    assert not database._idle[False]
+    with database.connection() as conn:
+        assert conn.execute('PRAGMA synchronous').fetchone() == (2, )
+    assert database.pool_size == 1
+    with pytest.raises(ValueError):
+        database.configure({"sqlite": {"synchronous": "SOMETIMES"}})
+    database.close()
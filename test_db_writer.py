@@ -0,0 +1,82 @@
+import sqlite3
+
+from db_writer import BatchWriter
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS rows (id INTEGER PRIMARY KEY)']
+INSERT = 'INSERT INTO rows (id) VALUES (?)'
+
+
+def stored(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute(
+            'SELECT id FROM rows ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def test_submit_many_is_not_split_across_batches(tmp_path):
+    path = str(tmp_path / 'rows.db')
+    writer = BatchWriter(path, schema=SCHEMA, batch_size=2)
+    writer.submit_many(INSERT, [(i, ) for i in range(5)])
+    writer.close()
+    assert writer.batches_committed == 1
+    assert stored(path) == [0, 1, 2, 3, 4]
+
+
+def test_failing_group_is_dropped_whole(tmp_path):
+    path = str(tmp_path / 'rows.db')
+    writer = BatchWriter(path, schema=SCHEMA)
+    writer.submit(INSERT, (1, ))
+    writer.submit_many(INSERT, [(2, ), (3, ), (1, )])
+    writer.submit(INSERT, (4, ))
+    writer.close()
+    assert stored(path) == [1, 4]
+
+
+def test_callback_runs_only_for_committed_rows(tmp_path):
+    path = str(tmp_path / 'rows.db')
+    writer = BatchWriter(path, schema=SCHEMA)
+    settled = []
+    writer.submit(INSERT, (1, ))
+    writer.after_commit(lambda: settled.append('first'))
+    writer.submit(INSERT, (1, ))
+    writer.after_commit(lambda: settled.append('second'),
+                        lambda: settled.append('second failed'))
+    writer.submit(INSERT, (2, ))
+    writer.after_commit(lambda: settled.append('third'))
+    writer.close()
+    assert settled == ['first', 'second failed', 'third']
+    assert stored(path) == [1, 2]
+
+
+# Connection whose ROLLBACK fails, like one left in an unknown state
+class BrokenRollback:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def in_transaction(self):
+        return self.conn.in_transaction
+
+    def execute(self, sql, params=()):
+        if sql == 'ROLLBACK':
+            raise sqlite3.OperationalError("disk I/O error")
+        return self.conn.execute(sql, params)
+
+    def close(self):
+        self.conn.close()
+
+
+def test_failed_rollback_reopens_the_connection(tmp_path):
+    path = str(tmp_path / 'rows.db')
+    writer = BatchWriter(path, schema=SCHEMA)
+    writer.flush()
+    writer._conn = BrokenRollback(writer._conn)
+    writer.submit(INSERT, (1, ))
+    writer.submit(INSERT, (1, ))
+    assert writer.flush(timeout=5)
+    writer.submit(INSERT, (2, ))
+    writer.close()
+    assert stored(path) == [1, 2]
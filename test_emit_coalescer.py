@@ -0,0 +1,46 @@
+from emit_coalescer import ALL_REGIONS_ROOM, EmitCoalescer
+
+
+class FakeSocketIO:
+
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, to, data))
+
+
+def movement(user, x, y, turn=0):
+    return {"user": user, "location": (x, y), "turn": turn}
+
+
+def test_each_view_gets_one_batch_per_window():
+    socketio = FakeSocketIO()
+    coalescer = EmitCoalescer(socketio,
+                              region_size=(5, 5),
+                              compress_threshold=0)
+    # A view spanning two regions, and one inside the first of them
+    wide = coalescer.room_for_view(0, 0, 9, 4)
+    narrow = coalescer.room_for_view(1, 1, 3, 3)
+    coalescer.join_view(wide)
+    coalescer.join_view(narrow)
+    coalescer.join_view(narrow)
+    for message in (movement('a', 1, 1), movement('b', 7, 2),
+                    movement('c', 2, 3), movement('d', 20, 20)):
+        coalescer.add(message)
+
+    coalescer.flush()
+    batches = {room: data["users"] for _, room, data in socketio.emitted}
+    assert len(socketio.emitted) == 3
+    assert sorted(batches[ALL_REGIONS_ROOM]) == ['a', 'b', 'c', 'd']
+    assert batches[wide] == ['a', 'c', 'b']
+    assert batches[narrow] == ['a', 'c']
+
+    # Rooms whose last client left are no longer sent anything
+    coalescer.leave_view(wide)
+    coalescer.leave_view(narrow)
+    coalescer.add(movement('e', 2, 2))
+    coalescer.flush()
+    assert [room for _, room, _ in socketio.emitted[3:]] == [
+        ALL_REGIONS_ROOM, narrow
+    ]
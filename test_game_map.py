@@ -0,0 +1,20 @@
+from game_map import GameMap
+
+
+def test_batch_checks_match_single_checks():
+    game_map = GameMap.from_layout([
+        [' ', 'H', ' '],
+        ['/', ' ', ' '],
+    ])
+    positions = [(0, 0), (0, 0), (2, 1), (1, 1), (1, 1), (2, 0)]
+    directions = ['E', 'N', 'E', 'W', 'X', 'S']
+    expected = []
+    for (x, y), direction in zip(positions, directions, strict=True):
+        new_x, new_y = game_map.step(x, y, direction)
+        expected.append((new_x, new_y, game_map.can_enter(new_x, new_y)))
+    assert game_map.check_moves(positions, directions) == expected
+    assert [valid for _, _, valid in expected] == [
+        False, False, False, True, True, True
+    ]
+    assert game_map.check_positions([-1, 0, 2, 3], [0, 1, 1, 1]) == (
+        bytearray([0, 1, 1, 0]))
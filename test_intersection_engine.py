@@ -0,0 +1,76 @@
+from intersection_engine import Intersection, IntersectionEngine
+
+
+def test_positions_added_after_their_turn_resolved_are_dropped():
+    engine = IntersectionEngine(10, 10)
+    engine.add(5, 'a', 1, 1)
+    engine.add(5, 'b', 1, 1)
+    assert len(engine.detect(5)) == 1
+
+    engine.add(5, 'c', 1, 1)
+    engine.add(4, 'd', 1, 1)
+    assert engine.late == 2
+    assert engine.pending(5) == 0
+    assert not engine._turns
+    assert engine.detect(5) == []
+
+
+def test_detect_drops_older_unresolved_turns():
+    engine = IntersectionEngine(10, 10)
+    engine.add(3, 'a', 1, 1)
+    engine.add(4, 'b', 2, 2)
+    engine.add(6, 'c', 3, 3)
+    engine.detect(5)
+    assert engine.dropped == 2
+    assert engine.pending(6) == 1
+    assert list(engine._turns) == [6]
+
+
+def test_reset_keeps_turns_of_the_restarted_clock():
+    engine = IntersectionEngine(10, 10)
+    engine.detect(40)
+    engine.add(41, 'old', 1, 1)
+    engine.reset()
+    engine.add(0, 'a', 2, 2)
+    engine.add(0, 'b', 2, 2)
+    assert engine.pending(41) == 0
+    assert [hit.users for hit in engine.detect(0)] == [('a', 'b')]
+
+
+def test_same_cell_users_are_deduplicated_in_arrival_order():
+    engine = IntersectionEngine(10, 10)
+    for user in ('b', 'a', 'b', 'c', 'a'):
+        engine.add(0, user, 4, 4)
+    engine.add(0, 'd', 5, 4)
+    engine.add(0, 'e', 6, 6)
+    engine.add(0, 'e', 6, 6)
+    assert engine.detect(0) == [
+        Intersection(('b', 'a', 'c'), (4, 4), None)
+    ]
+
+
+def test_radius_reports_each_near_pair_once():
+    engine = IntersectionEngine(10, 10, radius=1.5)
+    engine.add(0, 'a', 4, 4)
+    engine.add(0, 'b', 5, 5)  # diagonal, within 1.5
+    engine.add(0, 'c', 6, 4)  # two cells from a, outside the radius
+    engine.add(0, 'd', 9, 9)
+    engine.add(0, 'a', 9, 8)  # a again, next to d
+    hits = engine.detect(0)
+    assert sorted(hits) == sorted([
+        Intersection(('a', 'b'), (4, 4), (5, 5)),
+        Intersection(('c', 'b'), (6, 4), (5, 5)),
+        Intersection(('a', 'd'), (9, 8), (9, 9)),
+    ])
+
+
+def test_near_misses_need_a_radius_and_stay_on_the_map():
+    engine = IntersectionEngine(3, 3)
+    engine.add(0, 'a', 0, 0)
+    engine.add(0, 'b', 1, 0)
+    assert engine.detect(0) == []
+
+    engine = IntersectionEngine(3, 3, radius=1)
+    engine.add(0, 'a', 2, 0)
+    engine.add(0, 'b', 0, 1)  # wraps to the next row in the flat grid
+    assert engine.detect(0) == []
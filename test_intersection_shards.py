@@ -0,0 +1,143 @@
+import random
+import sqlite3
+
+import intersections_service
+from db_writer import BatchWriter
+from intersection_engine import engine_from_config
+from intersection_shards import IntersectionShard, layout_from_config
+from memory_broker import InMemoryBroker
+from messages import (
+    JSON_CODEC,
+    message_properties,
+    movement_message,
+    turn_message,
+)
+from topology import (
+    MOVEMENTS_EXCHANGE,
+    TURNS_EXCHANGE,
+    shard_movement_queue,
+    shard_turn_queue,
+    topology_from_config,
+)
+
+WIDTH = HEIGHT = 20
+WORKERS = 3
+
+
+def make_config(workers):
+    return {
+        "map_layout": [[" "] * WIDTH for _ in range(HEIGHT)],
+        "intersection_radius": 1.5,
+        "topology": {"region_size": [5, 5]},
+        "intersection_shards": {"workers": workers},
+    }
+
+
+# Moves as (turn, user, x, y): pairs meeting on and across tile borders,
+# where one side is only in a shard's halo, plus random ones
+def make_moves(turns=6, users=60, seed=3):
+    moves = [
+        (0, 'a', 4, 4), (0, 'b', 5, 5),  # diagonal across four tiles
+        (0, 'c', 9, 2), (0, 'd', 10, 2),  # side by side across a border
+        (1, 'a', 5, 5), (1, 'b', 5, 5),  # same cell on a tile corner
+        (1, 'c', 14, 9), (1, 'd', 15, 10),
+    ]
+    rng = random.Random(seed)
+    for turn in range(turns):
+        moves.extend((turn, f"user{user}", rng.randrange(WIDTH),
+                      rng.randrange(HEIGHT)) for user in range(users))
+    return sorted(moves, key=lambda move: move[0])
+
+
+# Broker with the single-process and the sharded queues, holding the moves
+# routed as movement_service publishes them, each turn followed by its end
+def publish_moves(moves):
+    broker = InMemoryBroker()
+    channel = broker.connection().channel()
+    topology_from_config(make_config(1)).declare(channel)
+    sharded = topology_from_config(make_config(WORKERS))
+    sharded.declare(channel)
+    properties = message_properties(JSON_CODEC)
+    turns = []
+    for turn, user, x, y in moves:
+        if turns and turns[-1] != turn:
+            broker.publish(TURNS_EXCHANGE, '',
+                           JSON_CODEC.encode(turn_message(turns[-1])),
+                           properties)
+        if not turns or turns[-1] != turn:
+            turns.append(turn)
+        broker.publish(
+            MOVEMENTS_EXCHANGE, sharded.routing_key(x, y),
+            JSON_CODEC.encode(movement_message(user, x, y, turn=turn)),
+            properties)
+    broker.publish(TURNS_EXCHANGE, '',
+                   JSON_CODEC.encode(turn_message(turns[-1])), properties)
+    return broker
+
+
+# Ack for handlers called outside a BatchConsumer
+def ack():
+    pass
+
+
+ack.requeue = ack
+
+
+# Feed a movement and a turn queue to `engine` turn by turn, as the
+# service's consumers would, recording into the database at `path`
+def consume(broker, engine, movements_queue, turns_queue, path):
+    writer = BatchWriter(path, schema=intersections_service.DATABASE_SCHEMA)
+    movements = broker.queues[movements_queue]
+    turns = broker.queues[turns_queue]
+    try:
+        while turns:
+            turn = JSON_CODEC.decode(turns[0].body)['turn']
+            batch = []
+            while (movements and JSON_CODEC.decode(
+                    movements[0].body)['turn'] <= turn):
+                batch.append(movements.popleft())
+            intersections_service.on_movement_batch(batch, ack, writer,
+                                                    engine)
+            intersections_service.on_turn_batch([turns.popleft()], ack,
+                                                writer, engine)
+    finally:
+        writer.close()
+
+
+def recorded(path):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(conn.execute(
+            'SELECT users, location, turn FROM intersections'))
+    finally:
+        conn.close()
+
+
+def test_sharded_intersections_match_a_single_process(tmp_path):
+    moves = make_moves()
+    broker = publish_moves(moves)
+
+    single_path = str(tmp_path / 'single.db')
+    consume(broker, engine_from_config(make_config(1)),
+            intersections_service.MOVEMENTS_QUEUE,
+            intersections_service.TURNS_QUEUE, single_path)
+
+    # Shards share one database, as the shard processes of run_sharded do
+    sharded_path = str(tmp_path / 'sharded.db')
+    layout = layout_from_config(make_config(WORKERS))
+    for worker in range(WORKERS):
+        consume(broker, IntersectionShard(layout, worker),
+                shard_movement_queue(worker), shard_turn_queue(worker),
+                sharded_path)
+
+    expected = recorded(single_path)
+    assert ('a, b', '5,5', 1) in expected
+    assert any(';' in location for _, location, _ in expected)
+    assert recorded(sharded_path) == expected
+    # Halo positions reach a shard without it recording their movements
+    conn = sqlite3.connect(sharded_path)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM movements').fetchone() == (
+            len(set(moves)), )
+    finally:
+        conn.close()
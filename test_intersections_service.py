@@ -0,0 +1,65 @@
+import sqlite3
+
+import intersections_service
+from db_writer import BatchWriter
+from intersection_engine import IntersectionEngine
+from messages import JSON_CODEC, movement_message, turn_message
+
+
+def count_movements(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM movements').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_redelivered_movement_is_recorded_once(tmp_path, monkeypatch):
+    path = str(tmp_path / 'local.db')
+    writer = BatchWriter(path, schema=intersections_service.DATABASE_SCHEMA)
+    engine = IntersectionEngine(10, 10)
+    body = JSON_CODEC.encode(
+        movement_message('alice', 3, 4, timestamp=1718000000))
+    other = JSON_CODEC.encode(
+        movement_message('alice', 5, 5, timestamp=1718000005))
+    try:
+        intersections_service.on_movement_message(body, writer, engine)
+        # The redelivery comes in after a turn update moved the open turn
+        monkeypatch.setattr(intersections_service, 'open_turn', 9)
+        intersections_service.on_movement_message(body, writer, engine)
+        intersections_service.on_movement_message(other, writer, engine)
+    finally:
+        writer.close()
+    assert count_movements(path) == 2
+
+
+def test_turn_resolves_movements_that_arrive_after_its_update(tmp_path):
+    path = str(tmp_path / 'local.db')
+    writer = BatchWriter(path, schema=intersections_service.DATABASE_SCHEMA)
+    engine = IntersectionEngine(10, 10)
+
+    def turn(number):
+        intersections_service.on_turn_update(
+            JSON_CODEC.encode(turn_message(number)), writer, engine)
+
+    def move(user):
+        intersections_service.on_movement_message(
+            JSON_CODEC.encode(movement_message(user, 2, 2, turn=0)), writer,
+            engine)
+
+    try:
+        turn(0)
+        # The turn consumer ran ahead of the movement consumer
+        move('alice')
+        move('bob')
+        turn(1)
+    finally:
+        writer.close()
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute(
+            'SELECT users, location, turn FROM intersections').fetchall() == [
+                ('alice, bob', '2,2', 0)
+            ]
+    finally:
+        conn.close()
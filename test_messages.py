@@ -0,0 +1,22 @@
+from messages import BINARY_CODEC, JSON_CODEC, movement_message, turn_message
+
+MESSAGES = [
+    movement_message('alice', 3, 4),
+    movement_message('bob', 1, 2, turn=7, timestamp=1718000000,
+                     action='move'),
+    movement_message('carol', 5, 6, turn=0, timestamp=1718000000.25,
+                     action='login'),
+    turn_message(12),
+    turn_message(13, epoch=1718000000.5),
+]
+
+
+def test_codecs_round_trip_identically():
+    for message in MESSAGES:
+        from_json = JSON_CODEC.decode(JSON_CODEC.encode(message))
+        from_binary = BINARY_CODEC.decode(BINARY_CODEC.encode(message))
+        assert from_json == message
+        assert from_binary == message
+        if 'timestamp' in message:
+            assert type(from_binary['timestamp']) is type(
+                message['timestamp'])
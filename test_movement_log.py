@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from movement_log import MOVEMENT, MovementLog
+
+
+# Turns 0..count-1 of one clock run, user 'a' moving one cell per turn
+def run_turns(movement_log, count, started, user='a', y=0):
+    for turn in range(count):
+        movement_log.append(user, turn, y)
+        movement_log.end_turn(turn, started + turn)
+
+
+def test_redelivered_turn_end_is_not_a_restart(tmp_path):
+    movement_log = MovementLog(str(tmp_path / 'log'))
+    run_turns(movement_log, 5, 1000.0)
+    movement_log.end_turn(2, 1002.0)
+
+    assert movement_log.clock_epoch == 0
+    assert movement_log.open_turn == 5
+    movement_log.close()
+
+
+def test_clock_restart_starts_a_new_epoch(tmp_path):
+    path = str(tmp_path / 'log')
+    movement_log = MovementLog(path, snapshot_every=2)
+    run_turns(movement_log, 5, 1000.0)
+    run_turns(movement_log, 3, 2000.0, user='b', y=1)
+
+    assert movement_log.clock_epoch == 1
+    assert movement_log.open_turn == 3
+    # Moves without a turn go to the restarted clock's open turn
+    movement_log.append('c', 9, 9)
+    assert [(record.user, record.turn)
+            for record in movement_log.replay(3, 3)] == [('c', 3)]
+
+    # Snapshots of both epochs are kept apart
+    assert movement_log.positions_at(2) == {'a': (4, 0), 'b': (2, 1)}
+    assert movement_log.positions_at(2, clock_epoch=0) == {'a': (2, 0)}
+    # The restart is seen at the first turn end, so moves made before it
+    # are still in the old epoch
+    assert [(record.user, record.turn)
+            for record in movement_log.replay(clock_epoch=0)
+            if record.kind == MOVEMENT][-1] == ('b', 5)
+    assert [(record.user, record.turn)
+            for record in movement_log.replay(0, 1)
+            if record.kind == MOVEMENT] == [('b', 1)]
+    movement_log.close()
+
+    # The epoch is recovered from the segment names
+    assert any('-' in name for name in os.listdir(path))
+    reopened = MovementLog(path, snapshot_every=2)
+    assert reopened.clock_epoch == 1
+    assert reopened.open_turn == 3
+    reopened.end_turn(3, 2003.0)
+    assert reopened.clock_epoch == 1
+    reopened.close()
+
+
+def test_movements_that_do_not_fit_a_record_are_rejected(tmp_path):
+    movement_log = MovementLog(str(tmp_path / 'log'))
+    for args, kwargs in (((('x' * 70000), 1, 1), {}),
+                         (('a', 1, 1), {'timestamp': '9' * 70000}),
+                         (('a', 1, 1), {'timestamp': 1718000000.5}),
+                         (('a', 2**40, 1), {})):
+        with pytest.raises(ValueError):
+            movement_log.append(*args, **kwargs)
+    movement_log.append('a', 1, 1, timestamp=1718000000)
+    assert [record.user for record in movement_log.replay()] == ['a']
+    movement_log.close()
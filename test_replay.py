@@ -0,0 +1,72 @@
+from game_map import GameMap
+from intersection_engine import Intersection, IntersectionEngine
+from movement_log import MovementLog
+from replay import Replayer, replay_messages
+
+LAYOUT = [
+    [' ', ' ', ' '],
+    [' ', 'H', ' '],
+]
+
+
+def make_replayer(movement_log, radius=0):
+    game_map = GameMap.from_layout(LAYOUT)
+    return Replayer(movement_log, game_map,
+                    IntersectionEngine(*game_map.size, radius=radius))
+
+
+# Turn 0: users 1 and 2 meet at (0, 0); turn 1: 1 moves on and 2 stays;
+# a movement for turn 0 arrives after it ended; turn 2 never ends
+def write_log(path):
+    movement_log = MovementLog(path)
+    movement_log.append('1', 0, 0)
+    movement_log.append('2', 0, 0)
+    movement_log.end_turn(0, 1000.0)
+    movement_log.append('1', 2, 0)
+    movement_log.append('2', 0, 0)
+    movement_log.append('9', 1, 0, turn=0)
+    movement_log.end_turn(1, 1001.0)
+    movement_log.append('3', 2, 1)
+    movement_log.flush()
+    return movement_log
+
+
+def test_turns_rebuild_maps_and_intersections(tmp_path):
+    movement_log = write_log(str(tmp_path / 'log'))
+    replayer = make_replayer(movement_log)
+    turns = list(replayer.turns())
+
+    assert [state.turn for state in turns] == [0, 1, 2]
+    assert [state.movements for state in turns] == [2, 2, 1]
+    assert turns[0].intersections == [
+        Intersection(('1', '2'), (0, 0), None)
+    ]
+    assert turns[0].changes == [[0, 0, ' ', 'X']]
+    # Each turn's map starts from the base layout
+    assert turns[1].changes == [[0, 0, 'X', '2'], [2, 0, ' ', '1']]
+    assert turns[2].changes == [[0, 0, '2', ' '], [2, 0, '1', ' '],
+                                [2, 1, ' ', '3']]
+    assert replayer.map_rows() == [[' ', ' ', ' '], [' ', 'H', '3']]
+    assert replayer.late == 1
+    movement_log.close()
+
+
+def test_messages_start_with_a_keyframe_and_end_with_totals(tmp_path):
+    movement_log = write_log(str(tmp_path / 'log'))
+    messages = list(
+        replay_messages(make_replayer(movement_log), 1, 2,
+                        keyframe_interval=2))
+
+    assert [message["type"] for message in messages] == [
+        "keyframe", "keyframe", "end"
+    ]
+    assert messages[0]["turn"] == 1
+    assert messages[0]["map"] == [['2', ' ', '1'], [' ', 'H', ' ']]
+    assert messages[-1] == {
+        "type": "end",
+        "turns": 2,
+        "movements": 3,
+        "late_movements": 0,
+        "intersections": 0
+    }
+    movement_log.close()
@@ -0,0 +1,41 @@
+import sqlite3
+
+import report_service
+from db_writer import BatchWriter
+
+
+def test_dedup_migration_runs_once(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    conn = sqlite3.connect(path)
+    for statement in report_service.REPORT_SCHEMA:
+        conn.execute(statement)
+    conn.executemany(
+        'INSERT INTO movements (user, location, timestamp) VALUES (?, ?, ?)',
+        [('a', '1,1', '1'), ('a', '1,1', '1')])
+    conn.executemany(
+        'INSERT INTO intersections (user1, user2, location, timestamp) '
+        'VALUES (?, ?, ?, ?)',
+        [('a', 'b', '1,1', '1'), ('b', 'a', '1,1', '1')])
+    conn.commit()
+    conn.close()
+
+    report_service.migrate_database(path)
+    BatchWriter(path, schema=report_service.INGEST_SCHEMA).close()
+
+    # Rows written once the indexes exist are not rewritten by a restart
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO intersections (user1, user2, location, "
+                 "timestamp) VALUES ('b', 'a', '2,2', '2')")
+    conn.commit()
+    conn.close()
+    report_service.migrate_database(path)
+
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM movements').fetchone() == (
+            1, )
+        assert sorted(conn.execute(
+            'SELECT user1, user2 FROM intersections')) == [
+                ('a', 'b'), ('b', 'a')]
+    finally:
+        conn.close()
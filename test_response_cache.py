@@ -0,0 +1,77 @@
+from flask import Flask, jsonify
+
+from response_cache import ResponseCache
+
+
+# App with a cached /report/<user> view counting its calls
+def make_app(cache, during_build=None):
+    app = Flask(__name__)
+    calls = []
+
+    @app.route('/report/<user>')
+    @cache.cached(lambda user: [f"user:{user}"])
+    def report(user):
+        calls.append(user)
+        if during_build is not None:
+            during_build()
+        return jsonify({"user": user, "version": len(calls)})
+
+    @app.route('/live')
+    @cache.cached(lambda: ["live"])
+    def live():
+        calls.append('live')
+        response = jsonify({"version": len(calls)})
+        response.cache_control.no_store = True
+        return response
+
+    return app.test_client(), calls
+
+
+def test_etag_revalidation_gets_an_empty_304():
+    client, calls = make_app(ResponseCache('test'))
+    first = client.get('/report/alice')
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+
+    again = client.get('/report/alice', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+    assert client.get('/report/alice').data == first.data
+    assert calls == ['alice']
+
+
+def test_invalidation_drops_only_the_tagged_responses():
+    cache = ResponseCache('test')
+    client, calls = make_app(cache)
+    alice = client.get('/report/alice')
+    client.get('/report/bob')
+
+    cache.invalidate('user:alice')
+    fresh = client.get('/report/alice',
+                       headers={'If-None-Match': alice.headers['ETag']})
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] != alice.headers['ETag']
+    client.get('/report/bob')
+    assert calls == ['alice', 'bob', 'alice']
+    assert cache.stats()["hits"] == 1
+
+
+def test_response_built_during_an_invalidation_is_not_stored():
+    cache = ResponseCache('test')
+    client, calls = make_app(cache,
+                             lambda: cache.invalidate('user:alice'))
+    client.get('/report/alice')
+    client.get('/report/alice')
+    assert calls == ['alice', 'alice']
+    assert cache.stats()["entries"] == 0
+
+
+def test_no_store_responses_bypass_the_cache():
+    cache = ResponseCache('test')
+    client, calls = make_app(cache)
+    client.get('/live')
+    response = client.get('/live')
+    assert 'ETag' not in response.headers
+    assert calls == ['live', 'live']
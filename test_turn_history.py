@@ -0,0 +1,68 @@
+import turn_history
+from turn_history import TurnHistory, history_from_config
+
+BASE = [[' ', ' '], [' ', 'H']]
+
+
+def test_least_recently_used_turn_is_evicted():
+    history = TurnHistory(BASE, max_turns=2)
+    history.create(0)
+    history.create(1)
+    history.set_cell(0, 0, 0, 'a')  # turn 0 is now the most recent
+    history.create(2)
+    assert history.resident_turns() == [0, 2]
+    assert 1 not in history
+    assert history.evictions == 1
+    assert history.get_cell(0, 0, 0) == 'a'
+
+
+def test_idle_turns_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(turn_history.time, 'monotonic', lambda: now[0])
+    history = TurnHistory(BASE, max_turns=10, ttl_seconds=5)
+    history.create(0)
+    history.create(1)
+    now[0] += 3
+    history.set_cell(1, 1, 0, 'b')
+    now[0] += 3
+    history.create(2)
+    assert history.resident_turns() == [1, 2]
+
+
+def test_evicted_turns_spill_and_come_back(tmp_path):
+    history = TurnHistory(BASE,
+                          max_turns=1,
+                          spill_path=str(tmp_path / 'spill'),
+                          spill_max_turns=2)
+    try:
+        history.create(0)
+        history.set_cell(0, 1, 0, 'a')
+        history.create(1)
+        history.create(2)
+        assert history.resident_turns() == [2]
+        assert 0 in history and 1 in history
+        assert history.get_cell(0, 1, 0) == 'a'
+        assert history.rows(0) == [[' ', 'a'], [' ', 'H']]
+
+        # Writing a spilled turn reloads it into memory
+        history.set_cell(0, 0, 1, 'b')
+        assert history.resident_turns() == [0]
+        assert history.rows(0) == [[' ', 'a'], ['b', 'H']]
+
+        # The spill ring holds two turns; later ones overwrite the oldest
+        history.create(3)
+        history.create(4)
+        assert [turn for turn in range(5) if turn in history] == [0, 3, 4]
+    finally:
+        history.close()
+
+
+def test_memory_budget_caps_resident_turns():
+    config = {
+        "map_history": {
+            "max_turns": 50,
+            "max_memory_bytes": 3 * 4 * 4,
+        }
+    }
+    history = history_from_config(config, BASE, spill=False)
+    assert history.max_turns == 3
@@ -0,0 +1,55 @@
+import pytest
+
+from turn_scheduler import CATCH_UP, SKIP, TurnScheduler
+
+
+# Run a scheduler with a period of 1 on a fake clock until `turns` turns
+# fired. Each tick takes 0.2, and the tick of turn 1 stalls until 4.5.
+# Returns the (turn, deadline) pairs fired.
+def run(policy, turns=5, **kwargs):
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    scheduler = TurnScheduler(1.0,
+                              policy=policy,
+                              spin_seconds=0,
+                              clock=lambda: now[0],
+                              sleep=sleep,
+                              **kwargs)
+    fired = []
+
+    def tick(turn, deadline):
+        fired.append((turn, deadline))
+        now[0] = 4.5 if turn == 1 else now[0] + 0.2
+        if len(fired) == turns:
+            scheduler.stop()
+
+    scheduler.run(tick)
+    return scheduler, fired
+
+
+def test_skip_resumes_at_the_current_turn():
+    scheduler, fired = run(SKIP, turns=4)
+    assert fired == [(0, 0.0), (1, 1.0), (4, 4.0), (5, 5.0)]
+    assert scheduler.skipped == 2
+    assert scheduler.max_lateness == pytest.approx(0.5)
+
+
+def test_catch_up_fires_missed_turns_back_to_back():
+    scheduler, fired = run(CATCH_UP, turns=6)
+    assert [turn for turn, _ in fired] == [0, 1, 2, 3, 4, 5]
+    assert [deadline for _, deadline in fired] == [0, 1, 2, 3, 4, 5]
+    assert scheduler.skipped == 0
+
+
+def test_catch_up_skips_past_max_catch_up():
+    scheduler, fired = run(CATCH_UP, turns=4, max_catch_up=1)
+    assert [turn for turn, _ in fired] == [0, 1, 2, 4]
+    assert scheduler.skipped == 1
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        TurnScheduler(1.0, policy='rewind')
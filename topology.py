@@ -0,0 +1,164 @@
+import json
+from collections import namedtuple
+from functools import lru_cache
+
+from intersection_shards import layout_from_config
+
+# Turn updates are copied to every bound queue
+TURNS_EXCHANGE = 'turns'
+# Movements are routed by map region with keys movement.<rx>.<ry>
+MOVEMENTS_EXCHANGE = 'movements'
+ALL_REGIONS = 'movement.#'
+
+DEFAULT_REGION_SIZE = (5, 5)
+
+Exchange = namedtuple('Exchange', ['name', 'type'])
+Binding = namedtuple('Binding', ['queue', 'exchange', 'routing_key'])
+
+EXCHANGES = [
+    Exchange(TURNS_EXCHANGE, 'fanout'),
+    Exchange(MOVEMENTS_EXCHANGE, 'topic'),
+]
+
+# One queue per consuming service, so every service sees every message
+# instead of competing with the others on a shared work queue
+MOVEMENT_QUEUES = {
+    'main': 'main.movements',
+    'intersections': 'intersections.movements',
+    'reports': 'reports.movements',
+    'mapbuilder': 'mapbuilder.movements',
+    'history': 'movement_service.history',
+}
+TURN_QUEUES = {
+    'main': 'main.turns',
+    'intersections': 'intersections.turns',
+    'history': 'movement_service.turns',
+    'mapbuilder': 'mapbuilder.turns',
+}
+
+
+def region_key(rx, ry):
+    return f"movement.{rx}.{ry}"
+
+
+# Queues of intersection shard `worker` when intersections are sharded
+def shard_movement_queue(worker):
+    return f"intersections.movements.{worker}"
+
+
+def shard_turn_queue(worker):
+    return f"intersections.turns.{worker}"
+
+
+# Bindings of every shard of a ShardLayout: the regions of its tiles and
+# halo, and the turns fanout
+def shard_bindings(layout):
+    bindings = []
+    for worker in range(layout.workers):
+        bindings.extend(
+            Binding(shard_movement_queue(worker), MOVEMENTS_EXCHANGE,
+                    region_key(tx, ty))
+            for tx, ty in layout.tiles_needed(worker))
+        bindings.append(Binding(shard_turn_queue(worker), TURNS_EXCHANGE, ''))
+    return bindings
+
+
+# Queue of map worker `worker` when the map builder runs several workers
+def map_worker_queue(worker):
+    return f"mapbuilder.movements.{worker}"
+
+
+# Map workers set in config.json
+def map_workers_from_config(config):
+    return max(1, config.get('map_workers', {}).get('workers', 1))
+
+
+# Bindings of `workers` map workers: the regions of a width x height map are
+# dealt out round-robin, so every cell is updated by exactly one worker
+def map_worker_bindings(width, height, region_size, workers):
+    region_width, region_height = region_size
+    regions = [(rx, ry) for ry in range(-(-height // region_height))
+               for rx in range(-(-width // region_width))]
+    return [
+        Binding(map_worker_queue(index % workers), MOVEMENTS_EXCHANGE,
+                region_key(rx, ry)) for index, (rx, ry) in enumerate(regions)
+    ]
+
+
+# Exchanges, service queues and bindings of the message flow between the
+# services. Every service declares the whole topology on startup, so
+# messages are queued for services that have not started yet. Services left
+# out of `services` (e.g. intersections when sharded) get no catch-all queue.
+class Topology:
+
+    def __init__(self, region_size=DEFAULT_REGION_SIZE, bindings=(),
+                 services=None):
+        self.region_width, self.region_height = region_size
+        self.bindings = [
+            Binding(queue, MOVEMENTS_EXCHANGE, ALL_REGIONS)
+            for service, queue in MOVEMENT_QUEUES.items()
+            if services is None or service in services
+        ] + [
+            Binding(queue, TURNS_EXCHANGE, '')
+            for service, queue in TURN_QUEUES.items()
+            if services is None or service in services
+        ] + list(bindings)
+
+    def region_of(self, x, y):
+        return x // self.region_width, y // self.region_height
+
+    # Routing key of a movement to cell (x, y)
+    def routing_key(self, x, y):
+        return region_key(*self.region_of(x, y))
+
+    # Channel calls that create the topology, as (method name, kwargs)
+    def declarations(self):
+        calls = [('exchange_declare', {
+            'exchange': exchange.name,
+            'exchange_type': exchange.type,
+            'durable': True
+        }) for exchange in EXCHANGES]
+        for queue in dict.fromkeys(binding.queue
+                                   for binding in self.bindings):
+            calls.append(('queue_declare', {'queue': queue, 'durable': True}))
+        for binding in self.bindings:
+            calls.append(('queue_bind', {
+                'queue': binding.queue,
+                'exchange': binding.exchange,
+                'routing_key': binding.routing_key
+            }))
+        return calls
+
+    # Declare everything on a blocking (or in-memory) channel
+    def declare(self, channel):
+        for method, kwargs in self.declarations():
+            getattr(channel, method)(**kwargs)
+
+
+# Topology for config.json. With more than one intersection shard worker the
+# intersection service's queues are replaced by one pair per shard, and with
+# more than one map worker the map builder's queue by one queue per worker.
+def topology_from_config(config, bindings=()):
+    settings = config.get('topology', {})
+    region_size = tuple(settings.get('region_size', DEFAULT_REGION_SIZE))
+    services = set(MOVEMENT_QUEUES)
+    worker_bindings = []
+    layout = layout_from_config(config)
+    if layout.workers > 1:
+        services.discard('intersections')
+        worker_bindings.extend(shard_bindings(layout))
+    map_workers = map_workers_from_config(config)
+    if map_workers > 1:
+        map_layout = config['map_layout']
+        services.discard('mapbuilder')
+        worker_bindings.extend(
+            map_worker_bindings(len(map_layout[0]), len(map_layout),
+                                region_size, map_workers))
+    return Topology(region_size, worker_bindings + list(bindings), services)
+
+
+# Topology from config.json, read once per process
+@lru_cache(maxsize=None)
+def load_topology(path='config.json'):
+    with open(path) as f:
+        return topology_from_config(json.load(f))
@@ -0,0 +1,235 @@
+import mmap
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+DEFAULT_MAX_TURNS = 64
+DEFAULT_SPILL_MAX_TURNS = 10000
+
+# Cell codes are stored as unsigned 32-bit ints
+_CODE_TYPE = 'I'
+_CODE_SIZE = array(_CODE_TYPE).itemsize
+
+
+# Fixed-slot ring of grids in a memory-mapped file. Slot `n % max_turns`
+# holds the n-th spilled turn; overwriting a slot forgets its old turn.
+class SpillFile:
+
+    def __init__(self, path, grid_bytes, max_turns=DEFAULT_SPILL_MAX_TURNS):
+        self.path = path
+        self.grid_bytes = grid_bytes
+        self.max_turns = max_turns
+        self._slots = {}
+        self._owners = {}
+        self._next_slot = 0
+        self._capacity = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._mmap = None
+        self._grow(min(max_turns, 16))
+
+    def _grow(self, slots):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._capacity = slots
+        os.ftruncate(self._fd, slots * self.grid_bytes)
+        self._mmap = mmap.mmap(self._fd, slots * self.grid_bytes)
+
+    def __contains__(self, turn):
+        return turn in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def write(self, turn, grid):
+        slot = self._slots.get(turn)
+        if slot is None:
+            slot = self._next_slot % self.max_turns
+            self._next_slot += 1
+            self._slots.pop(self._owners.get(slot), None)
+            self._owners[slot] = turn
+            self._slots[turn] = slot
+        if slot >= self._capacity:
+            self._grow(min(self.max_turns, self._capacity * 2))
+        offset = slot * self.grid_bytes
+        self._mmap[offset:offset + self.grid_bytes] = grid.tobytes()
+
+    # Read a whole grid back, or None if the turn is not on disk
+    def read(self, turn):
+        slot = self._slots.get(turn)
+        if slot is None:
+            return None
+        offset = slot * self.grid_bytes
+        grid = array(_CODE_TYPE)
+        grid.frombytes(self._mmap[offset:offset + self.grid_bytes])
+        return grid
+
+    # Read one cell code without loading the grid
+    def read_cell(self, turn, index):
+        offset = self._slots[turn] * self.grid_bytes + index * _CODE_SIZE
+        return array(_CODE_TYPE,
+                     self._mmap[offset:offset + _CODE_SIZE])[0]
+
+    def forget(self, turn):
+        slot = self._slots.pop(turn, None)
+        if slot is not None:
+            self._owners.pop(slot, None)
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+# Per-turn map grids with bounded memory. Each grid is a flat array of cell
+# codes (one entry per cell, mapped to the layout strings through a shared
+# symbol table). The `max_turns` most recently used turns stay in memory;
+# turns beyond that, or untouched for `ttl_seconds`, are evicted to a
+# SpillFile when `spill_path` is set and dropped otherwise.
+class TurnHistory:
+
+    def __init__(self,
+                 base_rows,
+                 max_turns=DEFAULT_MAX_TURNS,
+                 ttl_seconds=None,
+                 spill_path=None,
+                 spill_max_turns=DEFAULT_SPILL_MAX_TURNS):
+        self.height = len(base_rows)
+        self.width = len(base_rows[0])
+        self.max_turns = max(1, max_turns)
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self._symbols = []
+        self._codes = {}
+        self._base = array(_CODE_TYPE,
+                           [self._code(cell) for row in base_rows
+                            for cell in row])
+        self._grids = OrderedDict()
+        self._lock = threading.RLock()
+        self._spill = (SpillFile(spill_path,
+                                 len(self._base) * _CODE_SIZE,
+                                 spill_max_turns) if spill_path else None)
+
+    @property
+    def grid_bytes(self):
+        return len(self._base) * _CODE_SIZE
+
+    def _code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self._symbols)
+            self._codes[value] = code
+            self._symbols.append(value)
+        return code
+
+    def __contains__(self, turn):
+        with self._lock:
+            return turn in self._grids or (self._spill is not None
+                                           and turn in self._spill)
+
+    # Turns currently held in memory, least recently used first
+    def resident_turns(self):
+        with self._lock:
+            return list(self._grids)
+
+    # Approximate memory held by resident grids
+    def memory_bytes(self):
+        with self._lock:
+            return len(self._grids) * self.grid_bytes
+
+    # Start a turn from the base layout (no-op if it already exists)
+    def create(self, turn):
+        with self._lock:
+            if turn not in self:
+                self._store(turn, array(_CODE_TYPE, self._base))
+
+    def get_cell(self, turn, x, y):
+        index = y * self.width + x
+        with self._lock:
+            entry = self._grids.get(turn)
+            if entry is not None:
+                return self._symbols[entry[0][index]]
+            if self._spill is not None and turn in self._spill:
+                return self._symbols[self._spill.read_cell(turn, index)]
+            raise KeyError(turn)
+
+    def set_cell(self, turn, x, y, value):
+        with self._lock:
+            grid = self._load(turn)
+            grid[y * self.width + x] = self._code(value)
+
+    # Base layout value of a cell
+    def base_cell(self, x, y):
+        return self._symbols[self._base[y * self.width + x]]
+
+    # Decode a turn's grid into a list of rows of cell strings
+    def rows(self, turn):
+        with self._lock:
+            entry = self._grids.get(turn)
+            grid = entry[0] if entry is not None else (
+                self._spill.read(turn) if self._spill is not None else None)
+            if grid is None:
+                raise KeyError(turn)
+            symbols = self._symbols
+            width = self.width
+            return [[symbols[code] for code in grid[i:i + width]]
+                    for i in range(0, len(grid), width)]
+
+    def close(self):
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+
+    # Fetch a grid for writing, bringing spilled turns back into memory
+    def _load(self, turn):
+        entry = self._grids.get(turn)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self._grids.move_to_end(turn)
+            return entry[0]
+        grid = self._spill.read(turn) if self._spill is not None else None
+        if grid is None:
+            raise KeyError(turn)
+        self._spill.forget(turn)
+        self._store(turn, grid)
+        return grid
+
+    def _store(self, turn, grid):
+        self._grids[turn] = [grid, time.monotonic()]
+        self._grids.move_to_end(turn)
+        self._evict()
+
+    def _evict(self):
+        expire_before = (time.monotonic() - self.ttl_seconds
+                         if self.ttl_seconds else None)
+        while self._grids:
+            turn, (grid, last_used) = next(iter(self._grids.items()))
+            over_budget = len(self._grids) > self.max_turns
+            expired = expire_before is not None and last_used < expire_before
+            if not (over_budget or expired) or len(self._grids) == 1:
+                break
+            del self._grids[turn]
+            self.evictions += 1
+            if self._spill is not None:
+                self._spill.write(turn, grid)
+
+
+# Build a TurnHistory from the "map_history" section of config.json. A
+# `max_memory_bytes` budget caps the number of resident turns. Opening the
+# spill file truncates it, so only the process that owns it may pass
+# `spill=True`; other histories drop evicted turns.
+def history_from_config(config, base_rows, spill=True):
+    settings = config.get('map_history', {})
+    history = TurnHistory(
+        base_rows,
+        max_turns=settings.get('max_turns', DEFAULT_MAX_TURNS),
+        ttl_seconds=settings.get('ttl_seconds'),
+        spill_path=settings.get('spill_path') if spill else None,
+        spill_max_turns=settings.get('spill_max_turns',
+                                     DEFAULT_SPILL_MAX_TURNS))
+    budget = settings.get('max_memory_bytes')
+    if budget:
+        history.max_turns = max(1,
+                                min(history.max_turns,
+                                    budget // history.grid_bytes))
+    return history
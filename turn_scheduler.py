@@ -0,0 +1,113 @@
+import threading
+import time
+
+# What to do with turns whose deadline has already passed
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+POLICIES = (SKIP, CATCH_UP)
+
+# Sleep until this close to a deadline, then spin; time.sleep alone can
+# overshoot by a scheduler tick, which matters at 50-100 turns per second
+DEFAULT_SPIN_SECONDS = 0.0005
+
+
+# Fires turns on absolute deadlines start + n * period of the monotonic
+# clock, so time spent in `tick` does not accumulate as drift. When a
+# deadline is missed by a whole period or more, SKIP drops the missed turns
+# and resumes at the current one; CATCH_UP fires them back to back, at most
+# `max_catch_up` at a time before skipping the rest.
+class TurnScheduler:
+
+    def __init__(self,
+                 period,
+                 policy=SKIP,
+                 max_catch_up=10,
+                 spin_seconds=DEFAULT_SPIN_SECONDS,
+                 clock=time.monotonic,
+                 sleep=time.sleep):
+        if period <= 0:
+            raise ValueError("Turn period must be positive")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown missed-deadline policy '{policy}'; "
+                             f"use one of {', '.join(POLICIES)}")
+        self.period = period
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.spin_seconds = spin_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.stopped = threading.Event()
+        self.fired = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self.start_time = None
+        self.wall_start = None
+
+    # Wall-clock time of a monotonic instant of this run. Derived from the
+    # monotonic clock, so it does not jump if the system clock is adjusted.
+    def wall_time(self, monotonic_time):
+        return self.wall_start + (monotonic_time - self.start_time)
+
+    def deadline(self, index):
+        return self.start_time + index * self.period
+
+    def _wait_until(self, deadline):
+        while True:
+            remaining = deadline - self.clock()
+            if remaining <= 0 or self.stopped.is_set():
+                return
+            if remaining > self.spin_seconds:
+                self.sleep(remaining - self.spin_seconds)
+
+    # Call tick(turn, deadline) for turns first_turn, first_turn + 1, ...
+    # until stop() is called. `deadline` is the turn's scheduled monotonic
+    # time.
+    def run(self, tick, first_turn=0):
+        self.start_time = self.clock()
+        self.wall_start = time.time()
+        index = 0
+        burst = 0
+        while not self.stopped.is_set():
+            deadline = self.deadline(index)
+            self._wait_until(deadline)
+            if self.stopped.is_set():
+                return
+            lateness = self.clock() - deadline
+            if lateness >= self.period:
+                missed = int(lateness // self.period)
+                if self.policy == SKIP or burst >= self.max_catch_up:
+                    index += missed
+                    self.skipped += missed
+                    burst = 0
+                    deadline = self.deadline(index)
+                    lateness = self.clock() - deadline
+                else:
+                    burst += 1
+            else:
+                burst = 0
+            self.max_lateness = max(self.max_lateness, lateness)
+            tick(first_turn + index, deadline)
+            self.fired += 1
+            index += 1
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {
+            "period": self.period,
+            "policy": self.policy,
+            "fired": self.fired,
+            "skipped": self.skipped,
+            "max_lateness": self.max_lateness,
+        }
+
+
+# Scheduler for the turn_duration and "turn_clock" settings of config.json
+def scheduler_from_config(config):
+    settings = config.get('turn_clock', {})
+    return TurnScheduler(config.get('turn_duration', 1.0),
+                         policy=settings.get('missed_deadline_policy', SKIP),
+                         max_catch_up=settings.get('max_catch_up', 10),
+                         spin_seconds=settings.get('spin_seconds',
+                                                   DEFAULT_SPIN_SECONDS))